@@ -50,6 +50,7 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'run_pipeline.middleware.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -63,7 +64,7 @@ CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",  # Allow requests from React app
 ]
 
-CORS_EXPOSE_HEADERS = ['Content-Disposition']
+CORS_EXPOSE_HEADERS = ['Content-Disposition', 'Server-Timing', 'X-Pipeline-Id', 'X-Pipeline-Version']
 
 
 ROOT_URLCONF = 'adp.urls'
@@ -138,3 +139,190 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Sandbox execution
+
+# Build context of the image the generated code runs in
+PODMAN_IMAGE_DIR = BASE_DIR / 'podman-image'
+PODMAN_IMAGE_NAME = 'python-container'
+
+# Prebuilt image variants, each with a subset of the packages of podman-image/requirements.txt (None for all).
+# A job runs in the smallest variant providing the packages its code imports, else in the complete image.
+# The packages are taken from requirements.txt only, imports of other packages fail the pre-flight check.
+PODMAN_IMAGE_VARIANTS = {
+    'slim': [],
+    'data': ['numpy', 'pandas', 'pyarrow', 'openpyxl', 'matplotlib', 'Jinja2', 'lxml'],
+    'full': None,
+}
+
+# Wheels of all packages are downloaded once and the images are built offline from them
+PODMAN_WHEEL_CACHE_DIR = BASE_DIR / 'cache' / 'wheels'
+
+# Job workspaces with the linked inputs and the generated code are created below this directory.
+# A container mounts only the workspace of its job read-only and the job's own directory below the
+# outputs root as the only writable mount. Both roots must be on the file system of MEDIA_ROOT
+# for the inputs to be hard-linked instead of copied.
+PODMAN_WORKSPACE_ROOT = BASE_DIR / 'workspaces'
+PODMAN_OUTPUTS_ROOT = BASE_DIR / 'outputs'
+
+# Number of pre-started containers kept warm per image variant, 0 starts a new container for every job.
+# A pooled container runs a single job and is removed afterwards.
+PODMAN_POOL_SIZE = 2
+
+# Maximum number of jobs running in the sandbox at the same time, None uses the number of CPU cores
+SANDBOX_MAX_CONCURRENCY = None
+
+# CPU and memory limits of every sandbox container (podman --cpus / --memory), None disables a limit
+PODMAN_CPUS = 1.0
+PODMAN_MEMORY = '1g'
+
+# Maximum number of processes in a sandbox container (podman --pids-limit), None disables the limit
+PODMAN_PIDS_LIMIT = 256
+
+# Network of the sandbox containers (podman --network), 'none' cuts them off, None keeps podman's default
+PODMAN_NETWORK = None
+
+# Seconds a job may run before its container is killed, and CPU seconds its program may use
+PODMAN_TIMEOUT = 300
+PODMAN_CPU_TIME_LIMIT = 240
+
+# Class running the generated code, a subclass of services.executor.Executor:
+# - services.podman_executor.PodmanExecutor isolates it in containers
+# - services.worker_pool_executor.WorkerPoolExecutor forks it from pre-started Python workers with the
+#   heavy libraries imported, limited by rlimits but not isolated from the host (trusted jobs only)
+# - services.local_executor.LocalExecutor runs it in a local subprocess without isolation (benchmarks only)
+# The time, CPU and memory limits above apply to all of them.
+EXECUTOR_BACKEND = 'services.podman_executor.PodmanExecutor'
+
+# Modules the workers of the WorkerPoolExecutor import once, the forked jobs start with them loaded
+WORKER_POOL_PRELOAD = ['pandas', 'numpy', 'openpyxl']
+
+# Largest file a job of the WorkerPoolExecutor may write and number of files it may open, None for no limit
+WORKER_POOL_MAX_FILE_SIZE = 1024 * 1024 * 1024
+WORKER_POOL_MAX_OPEN_FILES = 256
+
+# Number of background workers running submitted jobs (generation, execution and fix retries)
+JOB_WORKERS = 4
+
+# Seconds finished jobs are kept with their uploads and outputs before they are removed (None keeps them),
+# and seconds between two removals of expired jobs by the background workers
+JOB_RETENTION = 7 * 24 * 3600
+JOB_CLEANUP_INTERVAL = 3600
+
+
+# File uploads
+
+# Size limits of a single uploaded file and of all files of one request, in bytes.
+# They are enforced by SizeLimitUploadHandler while the upload is streaming in.
+MAX_UPLOAD_FILE_SIZE = 512 * 1024 * 1024
+MAX_UPLOAD_REQUEST_SIZE = 2 * 1024 * 1024 * 1024
+
+# Uploads larger than FILE_UPLOAD_MAX_MEMORY_SIZE are streamed to a temporary file instead of memory
+FILE_UPLOAD_HANDLERS = [
+    'run_pipeline.uploads.SizeLimitUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# Size of the chunks uploads are copied to the job workspace with
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+# Input file previews
+
+# Extracted previews are cached on disk by file content hash, bounded to this many entries (0 disables the cache)
+PREVIEW_CACHE_DIR = BASE_DIR / 'cache' / 'previews'
+PREVIEW_CACHE_MAX_ENTRIES = 2000
+
+# Previews are extracted in a pool of worker processes (0 extracts them in the request thread, without timeouts)
+PREVIEW_WORKERS = 4
+
+# Seconds a single file (from the moment a worker starts reading it) and all files of a request
+# may take before a placeholder is used instead
+PREVIEW_FILE_TIMEOUT = 10
+PREVIEW_TOTAL_TIMEOUT = 30
+
+# Readers stop parsing a file once its preview reached this many characters
+PREVIEW_MAX_CHARS = 4000
+
+# Token budget shared by the previews of all input files in the LLM prompt
+PROMPT_INPUT_TOKEN_BUDGET = 6000
+
+
+# Columnar inputs
+
+# Tabular uploads (CSV, TSV and the sheets of xlsx workbooks) of at least COLUMNAR_MIN_BYTES are converted
+# to Parquet once and linked next to the originals, and the model is told to load these copies instead
+# of parsing the originals in every run and fix retry. The copies are cached on disk by content hash,
+# bounded to COLUMNAR_CACHE_MAX_ENTRIES converted files (0 for no bound).
+COLUMNAR_INPUTS = True
+COLUMNAR_MIN_BYTES = 1024 * 1024
+COLUMNAR_CACHE_DIR = BASE_DIR / 'cache' / 'columnar'
+COLUMNAR_CACHE_MAX_ENTRIES = 500
+
+
+# Sample-first execution
+
+# When the input files add up to at least SAMPLE_MIN_BYTES, new code runs on truncated copies of them
+# first: the first SAMPLE_ROWS rows of CSV, TSV, Parquet files and xlsx sheets, the first SAMPLE_PDF_PAGES
+# pages of PDFs. Failures go straight back to the fixer, only code that passed runs on the full inputs.
+SAMPLE_FIRST = True
+SAMPLE_MIN_BYTES = 5 * 1024 * 1024
+SAMPLE_ROWS = 1000
+SAMPLE_PDF_PAGES = 3
+
+
+# Generated code cache
+
+# Code that ran successfully is reused for the same instruction and input structure
+CODE_CACHE_MAX_ENTRIES = 500
+CODE_CACHE_TTL = 7 * 24 * 60 * 60  # Seconds
+
+
+# LLM clients
+
+# Seconds before an LLM request times out
+LLM_TIMEOUT = 60
+
+# Transient errors (rate limits, 5xx, connection errors) are retried with jittered exponential backoff
+LLM_MAX_RETRIES = 4
+LLM_BACKOFF_BASE = 0.5  # Seconds
+LLM_BACKOFF_MAX = 20  # Seconds
+
+# Size of the HTTP connection pool of each LLM client
+LLM_MAX_CONNECTIONS = 20
+
+# API endpoints of the LLM providers, None uses the provider's default. The benchmark command
+# points them to a local stub server (services/stub_llm.py).
+GROQ_BASE_URL = None
+OPENAI_BASE_URL = None
+
+
+# Speculative execution
+
+# Candidates generated and executed in parallel, the first one that succeeds and writes output wins
+# and the others are cancelled. Each candidate names an LLM provider ('groq' or 'openai') and the
+# sampling temperature (None for the provider's default). An empty list disables speculative mode.
+SPECULATIVE_CANDIDATES = []
+# For example:
+# SPECULATIVE_CANDIDATES = [
+#     {'provider': 'groq', 'temperature': 0.2},
+#     {'provider': 'groq', 'temperature': 0.8},
+#     {'provider': 'openai', 'temperature': 0.3},
+# ]
+
+
+# Batch runs
+
+# Input groups of a batch executed at the same time, the sandbox admits at most SANDBOX_MAX_CONCURRENCY
+# jobs of all requests at once. A batch may have at most BATCH_MAX_GROUPS input groups.
+BATCH_CONCURRENCY = 4
+BATCH_MAX_GROUPS = 100
+
+
+# Pre-flight check
+
+# Generated code is checked for imports missing from the sandbox image, reads of files that were
+# not uploaded and a missing output before it is executed; problems go straight back to the fixer
+PREFLIGHT_CHECKS = True
@@ -5,9 +5,12 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from run_pipeline.views import MetricsView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('run_pipeline.urls')),  # Include the API routes
+    path('metrics', MetricsView.as_view(), name='metrics'),  # Prometheus scrape endpoint
 ]
 
 # Serve media files during development
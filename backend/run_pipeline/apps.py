@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class RunPipelineConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'run_pipeline'
+
+    def ready(self):
+        from django.core.signals import request_started
+
+        from .jobs import recover_jobs
+
+        # The database is not queried while the apps load, the jobs are recovered on the first request
+        request_started.connect(recover_jobs, dispatch_uid='run_pipeline.recover_jobs')
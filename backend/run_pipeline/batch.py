@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+from services import metrics
+from services.workspace import Workspace
+
+from .downloads import directory_entries
+from .pipeline import ProgramPipeline
+from .pipeline_store import save_pipeline_version
+from .previews import generate_input_files_description
+
+logger = logging.getLogger(__name__)
+
+# Multipart fields named like this hold the files of one input group
+GROUP_FIELD_PREFIX = 'group.'
+
+# Characters of the execution logs of an item kept in the report
+REPORT_LOG_CHARS = 4000
+
+
+class BatchItem:
+    """One input group of a batch, run in its own workspace."""
+
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files
+        self.workspace = None
+        self.input_names = []
+        self.success = False
+        self.logs = ''
+        self.exit_reason = None
+        self.elapsed = None
+
+    def report(self):
+        return {
+            'name': self.name,
+            'files': [file.name for file in self.files],
+            'success': self.success,
+            'exit_reason': self.exit_reason,
+            'elapsed': round(self.elapsed, 3) if self.elapsed is not None else None,
+            'outputs': [arcname for arcname, _ in self.output_entries()],
+            'logs': self.logs[-REPORT_LOG_CHARS:],
+        }
+
+    def output_entries(self):
+        if not self.success or self.workspace is None:
+            return []
+        return directory_entries(self.workspace.output_directory, prefix=f'{self.name}/')
+
+
+def group_name(name):
+    """A name usable as a directory of the archive."""
+    return re.sub(r'[^\w.-]', '_', name).strip('.') or 'group'
+
+
+def collect_groups(files):
+    """
+    Input groups of a request as BatchItems: the files of every `group.<name>` field form
+    a group, and every file uploaded as `files` is a group of its own, named after the file.
+    """
+    groups = []
+    for field in files:
+        if field.startswith(GROUP_FIELD_PREFIX):
+            groups.append((field[len(GROUP_FIELD_PREFIX):], files.getlist(field)))
+        elif field == 'files':
+            groups.extend((os.path.splitext(file.name)[0], [file]) for file in files.getlist(field))
+
+    items = []
+    used = set()
+    for name, group_files in groups:
+        name = unique = group_name(name)
+        counter = 1
+        while unique in used:
+            counter += 1
+            unique = f'{name}-{counter}'
+        used.add(unique)
+        items.append(BatchItem(unique, group_files))
+    return items
+
+
+def input_names(item, template):
+    """
+    Names the files of an item are stored under. The code is generated for the first group, so
+    when an item has as many files with the same extensions, they take the first group's names
+    in upload order, making monthly exports like sales-01.csv and sales-02.csv interchangeable.
+    """
+    names = [file.name for file in item.files]
+    if template is not None and len(names) == len(template) and all(
+        os.path.splitext(name)[1].lower() == os.path.splitext(template_name)[1].lower()
+        for name, template_name in zip(names, template)
+    ):
+        return list(template)
+    return names
+
+
+def prepare_workspace(item, template=None):
+    item.workspace = Workspace()
+    item.input_names = input_names(item, template)
+    for file, name in zip(item.files, item.input_names):
+        item.workspace.save_upload(file, name)
+
+
+def finish(item, result):
+    """Record the outcome of executing an item, an ExecutionResult or a (success, logs) pair."""
+    item.success, item.logs = result
+    item.exit_reason = getattr(result, 'exit_reason', None)
+    item.elapsed = getattr(result, 'elapsed', None)
+
+
+def run_batch(items, instruction, executor):
+    """
+    Generate, check and fix the code on the first item, then execute it on all other items in
+    parallel, at most BATCH_CONCURRENCY at once. Returns the saved PipelineVersion of the code (None if
+    it could not be saved). If the first item failed, no other item was run.
+    """
+    pipeline = ProgramPipeline(executor)
+    first = items[0]
+    with metrics.span('upload', files=sum(len(item.files) for item in items)):
+        prepare_workspace(first)
+        for item in items[1:]:
+            prepare_workspace(item, first.input_names)
+
+    input_files_description = generate_input_files_description(first.input_names, first.workspace.directory, 16)
+    if not input_files_description:
+        finish(first, (False, "Failed to generate file descriptions."))
+    else:
+        finish(first, pipeline.run(first.workspace.directory, input_files_description, instruction))
+    if not first.success:
+        for item in items[1:]:
+            item.logs = "Not run, no working code could be generated on the first input group."
+        return None
+    code = (first.workspace.directory / "main.py").read_text()
+    version = save_pipeline_version(instruction, input_files_description, code, first.input_names)
+
+    def execute(item):
+        try:
+            # The code ran successfully on the first item, the pre-flight check could only reject it wrongly
+            finish(item, pipeline.execute(code, item.workspace.directory, check=False))
+        except Exception as e:
+            logger.exception(f"Batch item {item.name} crashed.")
+            finish(item, (False, str(e)))
+
+    logger.info(f"Running the batch over {len(items) - 1} more input groups.")
+    with ThreadPoolExecutor(max_workers=settings.BATCH_CONCURRENCY, thread_name_prefix='adp-batch') as pool:
+        # The items' spans belong to the request as well
+        for future in [pool.submit(metrics.propagate(execute), item) for item in items[1:]]:
+            future.result()
+    return version
+
+
+def batch_entries(items, instruction, version):
+    """(arcname, path or bytes) entries of the combined archive: each item's outputs and report.json."""
+    report = {
+        'instruction': instruction,
+        'pipeline': {'pipeline_id': version.pipeline_id, 'version': version.version} if version else None,
+        'succeeded': sum(item.success for item in items),
+        'failed': sum(not item.success for item in items),
+        'items': [item.report() for item in items],
+    }
+    entries = [('report.json', json.dumps(report, indent=2).encode())]
+    for item in items:
+        entries.extend(item.output_entries())
+    return entries
+
+
+def cleanup(items):
+    for item in items:
+        if item.workspace is not None:
+            item.workspace.cleanup()
@@ -0,0 +1,178 @@
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from django.conf import settings
+import pandas as pd
+import pyarrow as pa
+
+from services import metrics
+from services.workspace import link_file
+
+from .preview_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+# Bump when the conversion changes, so that stale copies are not served anymore
+COLUMNAR_FORMAT_VERSION = 1
+
+# Readers of the tabular formats converted to Parquet, returning {sheet name or None: data frame}
+COLUMNAR_READERS = {
+    '.csv': lambda path: {None: pd.read_csv(path)},
+    '.tsv': lambda path: {None: pd.read_csv(path, sep='\t')},
+    '.xlsx': lambda path: pd.read_excel(path, sheet_name=None, engine='openpyxl'),
+}
+
+# Maps the Parquet file names of a cache entry to the names of the sheets they hold
+SHEETS_FILE = 'sheets.json'
+
+_columnar_cache = None
+_columnar_cache_lock = threading.Lock()
+
+
+def get_columnar_cache():
+    """Return the process-wide cache of columnar copies."""
+    global _columnar_cache
+    with _columnar_cache_lock:
+        if _columnar_cache is None:
+            _columnar_cache = ColumnarCache(settings.COLUMNAR_CACHE_DIR, settings.COLUMNAR_CACHE_MAX_ENTRIES)
+        return _columnar_cache
+
+
+class ColumnarCopy:
+    """A Parquet copy of a table of an input file, linked into a workspace."""
+
+    def __init__(self, name, source, sheet=None):
+        self.name = name
+        self.source = source
+        self.sheet = sheet
+
+    def __str__(self):
+        table = f"{self.source}, sheet '{self.sheet}'" if self.sheet is not None else self.source
+        return f"{self.name} (copy of {table})"
+
+
+def sheet_file_name(sheet):
+    return re.sub(r'[^\w.-]', '_', str(sheet))
+
+
+def write_parquet(data_frame, path):
+    try:
+        data_frame.to_parquet(path, index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # Object columns mixing types, like numbers and text in a spreadsheet column, are stored as text
+        text_columns = {column: 'string' for column in data_frame.select_dtypes(include='object').columns}
+        data_frame.astype(text_columns).to_parquet(path, index=False)
+
+
+class ColumnarCache:
+    """
+    Content-addressed store of the Parquet copies of tabular files, on disk and bounded in LRU order.
+    An entry is a directory keyed by the file's content hash and extension, holding one Parquet file
+    per table: data.parquet for delimited files, <sheet>.parquet for the sheets of a workbook,
+    and sheets.json mapping the file names to the sheet names.
+    """
+
+    def __init__(self, directory, max_entries):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(file_hash, file_extension):
+        return f"{file_hash}-{file_extension.lstrip('.')}-v{COLUMNAR_FORMAT_VERSION}"
+
+    def _path(self, key):
+        return self.directory / key[:2] / key
+
+    def tables(self, file_path):
+        """{sheet name or None for delimited files: Parquet path} of a file, converting it on a cache miss."""
+        file_path = Path(file_path)
+        extension = file_path.suffix.lower()
+        entry = self._path(self.key(file_digest(file_path), extension))
+        if entry.is_dir():
+            # The mtime records the last access for the LRU eviction
+            os.utime(entry)
+        else:
+            self._convert(file_path, extension, entry)
+        sheets = json.loads((entry / SHEETS_FILE).read_text())
+        return {sheet: entry / f"{name}.parquet" for name, sheet in sheets.items()}
+
+    def _convert(self, file_path, extension, entry):
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=entry.parent))
+        try:
+            sheets = {}
+            for sheet, data_frame in COLUMNAR_READERS[extension](file_path).items():
+                name = sheet_file_name(sheet) if sheet is not None else 'data'
+                write_parquet(data_frame, staging / f"{name}.parquet")
+                sheets[name] = sheet
+            (staging / SHEETS_FILE).write_text(json.dumps(sheets))
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                # Another request converted the same file meanwhile
+                pass
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            entries = sorted(self.directory.glob('*/*-v*'), key=lambda path: path.stat().st_mtime)
+            for entry in entries[:max(0, len(entries) - self.max_entries)]:
+                shutil.rmtree(entry, ignore_errors=True)
+
+
+def add_columnar_copies(directory, file_names, min_bytes=None):
+    """
+    Link Parquet copies of the tabular input files of at least min_bytes (COLUMNAR_MIN_BYTES by default)
+    into the directory, next to the originals, as <file name>.parquet or <file name>.<sheet>.parquet
+    for workbooks. Files that already have copies are kept. Returns the ColumnarCopies.
+    """
+    if min_bytes is None:
+        min_bytes = settings.COLUMNAR_MIN_BYTES
+    directory = Path(directory)
+    copies = []
+    for name in file_names:
+        path = directory / name
+        if path.suffix.lower() not in COLUMNAR_READERS or path.stat().st_size < min_bytes:
+            continue
+        existing = [directory / f"{name}.parquet"] + sorted(directory.glob(f"{glob.escape(name)}.*.parquet"))
+        existing = [copy for copy in existing if copy.exists()]
+        if existing:
+            copies.extend(ColumnarCopy(copy.name, name) for copy in existing)
+            continue
+        try:
+            with metrics.span('columnar', file_bytes=path.stat().st_size):
+                tables = get_columnar_cache().tables(path)
+        except Exception as e:
+            logger.warning(f"Could not convert {name} to Parquet, the model reads the original: {e}")
+            continue
+        for sheet, table_path in tables.items():
+            copy_name = f"{name}.{table_path.stem}.parquet" if sheet is not None else f"{name}.parquet"
+            link_file(table_path, directory / copy_name)
+            copies.append(ColumnarCopy(copy_name, name, sheet))
+    return copies
+
+
+def columnar_note(copies):
+    """Paragraph of the input files description telling the model to load the columnar copies."""
+    if not copies:
+        return ""
+    lines = [
+        "",
+        "Columnar Parquet copies of the tabular input files are in the working directory as well. "
+        "They load much faster than the originals: ALWAYS READ THE DATA OF THESE FILES FROM THE COPIES "
+        "with pandas.read_parquet(path, memory_map=True):",
+    ]
+    lines += [f"- {copy}" for copy in copies]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,233 @@
+import logging
+import os
+import re
+import time
+import zipfile
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks output files are streamed with
+CHUNK_SIZE = 64 * 1024
+
+# Formats that are already compressed, deflating them again only costs CPU time
+STORED_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.zip', '.gz', '.bz2', '.xz', '.7z',
+    '.xlsx', '.docx', '.pptx', '.odt', '.ods',
+    '.mp3', '.mp4', '.mov', '.parquet',
+}
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class OutputFileResponse(FileResponse):
+    block_size = CHUNK_SIZE
+
+
+class OutputFile:
+    """Read-only view of a file for FileResponse, limited to a byte range and cleaning up when closed."""
+
+    def __init__(self, path, start=0, length=None, cleanup=None):
+        self.name = str(path)
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = length
+        self._cleanup = cleanup
+
+    def read(self, size=-1):
+        if self._remaining is None:
+            return self._file.read(size)
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        try:
+            self._file.close()
+        finally:
+            if self._cleanup is not None:
+                self._cleanup()
+                self._cleanup = None
+
+
+class _ZipBuffer:
+    """Write-only, unseekable sink that collects what zipfile writes until it is yielded."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStream:
+    """
+    Iterable producing a zip archive on the fly from (arcname, path) entries, without writing it to disk.
+    Since the sink is not seekable, zipfile writes data descriptors after each member.
+    """
+
+    def __init__(self, entries, cleanup=None):
+        self._cleanup = cleanup
+        self._files = len(entries)
+        self._buffer = None
+        self._started = None
+        self._generator = self._generate(entries)
+
+    def __iter__(self):
+        return self._generator
+
+    def _generate(self, entries):
+        self._started = time.perf_counter()
+        buffer = self._buffer = _ZipBuffer()
+        with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+            for arcname, path in entries:
+                if isinstance(path, bytes):
+                    archive.writestr(arcname, path, compress_type=zipfile.ZIP_DEFLATED)
+                    yield buffer.pop()
+                    continue
+
+                member = zipfile.ZipInfo.from_file(path, arcname)
+                member.compress_type = compression_for(path)
+                with open(path, 'rb') as source, archive.open(member, 'w') as target:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        target.write(chunk)
+                        data = buffer.pop()
+                        if data:
+                            yield data
+                yield buffer.pop()
+        # Central directory
+        yield buffer.pop()
+
+    def close(self):
+        try:
+            self._generator.close()
+            # The zip is streamed after the view returned, so it only shows up in the metrics
+            if self._started is not None:
+                metrics.record(
+                    'zip', time.perf_counter() - self._started, files=self._files, zip_bytes=self._buffer.tell()
+                )
+        finally:
+            if self._cleanup is not None:
+                self._cleanup()
+                self._cleanup = None
+
+
+def compression_for(path):
+    """Store already compressed formats as they are and deflate everything else."""
+    if path.suffix.lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def directory_entries(directory, prefix=''):
+    """List (arcname, path) entries of all files below a directory."""
+    return [
+        (prefix + path.relative_to(directory).as_posix(), path)
+        for path in sorted(directory.rglob('*'))
+        if path.is_file()
+    ]
+
+
+def parse_range(range_header, file_size):
+    """
+    Parse a single-range `Range` header into (start, length).
+    Returns None to serve the whole file and raises ValueError when the range is not satisfiable.
+    """
+    match = RANGE_PATTERN.match(range_header.strip()) if range_header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = min(int(last), file_size)
+        if length == 0:
+            raise ValueError("Empty suffix range.")
+        return file_size - length, length
+    start = int(first)
+    end = min(int(last), file_size - 1) if last else file_size - 1
+    if start >= file_size or end < start:
+        raise ValueError("Range not satisfiable.")
+    return start, end - start + 1
+
+
+def create_file_response(file_path, request=None, cleanup=None):
+    """Stream a single file, answering Range requests with 206 partial content."""
+    file_size = file_path.stat().st_size
+    range_header = request.META.get('HTTP_RANGE') if request is not None else None
+    try:
+        byte_range = parse_range(range_header, file_size)
+    except ValueError:
+        if cleanup is not None:
+            cleanup()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{file_size}'
+        return response
+
+    if byte_range is None:
+        response = OutputFileResponse(OutputFile(file_path, cleanup=cleanup), as_attachment=True,
+                                      filename=file_path.name, content_type='application/octet-stream')
+        response['Content-Length'] = file_size
+    else:
+        start, length = byte_range
+        response = OutputFileResponse(OutputFile(file_path, start, length, cleanup), as_attachment=True,
+                                      filename=file_path.name, content_type='application/octet-stream',
+                                      status=206)
+        response['Content-Length'] = length
+        response['Content-Range'] = f'bytes {start}-{start + length - 1}/{file_size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def create_zip_response(entries, zip_filename, cleanup=None):
+    """Stream a zip of (arcname, path or bytes) entries built while it is sent."""
+    logger.info(f"Streaming zip file of {len(entries)} files: {zip_filename}")
+    response = StreamingHttpResponse(ZipStream(entries, cleanup), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{zip_filename}"'
+    return response
+
+
+def create_download_response(output_directory, request=None, cleanup=None):
+    """
+    Return the single output file directly, or a zip of the output directory built while it is sent.
+    `cleanup` is called once the response has been sent, or right away if there is nothing to send.
+    """
+    # Get the list of files in the output directory
+    entries = directory_entries(output_directory)
+    output_size = sum(os.path.getsize(path) for _, path in entries)
+    metrics.OUTPUT_SIZE.observe(output_size)
+    metrics.add_to_span('output_bytes', output_size)
+
+    # Check if there is exactly one file in the directory
+    if len(entries) == 1:
+        # Return the single file directly
+        logger.info(f"Returning single file: {entries[0][0]}")
+        return create_file_response(entries[0][1], request, cleanup)
+    elif len(entries) > 1:
+        return create_zip_response(entries, "output.zip", cleanup)
+    else:
+        # Optionally handle the case where there are no files
+        logger.warning("No files found in the output directory.")
+        if cleanup is not None:
+            cleanup()
+        return HttpResponse("No files available for download.", status=404)
@@ -0,0 +1,189 @@
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import close_old_connections
+from django.utils import timezone
+
+from services import metrics
+from services.workspace import Workspace
+
+from .models import UploadProcess
+from .pipeline import ProgramPipeline, get_executor
+from .pipeline_store import save_pipeline_version
+from .previews import generate_input_files_description
+
+logger = logging.getLogger(__name__)
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+_last_cleanup = None
+_cleanup_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """Return the pool of background workers running the submitted jobs."""
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix='adp-job')
+        return _worker_pool
+
+
+def job_result_directory(process_id):
+    """Directory the outputs of a finished job are kept in."""
+    return Path(settings.MEDIA_ROOT) / 'jobs' / str(process_id) / 'output'
+
+
+def job_upload_directory(process_id):
+    """Directory the uploads of a job are stored in, see models.upload_path."""
+    return Path(settings.MEDIA_ROOT) / 'uploads' / str(process_id)
+
+
+def worker_id():
+    """The server process the background workers belong to, computed per process as workers may be forked."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def worker_alive(worker):
+    """Whether the server process that took a job still runs. Processes on other hosts are assumed to."""
+    host, _, pid = worker.rpartition(':')
+    if not pid.isdigit():
+        return False
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def submit_job(process):
+    """Queue a stored UploadProcess, created with the worker_id() of this process, for the background workers."""
+    logger.info(f"Submitting job {process.process_id}.")
+    get_worker_pool().submit(run_job, process.process_id)
+
+
+def fail_orphaned_jobs():
+    """
+    Mark the queued and running jobs of server processes that are gone as failed. Jobs live in
+    the in-process worker pool, so they were lost when their process stopped.
+    """
+    unfinished = UploadProcess.objects.filter(status__in=[UploadProcess.QUEUED, UploadProcess.RUNNING])
+    orphaned = [process.process_id for process in unfinished.only('process_id', 'worker')
+                if not worker_alive(process.worker)]
+    if orphaned:
+        UploadProcess.objects.filter(
+            process_id__in=orphaned, status__in=[UploadProcess.QUEUED, UploadProcess.RUNNING]
+        ).update(status=UploadProcess.FAILED, logs="The server stopped before the job finished.")
+        logger.warning(f"Marked {len(orphaned)} orphaned jobs as failed.")
+    return len(orphaned)
+
+
+def cleanup_expired_jobs():
+    """Remove the jobs that finished more than JOB_RETENTION seconds ago, with their uploads and outputs."""
+    if settings.JOB_RETENTION is None:
+        return 0
+    expired = UploadProcess.objects.filter(
+        status__in=[UploadProcess.SUCCEEDED, UploadProcess.FAILED],
+        updated_at__lt=timezone.now() - timedelta(seconds=settings.JOB_RETENTION),
+    )
+    process_ids = list(expired.values_list('process_id', flat=True))
+    for process_id in process_ids:
+        shutil.rmtree(job_result_directory(process_id).parent, ignore_errors=True)
+        shutil.rmtree(job_upload_directory(process_id), ignore_errors=True)
+    # The uploads' rows go with their process
+    UploadProcess.objects.filter(process_id__in=process_ids).delete()
+    if process_ids:
+        logger.info(f"Removed {len(process_ids)} expired jobs.")
+    return len(process_ids)
+
+
+def cleanup_jobs_periodically():
+    """Remove the expired jobs, at most once every JOB_CLEANUP_INTERVAL seconds per process."""
+    global _last_cleanup
+    with _cleanup_lock:
+        now = time.monotonic()
+        if _last_cleanup is not None and now - _last_cleanup < settings.JOB_CLEANUP_INTERVAL:
+            return
+        _last_cleanup = now
+    try:
+        cleanup_expired_jobs()
+    except Exception:
+        logger.exception("Failed to remove the expired jobs.")
+
+
+def recover_jobs(**kwargs):
+    """Receiver of the first request of a server process: fail the jobs lost in a restart and remove expired ones."""
+    request_started.disconnect(recover_jobs, dispatch_uid='run_pipeline.recover_jobs')
+    try:
+        fail_orphaned_jobs()
+    except Exception:
+        logger.exception("Failed to check for orphaned jobs.")
+    cleanup_jobs_periodically()
+
+
+def run_job(process_id):
+    """Generate and execute the program of a job and persist its state and outputs."""
+    close_old_connections()
+    try:
+        process = UploadProcess.objects.get(process_id=process_id)
+        process.status = UploadProcess.RUNNING
+        process.save(update_fields=['status', 'updated_at'])
+
+        with metrics.collect_timings() as timings:
+            success, logs = _execute_job(process)
+        logger.info(f"Job {process_id} timings: {metrics.server_timing(timings)}")
+
+        process.status = UploadProcess.SUCCEEDED if success else UploadProcess.FAILED
+        process.logs = logs
+        process.save(update_fields=['status', 'logs', 'pipeline_version', 'updated_at'])
+        logger.info(f"Job {process_id} finished with status: {process.status}")
+    except Exception as e:
+        logger.exception(f"Job {process_id} crashed.")
+        UploadProcess.objects.filter(process_id=process_id).update(status=UploadProcess.FAILED, logs=str(e))
+    finally:
+        cleanup_jobs_periodically()
+        close_old_connections()
+
+
+def _execute_job(process):
+    executor = get_executor()
+    with Workspace() as workspace:
+        temp_directory = workspace.directory
+
+        # Link the stored uploads into the job's workspace instead of copying them
+        uploaded_files = []
+        for upload in process.uploads.all():
+            workspace.add_input(upload.file.path, upload.original_name)
+            uploaded_files.append(upload.original_name)
+
+        input_files_description = generate_input_files_description(uploaded_files, temp_directory, 16)
+        if not input_files_description:
+            return False, "Failed to generate file descriptions."
+
+        success, logs = ProgramPipeline(executor).run(temp_directory, input_files_description, process.description)
+
+        if success:
+            # Keep the working code, so that the next run of the instruction can skip the LLM
+            code = (temp_directory / "main.py").read_text()
+            process.pipeline_version = save_pipeline_version(
+                process.description, input_files_description, code, uploaded_files
+            )
+
+            result_directory = job_result_directory(process.process_id)
+            result_directory.parent.mkdir(parents=True, exist_ok=True)
+            shutil.rmtree(result_directory, ignore_errors=True)
+            shutil.move(str(workspace.output_directory), str(result_directory))
+        return success, logs
@@ -0,0 +1,288 @@
+import json
+import logging
+import random
+import resource
+import string
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from services.stub_llm import StubLLMServer
+
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+DEFAULT_INSTRUCTION = "Summarize the input files."
+
+# Columns of the generated tabular inputs
+COLUMNS = ['id', 'name', 'category', 'amount', 'date']
+
+
+def parse_size(text):
+    """Bytes of a size like 512, 10KB or 1.5MB."""
+    text = text.strip().upper()
+    number = text.rstrip(string.ascii_uppercase)
+    unit = text[len(number):]
+    if unit not in SIZE_UNITS or not number:
+        raise CommandError(f"Invalid file size: {text}")
+    return int(float(number) * SIZE_UNITS[unit])
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the values."""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(fraction * len(values) + 0.5) - 1))]
+
+
+def generate_rows(rng):
+    for index in range(1, 2 ** 62):
+        yield [
+            index,
+            ''.join(rng.choices(string.ascii_lowercase, k=8)),
+            rng.choice(['a', 'b', 'c', 'd']),
+            round(rng.uniform(0, 10000), 2),
+            f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+        ]
+
+
+def generate_input(directory, file_type, size):
+    """Write an input file of the type with about `size` bytes and return its path."""
+    rng = random.Random(f'{file_type}-{size}')
+    path = Path(directory) / f'input-{size}.{file_type}'
+    rows = generate_rows(rng)
+    if file_type == 'csv':
+        with path.open('w') as f:
+            f.write(','.join(COLUMNS) + '\n')
+            while f.tell() < size:
+                f.write(','.join(str(value) for value in next(rows)) + '\n')
+    elif file_type == 'txt':
+        with path.open('w') as f:
+            while f.tell() < size:
+                words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(12)]
+                f.write(' '.join(words) + '.\n')
+    elif file_type == 'json':
+        # A record takes about 90 bytes
+        records = [dict(zip(COLUMNS, next(rows))) for _ in range(max(1, size // 90))]
+        path.write_text(json.dumps(records))
+    elif file_type == 'xlsx':
+        from openpyxl import Workbook
+
+        # Compressed, a row takes about 25 bytes
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('data')
+        sheet.append(COLUMNS)
+        for _ in range(max(1, size // 25)):
+            sheet.append(next(rows))
+        workbook.save(path)
+    else:
+        raise CommandError(f"Unsupported file type: {file_type}")
+    return path
+
+
+def load_workload(path):
+    """Requests of a JSON lines file with an `instruction` and optionally the canned `code` answering it."""
+    workload = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                workload.append({'instruction': item['instruction'], 'code': item.get('code')})
+    if not workload:
+        raise CommandError(f"The workload {path} has no requests.")
+    return workload
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a workload against the run-program endpoint with a stub LLM server and report latency "
+        "percentiles, throughput and the time and memory of the pipeline stages, by file type, file size "
+        "and concurrency. Run it in its own process, it swaps the LLM endpoints and the executor backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workload', help="JSON lines file of requests with an 'instruction' and optional 'code'.")
+        parser.add_argument('--file-types', default='csv,json,txt,xlsx', help="Comma-separated input file types.")
+        parser.add_argument('--file-sizes', default='10KB,1MB', help="Comma-separated input file sizes.")
+        parser.add_argument('--concurrency', default='1,4', help="Comma-separated numbers of concurrent clients.")
+        parser.add_argument('--requests', type=int, default=20, help="Requests per scenario.")
+        parser.add_argument('--llm-latency', type=float, default=0.5, help="Seconds the stub LLM takes to answer.")
+        parser.add_argument('--executor', default='services.local_executor.LocalExecutor',
+                            help="Executor backend running the generated code.")
+        parser.add_argument('--keep-caches', action='store_true',
+                            help="Keep the code and preview caches enabled.")
+        parser.add_argument('--save', help="Write the results as JSON to this file.")
+        parser.add_argument('--baseline', help="Fail if the p95 latency regressed against these saved results.")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Allowed relative p95 increase over the baseline.")
+
+    def handle(self, *args, **options):
+        workload = load_workload(options['workload']) if options['workload'] else [
+            {'instruction': DEFAULT_INSTRUCTION, 'code': None}
+        ]
+        file_types = [file_type.strip().lower() for file_type in options['file_types'].split(',') if file_type.strip()]
+        file_sizes = [parse_size(size) for size in options['file_sizes'].split(',') if size.strip()]
+        concurrency_levels = [int(level) for level in options['concurrency'].split(',') if level.strip()]
+
+        if options['verbosity'] < 2:
+            # The pipeline logs every stage of every request
+            logging.disable(logging.INFO)
+
+        responses = {item['instruction']: item['code'] for item in workload if item['code']}
+        overrides = {
+            'EXECUTOR_BACKEND': options['executor'],
+            'GROQ_API_KEY': 'stub',
+            'OPENAI_API_KEY': 'stub',
+            'ALLOWED_HOSTS': ['testserver'],
+            # The default message storage signs cookies, which needs a secret key
+            'MESSAGE_STORAGE': 'django.contrib.messages.storage.session.SessionStorage',
+        }
+        if not options['keep_caches']:
+            overrides.update(CODE_CACHE_MAX_ENTRIES=0, PREVIEW_CACHE_MAX_ENTRIES=0)
+
+        try:
+            settings.SECRET_KEY
+        except ImproperlyConfigured:
+            # Error pages need a secret key too. Django fails restoring an empty one after an override,
+            # so it is set for good, the command runs in its own process
+            settings.SECRET_KEY = 'benchmark'
+
+        # Saved pipelines and other records go to a throwaway test database
+        database_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = self.run_scenarios(
+                workload, file_types, file_sizes, concurrency_levels, responses, overrides, options
+            )
+        finally:
+            teardown_databases(database_config, verbosity=0)
+
+        if options['save']:
+            Path(options['save']).write_text(json.dumps({'scenarios': results}, indent=2))
+            self.stdout.write(f"Results saved to {options['save']}")
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def run_scenarios(self, workload, file_types, file_sizes, concurrency_levels, responses, overrides, options):
+        results = []
+        with StubLLMServer(responses, latency=options['llm_latency']) as stub, tempfile.TemporaryDirectory() as inputs:
+            with override_settings(GROQ_BASE_URL=stub.groq_base_url, OPENAI_BASE_URL=stub.openai_base_url, **overrides):
+                warmed_up = False
+                for file_type in file_types:
+                    for size in file_sizes:
+                        path = generate_input(inputs, file_type, size)
+                        if not warmed_up:
+                            # The first request starts the preview workers and the executor, it is not measured
+                            _, status, _, error = self.send(path, workload[0])
+                            if error:
+                                raise CommandError(f"The warm-up request failed with status {status}: {error}")
+                            warmed_up = True
+                        for concurrency in concurrency_levels:
+                            result = self.run_scenario(path, workload, options['requests'], concurrency)
+                            result.update(file_type=file_type, file_size=size, input_bytes=path.stat().st_size)
+                            results.append(result)
+                            self.report(result)
+        return results
+
+    def send(self, path, item):
+        """
+        Post the input file with the instruction and read the whole response; returns (latency, status, spans,
+        error), where error describes why the request failed and is None if it succeeded.
+        """
+        # A failing view answers 500 like a server would, instead of raising in the client
+        client = Client(raise_request_exception=False)
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            response = client.post('/api/run-program/', {'files': f, 'instruction': item['instruction']})
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        response.close()
+        latency = time.perf_counter() - start
+        error = None
+        if getattr(response, 'exc_info', None):
+            error = repr(response.exc_info[1])
+        elif not 200 <= response.status_code < 300:
+            error = response.content[:500].decode(errors='replace')
+        return latency, response.status_code, getattr(response, 'timings', []), error
+
+    def run_scenario(self, path, workload, requests, concurrency):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            responses = list(pool.map(
+                lambda index: self.send(path, workload[index % len(workload)]), range(requests)
+            ))
+        elapsed = time.perf_counter() - start
+
+        latencies = [latency for latency, _, _, error in responses if error is None]
+        errors = [f'{status} {error}' for _, status, _, error in responses if error is not None]
+        stages = {}
+        peak_memory = None
+        for latency, status, timings, error in responses:
+            if error is not None:
+                continue
+            for finished_span in timings:
+                stages[finished_span.stage] = stages.get(finished_span.stage, 0.0) + finished_span.duration
+                span_memory = finished_span.attributes.get('peak_memory')
+                if span_memory is not None:
+                    peak_memory = max(peak_memory or 0, span_memory)
+
+        return {
+            'concurrency': concurrency,
+            'requests': requests,
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'throughput': len(latencies) / elapsed,
+            # Mean milliseconds a successful request spent in each stage
+            'stages': {stage: total * 1000 / len(latencies) for stage, total in stages.items()},
+            'sandbox_peak_memory': peak_memory,
+            # Peak resident memory of this process, the server side of the benchmark
+            'server_peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+
+    def report(self, result):
+        def ms(seconds):
+            return f'{seconds * 1000:.0f}ms' if seconds is not None else '-'
+
+        self.stdout.write(
+            f"{result['file_type']:>5} {result['input_bytes']:>11,}B  c={result['concurrency']:<3} "
+            f"p50={ms(result['p50'])} p95={ms(result['p95'])} p99={ms(result['p99'])} "
+            f"{result['throughput']:.2f} req/s  errors={result['errors']}/{result['requests']}"
+        )
+        stages = ', '.join(f'{stage} {duration:.0f}ms' for stage, duration in sorted(result['stages'].items()))
+        memory = result['sandbox_peak_memory']
+        self.stdout.write(
+            f"      stages: {stages or '-'}; sandbox peak {memory // 1024 if memory else '-'} KiB, "
+            f"server peak {result['server_peak_rss'] // 1024 ** 2} MiB"
+        )
+        if result['first_error']:
+            self.stderr.write(f"      first error: {result['first_error']}")
+
+    def compare(self, results, baseline_path, tolerance):
+        """Raise a CommandError listing the scenarios whose p95 latency exceeds the baseline's by more than the tolerance."""
+        baseline = {
+            (scenario['file_type'], scenario['file_size'], scenario['concurrency']): scenario
+            for scenario in json.loads(Path(baseline_path).read_text())['scenarios']
+        }
+        regressions = []
+        for result in results:
+            previous = baseline.get((result['file_type'], result['file_size'], result['concurrency']))
+            if previous is None or previous['p95'] is None:
+                continue
+            if result['p95'] is None or result['p95'] > previous['p95'] * (1 + tolerance):
+                current = f"{result['p95'] * 1000:.0f}ms" if result['p95'] is not None else "all requests failed"
+                regressions.append(
+                    f"{result['file_type']} {result['file_size']}B c={result['concurrency']}: "
+                    f"p95 {previous['p95'] * 1000:.0f}ms -> {current}"
+                )
+        if regressions:
+            raise CommandError("p95 latency regressed:\n" + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"No p95 regression against {baseline_path}."))
@@ -0,0 +1,21 @@
+import time
+
+from services import metrics
+
+
+class TimingMiddleware:
+    """Collect the timing spans of a request and send their breakdown in a Server-Timing header."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with metrics.collect_timings() as timings:
+            response = self.get_response(request)
+        breakdown = metrics.server_timing(timings)
+        total = f'total;dur={(time.perf_counter() - start) * 1000:.1f}'
+        response['Server-Timing'] = f'{breakdown}, {total}' if breakdown else total
+        # The spans themselves, for callers in the same process like the benchmark command
+        response.timings = timings
+        return response
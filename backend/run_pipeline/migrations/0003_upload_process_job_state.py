@@ -0,0 +1,40 @@
+# Generated by Django 5.2.1 on 2026-10-17 19:53
+
+import django.utils.timezone
+import run_pipeline.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('run_pipeline', '0002_remove_fileupload_uploaded_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadprocess',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='uploadprocess',
+            name='logs',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='uploadprocess',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='uploadprocess',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='fileupload',
+            name='file',
+            field=models.FileField(upload_to=run_pipeline.models.upload_path),
+        ),
+    ]
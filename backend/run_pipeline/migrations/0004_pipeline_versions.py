@@ -0,0 +1,47 @@
+# Generated by Django 5.2.1 on 2026-10-17 20:24
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('run_pipeline', '0003_upload_process_job_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Pipeline',
+            fields=[
+                ('pipeline_id', models.AutoField(primary_key=True, serialize=False)),
+                ('instruction', models.TextField()),
+                ('instruction_key', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PipelineVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('code', models.TextField()),
+                ('schema_fingerprint', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('pipeline', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='run_pipeline.pipeline')),
+            ],
+            options={
+                'ordering': ['pipeline', '-version'],
+            },
+        ),
+        migrations.AddField(
+            model_name='uploadprocess',
+            name='pipeline_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='processes', to='run_pipeline.pipelineversion'),
+        ),
+        migrations.AddConstraint(
+            model_name='pipelineversion',
+            constraint=models.UniqueConstraint(fields=('pipeline', 'version'), name='unique_pipeline_version'),
+        ),
+    ]
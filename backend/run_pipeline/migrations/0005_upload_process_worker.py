@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 20:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('run_pipeline', '0004_pipeline_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadprocess',
+            name='worker',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 21:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('run_pipeline', '0005_upload_process_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelineversion',
+            name='input_names',
+            field=models.JSONField(default=list),
+        ),
+    ]
@@ -1,12 +1,76 @@
+import os
 from django.db import models
+from django.utils import timezone
 
 class UploadProcess(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
     process_id = models.AutoField(primary_key=True)  # Auto-incremented ID for each process
-    description = models.TextField()
+    description = models.TextField()  # Instruction describing the program to generate
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    logs = models.TextField(blank=True, default='')  # Execution logs of the last attempt
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+    worker = models.CharField(max_length=255, blank=True, default='')  # Server process running the job, host:pid
+    # Saved pipeline version holding the code that produced the outputs of a succeeded job
+    pipeline_version = models.ForeignKey('PipelineVersion', related_name='processes', null=True, blank=True,
+                                         on_delete=models.SET_NULL)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+def upload_path(instance, filename):
+    """Keep the uploads of each process in their own directory under their original name."""
+    return os.path.join('uploads', str(instance.process_id), filename)
 
 class FileUpload(models.Model):
-    file = models.FileField(upload_to='uploads/')
+    file = models.FileField(upload_to=upload_path)
     process = models.ForeignKey(UploadProcess, related_name='uploads', on_delete=models.CASCADE)
 
+    @property
+    def original_name(self):
+        return os.path.basename(self.file.name)
+
+    def __str__(self):
+        return self.file.name
+
+class Pipeline(models.Model):
+    """Working code generated for an instruction, kept in versions to run it on new inputs without the LLM."""
+    pipeline_id = models.AutoField(primary_key=True)
+    instruction = models.TextField()
+    instruction_key = models.CharField(max_length=64, unique=True)  # Hash of the normalized instruction
+    created_at = models.DateTimeField(default=timezone.now)
+
+    @property
+    def latest_version(self):
+        return self.versions.order_by('-version').first()
+
+    def __str__(self):
+        return f"Pipeline {self.pipeline_id}: {self.instruction[:50]}"
+
+class PipelineVersion(models.Model):
+    pipeline = models.ForeignKey(Pipeline, related_name='versions', on_delete=models.CASCADE)
+    version = models.PositiveIntegerField()
+    code = models.TextField()  # The main.py that ran successfully
+    schema_fingerprint = models.CharField(max_length=64)  # Structure of the inputs the code was generated for
+    input_names = models.JSONField(default=list)  # Names of the input files the code reads, in upload order
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['pipeline', '-version']
+        constraints = [
+            models.UniqueConstraint(fields=['pipeline', 'version'], name='unique_pipeline_version'),
+        ]
+
     def __str__(self):
-        return self.file.name
\ No newline at end of file
+        return f"Pipeline {self.pipeline_id} v{self.version}"
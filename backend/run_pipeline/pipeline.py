@@ -0,0 +1,281 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from services import metrics
+from services.code_cache import get_code_cache
+from services.code_utils import syntax_error
+from services.executor import ExecutionResult
+from services.groq_client import get_groq_client
+from services.openai_client import get_openai_client
+from services.preflight import preflight, required_packages
+from services.workspace import Workspace
+
+from .columnar import add_columnar_copies, columnar_note
+from .sampling import create_sample_workspace, sample_failure_logs
+
+logger = logging.getLogger(__name__)
+
+# LLM providers a speculative candidate can be generated with
+LLM_PROVIDERS = {
+    'groq': get_groq_client,
+    'openai': get_openai_client,
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return the process-wide executor of the EXECUTOR_BACKEND (PodmanExecutor by default),
+    building its images and container pools on first use.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            logger.info(f"Initializing {settings.EXECUTOR_BACKEND} for the first time.")
+            _executor = import_string(settings.EXECUTOR_BACKEND)()
+            # Build the image once and pre-start the container pool
+            _executor.warm_up()
+        return _executor
+
+
+def save_generated_code(generated_code, temp_directory):
+    """Save the generated code to a file in the temporary directory."""
+    code_file_path = temp_directory / "main.py"
+    with code_file_path.open('w') as f:
+        f.write(generated_code)
+    return code_file_path
+
+
+def input_file_names(temp_directory):
+    """Relative paths of the input files in the temporary directory."""
+    temp_directory = Path(temp_directory)
+    return [
+        path.relative_to(temp_directory).as_posix()
+        for path in temp_directory.rglob("*")
+        if path.is_file() and path.name != "main.py" and path.relative_to(temp_directory).parts[0] != "output"
+    ]
+
+
+def has_output(temp_directory):
+    """Whether the program wrote at least one file to the output directory."""
+    output_directory = Path(temp_directory) / "output"
+    return output_directory.is_dir() and any(output_directory.iterdir())
+
+
+class ProgramPipeline:
+    """Generate the program for an instruction, execute it and let the LLM fix it on failure."""
+
+    number_of_generation_retries = 2
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    def execute(self, generated_code, temp_directory, cancel_event=None, check=True):
+        """
+        Save the code and run it in the sandbox, unless it does not even compile or,
+        with `check`, the pre-flight check finds problems that would make it fail.
+        """
+        code_file_path = save_generated_code(generated_code, temp_directory)
+        logger.info(f"Generated code saved to: {code_file_path}")
+
+        # A syntax error goes straight back to the fixer without spending a container run
+        error = syntax_error(generated_code)
+        if error is not None:
+            logger.warning("The generated code does not compile, skipping its execution.")
+            return False, error
+
+        if settings.COLUMNAR_INPUTS and '.parquet' in generated_code:
+            # Code generated on large inputs reads their columnar copies, saved code run on smaller
+            # inputs needs them as well, so they are created regardless of the file size
+            add_columnar_copies(temp_directory, input_file_names(temp_directory), min_bytes=0)
+
+        requirements_path = settings.PODMAN_IMAGE_DIR / "requirements.txt"
+        if check and settings.PREFLIGHT_CHECKS:
+            with metrics.span('preflight'):
+                report = preflight(generated_code, input_file_names(temp_directory), requirements_path)
+            if not report.ok:
+                logger.warning(f"The generated code failed the pre-flight check, skipping its execution:\n{report}")
+                return False, str(report)
+
+        # Run in the lightest image providing the packages the code imports
+        packages = required_packages(generated_code, requirements_path)
+        return self.executor.execute_script(temp_directory, cancel_event, packages)
+
+    def execute_sample_first(self, generated_code, temp_directory, sample, cancel_event=None, check=True):
+        """
+        Execute the code on the sample workspace first (if any), and on the full inputs
+        only once it succeeded there. Returns the ExecutionResult, or (False, logs) if the
+        code was not executed.
+        """
+        if sample is not None:
+            result = self.execute(generated_code, sample.directory, cancel_event, check)
+            execution_successfull, logs = result
+            if not execution_successfull:
+                # Syntax errors and pre-flight problems do not depend on the inputs
+                if not isinstance(result, ExecutionResult):
+                    return result
+                return ExecutionResult(
+                    False, sample_failure_logs(logs), result.exit_reason, result.elapsed, result.peak_memory
+                )
+            logger.info("The code ran successfully on the input sample, running it on the full inputs.")
+            # The sample has the same file names, the pre-flight check passed already
+            check = False
+        return self.execute(generated_code, temp_directory, cancel_event, check)
+
+    def run(self, temp_directory, input_files_description, instruction):
+        """
+        Run the pipeline in the temporary directory and return the ExecutionResult of the last
+        execution, which unpacks to (success, logs), or (False, logs) if no code was executed.
+        """
+        # openai_client = get_openai_client()
+        # generated_code = openai_client.generate_python_code(input_files_description, instruction)
+
+        groq_client = get_groq_client()
+
+        if settings.COLUMNAR_INPUTS:
+            # Convert the tables once, so that every run and fix retry loads them from the columnar copies
+            copies = add_columnar_copies(temp_directory, input_file_names(temp_directory))
+            input_files_description += columnar_note(copies)
+
+        # Reuse code that already ran successfully for the same instruction and input structure
+        code_cache = get_code_cache()
+        cache_key = code_cache.key(instruction, input_files_description)
+        generated_code = code_cache.get(cache_key)
+        if generated_code is not None:
+            logger.info("Using cached code, skipping generation.")
+            result, generated_code = self.run_candidate(
+                temp_directory, input_files_description, instruction, groq_client, generated_code=generated_code
+            )
+        elif settings.SPECULATIVE_CANDIDATES:
+            result, generated_code = self.run_speculative(
+                temp_directory, input_files_description, instruction
+            )
+        else:
+            result, generated_code = self.run_candidate(
+                temp_directory, input_files_description, instruction, groq_client
+            )
+
+        execution_successfull, _ = result
+        if not execution_successfull:
+            logger.error("Execution of the Python script failed.")
+            code_cache.delete(cache_key)
+        else:
+            logger.info("Execution of the Python script successful.")
+            code_cache.set(cache_key, generated_code)
+        return result
+
+    def run_candidate(self, temp_directory, input_files_description, instruction, llm_client,
+                      temperature=None, generated_code=None, cancel_event=None):
+        """
+        Generate (unless given), execute and fix a program in the temporary directory.
+        With SAMPLE_FIRST, new code runs on truncated copies of large inputs first and only
+        reaches the full inputs once it succeeded there, so failures get back to the fixer quickly.
+        Returns (result of the last execution, code); stops early once the cancel_event is set.
+        """
+        sample = None
+        if settings.SAMPLE_FIRST:
+            sample = create_sample_workspace(temp_directory, input_file_names(temp_directory))
+        try:
+            # Cached code already ran successfully on inputs with the same structure
+            first_sample = sample if generated_code is None else None
+            if generated_code is None:
+                generated_code = llm_client.generate_python_code(input_files_description, instruction, temperature)
+
+            # Execute the generated Python script
+            logger.info("Executing the generated Python script.")
+            result = self.execute_sample_first(generated_code, temp_directory, first_sample, cancel_event)
+            execution_successfull, logs = result
+
+            for attempt in range(self.number_of_generation_retries):
+                if execution_successfull or (cancel_event is not None and cancel_event.is_set()):
+                    break
+                logger.warning(f"Execution of the generated code failed:\n{logs}")
+                generated_code = llm_client.fix_generated_code(generated_code, logs)
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                # The last attempt is executed on the full inputs regardless,
+                # the pre-flight check and the sample run are only heuristics
+                last_attempt = attempt == self.number_of_generation_retries - 1
+                result = self.execute_sample_first(
+                    generated_code, temp_directory, None if last_attempt else sample, cancel_event,
+                    check=not last_attempt,
+                )
+                execution_successfull, logs = result
+        finally:
+            if sample is not None:
+                sample.cleanup()
+        return result, generated_code
+
+    def create_candidate_workspace(self, temp_directory):
+        """Create a workspace with links to the input files of the temporary directory."""
+        workspace = Workspace()
+        for name in input_file_names(temp_directory):
+            (workspace.directory / name).parent.mkdir(parents=True, exist_ok=True)
+            workspace.add_input(temp_directory / name, name)
+        return workspace
+
+    def run_speculative(self, temp_directory, input_files_description, instruction):
+        """
+        Run the configured candidates in parallel, each in its own workspace, and keep the
+        first one that succeeds and writes output. The other candidates are cancelled.
+        Returns (result, code) like run_candidate, with the winner's main.py and output in temp_directory.
+        """
+        candidates = settings.SPECULATIVE_CANDIDATES
+        logger.info(f"Running {len(candidates)} candidates speculatively.")
+        cancel_event = threading.Event()
+        workspaces = {}
+        winner = None
+        result = ((False, "No candidate could be run."), None)
+
+        # Do not wait for cancelled candidates, they clean up after themselves once they stopped
+        pool = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix='adp-candidate')
+        try:
+            for candidate in candidates:
+                workspace = self.create_candidate_workspace(temp_directory)
+                # The candidates' spans belong to the request as well
+                future = pool.submit(
+                    metrics.propagate(self.run_candidate), workspace.directory, input_files_description, instruction,
+                    LLM_PROVIDERS[candidate.get('provider', 'groq')](),
+                    temperature=candidate.get('temperature'),
+                    cancel_event=cancel_event,
+                )
+                workspaces[future] = workspace
+
+            for future in as_completed(workspaces):
+                try:
+                    execution, generated_code = future.result()
+                except Exception as e:
+                    logger.warning(f"Candidate failed with an error: {e}")
+                    continue
+                success, logs = execution
+                if success and has_output(workspaces[future].directory):
+                    winner = future
+                    result = (execution, generated_code)
+                    cancel_event.set()
+                    break
+                if success:
+                    execution = (False, "The program ran successfully but did not write any file to the 'output/' directory.")
+                result = (execution, generated_code)
+        finally:
+            cancel_event.set()
+            pool.shutdown(wait=False)
+
+        if winner is not None:
+            workspace = workspaces[winner]
+            logger.info(f"Candidate in {workspace.directory.name} won the race.")
+            output_directory = temp_directory / "output"
+            output_directory.mkdir(exist_ok=True)
+            for entry in workspace.output_directory.iterdir():
+                os.replace(entry, output_directory / entry.name)
+            save_generated_code(result[1], temp_directory)
+
+        for future, workspace in workspaces.items():
+            future.add_done_callback(lambda _, workspace=workspace: workspace.cleanup())
+        return result
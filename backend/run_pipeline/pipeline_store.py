@@ -0,0 +1,88 @@
+import hashlib
+import logging
+import os
+from django.db import IntegrityError, transaction
+
+from services.code_cache import input_fingerprint, normalize_instruction
+
+from .models import Pipeline, PipelineVersion
+
+logger = logging.getLogger(__name__)
+
+
+def instruction_key(instruction):
+    """Pipelines are looked up by their instruction, ignoring case and whitespace differences."""
+    return hashlib.sha256(normalize_instruction(instruction).encode()).hexdigest()
+
+
+def save_pipeline_version(instruction, input_files_description, code, input_names):
+    """
+    Keep code that ran successfully on the input files of the given names as a version of the instruction's
+    pipeline. The same code for the same input structure is stored only once; returns the new or the
+    existing version.
+    """
+    fingerprint = input_fingerprint(input_files_description)
+    pipeline, _ = Pipeline.objects.get_or_create(
+        instruction_key=instruction_key(instruction), defaults={'instruction': instruction}
+    )
+    existing = pipeline.versions.filter(code=code, schema_fingerprint=fingerprint).first()
+    if existing is not None:
+        return existing
+
+    # Concurrent saves may race for the next version number
+    for _ in range(3):
+        latest = pipeline.latest_version
+        try:
+            with transaction.atomic():
+                version = PipelineVersion.objects.create(
+                    pipeline=pipeline,
+                    version=latest.version + 1 if latest else 1,
+                    code=code,
+                    schema_fingerprint=fingerprint,
+                    input_names=list(input_names),
+                )
+        except IntegrityError:
+            continue
+        logger.info(f"Saved version {version.version} of pipeline {pipeline.pipeline_id}.")
+        return version
+    logger.warning(f"Could not save a new version of pipeline {pipeline.pipeline_id}.")
+    return None
+
+
+def input_names_mismatch(version, names):
+    """
+    Why uploads of the given names cannot be linked onto the input names of a version in order, None if
+    they can. Versions saved before the input names were kept take any uploads.
+    """
+    if not version.input_names:
+        return None
+    if len(names) != len(version.input_names):
+        return (f"Version {version.version} reads {len(version.input_names)} input files "
+                f"({', '.join(version.input_names)}), {len(names)} were uploaded.")
+    for name, input_name in zip(names, version.input_names):
+        if os.path.splitext(name)[1].lower() != os.path.splitext(input_name)[1].lower():
+            return f"Version {version.version} reads {input_name} in place of {name}, a file of another type."
+    return None
+
+
+def select_version(pipeline, names, version=None):
+    """
+    The requested version of a pipeline, else its latest version the uploads of the given names can be
+    linked onto, else its latest version. None if the pipeline has no such version.
+    """
+    versions = pipeline.versions.order_by('-version')
+    if version is not None:
+        return versions.filter(version=version).first()
+    return next((candidate for candidate in versions if input_names_mismatch(candidate, names) is None),
+                versions.first())
+
+
+def matching_version(version, input_files_description):
+    """
+    The latest version of a pipeline generated for inputs with the structure of the description that
+    reads the same input names as the given version, else the given version.
+    """
+    matching = version.pipeline.versions.order_by('-version').filter(
+        schema_fingerprint=input_fingerprint(input_files_description)
+    )
+    return next((candidate for candidate in matching if candidate.input_names == version.input_names), version)
@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from django.conf import settings
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bump when the preview readers change, so that stale previews are not served anymore
+PREVIEW_FORMAT_VERSION = 3
+
+_preview_cache = None
+_preview_cache_lock = threading.Lock()
+
+
+def get_preview_cache():
+    """Return the process-wide preview cache."""
+    global _preview_cache
+    with _preview_cache_lock:
+        if _preview_cache is None:
+            _preview_cache = PreviewCache(settings.PREVIEW_CACHE_DIR, settings.PREVIEW_CACHE_MAX_ENTRIES)
+            metrics.register_cache('preview_cache', 'preview cache', _preview_cache.stats)
+        return _preview_cache
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PreviewCache:
+    """
+    Content-addressed store of extracted file previews, persisted on disk and bounded in LRU order.
+    Entries are keyed by the file's content hash, its extension and the size of the preview.
+    """
+
+    def __init__(self, directory, max_entries):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        if self.enabled:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._load_index()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _load_index(self):
+        """Rebuild the LRU order from the access times recorded in the files' mtimes."""
+        paths = [path for path in self.directory.glob('*/*.txt')]
+        paths.sort(key=lambda path: path.stat().st_mtime)
+        for path in paths:
+            self._entries[path.stem] = path
+        self._evict()
+
+    @staticmethod
+    def key(file_hash, file_extension, num_lines, max_chars):
+        extension = file_extension.lstrip('.') or 'none'
+        return f"{file_hash}-{extension}-{num_lines}-{max_chars}-v{PREVIEW_FORMAT_VERSION}"
+
+    def _path(self, key):
+        return self.directory / key[:2] / f"{key}.txt"
+
+    def get(self, key):
+        """Return the cached preview or None."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            preview = path.read_text(encoding='utf-8')
+            os.utime(path)  # Record the access for the LRU order of later processes
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                self._entries.pop(key, None)
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._entries[key] = path
+            self._entries.move_to_end(key)
+        return preview
+
+    def set(self, key, preview):
+        """Store a preview, evicting the least recently used entries beyond the size bound."""
+        if not self.enabled:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write atomically so that concurrent readers never see a partial preview
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=path.parent, delete=False) as f:
+            f.write(preview)
+        os.replace(f.name, path)
+
+        with self._lock:
+            self._entries[key] = path
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            _, path = self._entries.popitem(last=False)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
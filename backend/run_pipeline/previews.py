@@ -0,0 +1,590 @@
+import io
+import json
+import logging
+import multiprocessing
+import os
+import posixpath
+import signal
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+import pandas as pd
+from lxml import etree
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.cell import column_index_from_string, coordinate_from_string
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
+from PyPDF2 import PdfReader
+
+from services import metrics
+from services.prompt_builder import PromptBuilder
+
+from .preview_cache import file_digest, get_preview_cache
+
+logger = logging.getLogger(__name__)
+
+WORD_NAMESPACE = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+DRAWING_NAMESPACE = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+PRESENTATION_NAMESPACE = 'http://schemas.openxmlformats.org/presentationml/2006/main'
+RELATIONSHIP_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+# Bytes read from the start of a tabular file to infer its schema and sample rows
+SCHEMA_SAMPLE_BYTES = 256 * 1024
+
+# Sample rows shown below a schema
+SCHEMA_SAMPLE_ROWS = 5
+
+# Maps lower-case file extensions to preview readers, see register_reader
+PREVIEW_READERS = {}
+
+_preview_pool = None
+_preview_pool_lock = threading.Lock()
+
+
+def register_reader(*extensions):
+    """
+    Register a preview reader for file extensions. A reader is called with the open binary file,
+    the number of lines and the character budget of the preview, and returns the preview text.
+    Readers must be registered when this module is imported, so that the preview workers know them.
+    """
+    def decorator(reader):
+        for extension in extensions:
+            PREVIEW_READERS[extension] = reader
+        return reader
+    return decorator
+
+
+def generate_input_files_description(uploaded_files, temp_directory, num_lines):
+    """
+    Generate a description string of the uploaded files, including their first few lines.
+    This handles both file objects (like UploadedFile) and file paths (str).
+    Previews missing from the cache are extracted in parallel, each within a bounded time,
+    and truncated so that all of them fit into PROMPT_INPUT_TOKEN_BUDGET tokens.
+    """
+    with metrics.span('preview', files=len(uploaded_files)) as preview_span:
+        preview_cache = get_preview_cache()
+        previews = {}
+        pending = {}
+
+        for file in uploaded_files:
+            file_name = os.path.basename(file)
+            file_extension = os.path.splitext(file_name)[1].lower()
+            file_path = os.path.join(temp_directory, file_name)
+
+            try:
+                key = preview_cache.key(file_digest(file_path), file_extension, num_lines, settings.PREVIEW_MAX_CHARS)
+            except OSError as e:
+                logger.error(f"Error reading file {file_name}: {str(e)}")
+                continue
+
+            first_lines = preview_cache.get(key)
+            if first_lines is not None:
+                logger.info(f"Using cached preview of {file_name}")
+                previews[file_name] = first_lines
+            else:
+                pending[file_name] = (key, file_path, file_extension)
+
+        preview_span.attributes.update(cache_hits=len(previews), extracted=len(pending))
+        previews.update(extract_previews(pending, num_lines, preview_cache))
+
+    # Share the token budget of the prompt between the files
+    prompt_builder = PromptBuilder(
+        settings.PROMPT_INPUT_TOKEN_BUDGET, omitted_template='Further input files, not previewed: {names}\n\n'
+    )
+    for file in uploaded_files:
+        file_name = os.path.basename(file)
+        prompt_builder.add(file_name, previews.get(file_name, f"Error reading file {file_name}\n"))
+    description, _ = prompt_builder.build()
+    return description
+
+
+def extract_previews(pending, num_lines, preview_cache):
+    """
+    Extract the previews of {file_name: (cache key, path, extension)} in the preview process pool.
+    A file that fails or exceeds PREVIEW_FILE_TIMEOUT (measured in the worker from the start of the file)
+    gets a short placeholder instead of stalling the request, as do the files still unfinished when
+    the PREVIEW_TOTAL_TIMEOUT of the whole batch is over.
+    """
+    if not pending:
+        return {}
+
+    pool, futures = submit_previews(pending, num_lines)
+    deadline = time.monotonic() + settings.PREVIEW_TOTAL_TIMEOUT
+    previews = {}
+
+    for file_name, (key, file_path, file_extension) in pending.items():
+        try:
+            if futures is None:
+                first_lines = extract_preview(file_path, file_extension, num_lines, settings.PREVIEW_MAX_CHARS)
+            else:
+                first_lines = futures[file_name].result(timeout=max(deadline - time.monotonic(), 0))
+        except (FuturesTimeoutError, PreviewTimeout):
+            logger.error(f"Reading file {file_name} timed out.")
+            previews[file_name] = "Preview not available, reading the file took too long.\n"
+            continue
+        except BrokenProcessPool as e:
+            logger.error(f"The preview worker reading {file_name} died: {str(e)}")
+            discard_preview_pool(pool)
+            continue
+        except Exception as e:
+            logger.error(f"Error reading file {file_name}: {str(e)}")
+            continue
+
+        previews[file_name] = first_lines
+        preview_cache.set(key, first_lines)
+
+    if futures is not None:
+        # Files of this request still waiting for a worker are dropped. Running ones stop
+        # at their own PREVIEW_FILE_TIMEOUT, the pool is shared with other requests.
+        for future in futures.values():
+            future.cancel()
+    return previews
+
+
+def submit_previews(pending, num_lines):
+    """Submit the files to the preview pool, returns (pool, {file_name: future}) or (None, None) without a pool."""
+    for _ in range(2):
+        pool = get_preview_pool()
+        if pool is None:
+            return None, None
+        try:
+            futures = {}
+            for file_name, (_, file_path, file_extension) in pending.items():
+                futures[file_name] = pool.submit(
+                    extract_preview_in_worker, file_path, file_extension, num_lines, settings.PREVIEW_MAX_CHARS,
+                    settings.PREVIEW_FILE_TIMEOUT,
+                )
+            return pool, futures
+        except BrokenProcessPool:
+            # A worker died during an earlier request, start a new pool and submit again
+            for future in futures.values():
+                future.cancel()
+            discard_preview_pool(pool)
+    raise BrokenProcessPool("The preview workers could not be started.")
+
+
+def get_preview_pool():
+    """Return the process pool previews are extracted in, or None to extract them in the calling thread."""
+    global _preview_pool
+    if settings.PREVIEW_WORKERS <= 0:
+        return None
+    with _preview_pool_lock:
+        if _preview_pool is None:
+            # Spawn instead of fork, the request-handling process runs threads
+            _preview_pool = ProcessPoolExecutor(max_workers=settings.PREVIEW_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return _preview_pool
+
+
+def discard_preview_pool(pool):
+    """Drop a broken preview pool, a new one is started on the next request."""
+    global _preview_pool
+    with _preview_pool_lock:
+        if _preview_pool is not pool:
+            # Another request replaced it already
+            return
+        _preview_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+class PreviewTimeout(Exception):
+    """Extracting a preview took longer than PREVIEW_FILE_TIMEOUT."""
+
+
+def _raise_preview_timeout(signum, frame):
+    raise PreviewTimeout()
+
+
+def extract_preview_in_worker(file_path, file_extension, num_lines, max_chars, timeout):
+    """
+    extract_preview in a preview worker, interrupted by an alarm after `timeout` seconds, so that
+    a stuck file frees the worker for the next one without breaking the pool.
+    """
+    signal.signal(signal.SIGALRM, _raise_preview_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return extract_preview(file_path, file_extension, num_lines, max_chars)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def extract_preview(file_path, file_extension, num_lines, max_chars):
+    """Parse the start of the file and extract its preview with the reader registered for its extension."""
+    reader = PREVIEW_READERS.get(file_extension)
+    if reader is None:
+        return "Cannot read this file."
+    with open(file_path, 'rb') as file:
+        return reader(file, num_lines, max_chars)
+
+
+class PreviewBuffer:
+    """Collect preview lines until either `num_lines` lines or `max_chars` characters were collected."""
+
+    def __init__(self, num_lines, max_chars):
+        self.num_lines = num_lines
+        self.max_chars = max_chars
+        self.lines = []
+        self.chars = 0
+
+    @property
+    def full(self):
+        return len(self.lines) >= self.num_lines or self.chars >= self.max_chars
+
+    def add(self, line):
+        """Add a line, truncated to the remaining budget. Returns False once the preview is full."""
+        if self.full:
+            return False
+        line = line[:self.max_chars - self.chars]
+        self.lines.append(line)
+        self.chars += len(line) + 1
+        return not self.full
+
+    def text(self):
+        return '\n'.join(self.lines)
+
+
+@register_reader('.txt', '')  # Text file or unknown extension defaults to text
+def read_text_file(file, num_lines, max_chars):
+    """Read the first few lines of a text file, without reading past the character budget."""
+    preview = PreviewBuffer(num_lines, max_chars)
+    # Assuming file encoding is UTF-8, a multi-byte character cut at the budget is replaced
+    data = file.read(max_chars * 4).decode('utf-8', errors='replace')
+    for line in data.splitlines():
+        if not preview.add(line):
+            break
+    return preview.text() + '\n'
+
+
+def _free(element):
+    """Free an element parsed by iterparse and its preceding siblings to keep memory flat."""
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+def _iter_paragraphs(xml_file, paragraph_tag, text_tag):
+    """Yield the text of each paragraph of an Office XML part while it is being parsed."""
+    for _, element in etree.iterparse(xml_file, events=('end',), tag=paragraph_tag):
+        yield ''.join(node.text or '' for node in element.iter(text_tag))
+        _free(element)
+
+
+@register_reader('.docx')
+def read_word_file(file, num_lines, max_chars):
+    """Read the first few paragraphs of a Word (.docx) file, parsing document.xml only as far as needed."""
+    preview = PreviewBuffer(num_lines, max_chars)
+    with zipfile.ZipFile(file) as archive, archive.open('word/document.xml') as document:
+        for paragraph in _iter_paragraphs(document, f'{{{WORD_NAMESPACE}}}p', f'{{{WORD_NAMESPACE}}}t'):
+            if not preview.add(paragraph):
+                break
+    return preview.text()
+
+
+def _part_path(target, base='xl'):
+    """Part name of a relationship target, relative to the base folder unless it is absolute."""
+    return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join(base, target))
+
+
+def _xlsx_sheets(archive):
+    """(name, part name) of the sheets of a workbook in tab order, the index of the active sheet and the date epoch."""
+    relationships = etree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in relationships}
+    workbook = etree.fromstring(archive.read('xl/workbook.xml'))
+    sheets = []
+    for sheet in workbook.iterfind('.//{*}sheets/{*}sheet'):
+        relationship_id = next(value for name, value in sheet.attrib.items() if name.endswith('}id'))
+        sheets.append((sheet.get('name'), _part_path(targets[relationship_id])))
+    view = workbook.find('.//{*}bookViews/{*}workbookView')
+    active = int(view.get('activeTab', 0)) if view is not None else 0
+    properties = workbook.find('{*}workbookPr')
+    date1904 = properties is not None and properties.get('date1904') in ('1', 'true')
+    return sheets, min(active, len(sheets) - 1), CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+
+
+def _xlsx_date_styles(archive):
+    """Indexes of the cell styles with a date format, their numbers are shown as dates."""
+    if 'xl/styles.xml' not in archive.namelist():
+        return set()
+    styles = etree.fromstring(archive.read('xl/styles.xml'))
+    formats = dict(BUILTIN_FORMATS)
+    formats.update((int(fmt.get('numFmtId')), fmt.get('formatCode')) for fmt in styles.iterfind('{*}numFmts/{*}numFmt'))
+    return {
+        index for index, xf in enumerate(styles.iterfind('{*}cellXfs/{*}xf'))
+        if is_date_format(formats.get(int(xf.get('numFmtId', 0))))
+    }
+
+
+def _xlsx_rows(archive, part, max_rows):
+    """
+    Parse the dimension and the first rows of a worksheet part, stopping there. Rows are lists
+    of raw (type, value, style) cells by column, missing rows and cells are empty.
+    """
+    dimension = None
+    rows = []
+    with archive.open(part) as xml_file:
+        for _, element in etree.iterparse(xml_file, events=('end',), tag=('{*}dimension', '{*}row')):
+            if etree.QName(element).localname == 'dimension':
+                dimension = element.get('ref')
+                continue
+            row_number = int(element.get('r', len(rows) + 1))
+            while len(rows) < min(row_number - 1, max_rows):
+                rows.append([])
+            if row_number > max_rows:
+                break
+            row = []
+            for cell in element.iterfind('{*}c'):
+                reference = cell.get('r')
+                column = column_index_from_string(coordinate_from_string(reference)[0]) if reference else len(row) + 1
+                row.extend([None] * (column - len(row) - 1))
+                cell_type = cell.get('t', 'n')
+                if cell_type == 'inlineStr':
+                    value = ''.join(text.text or '' for text in cell.iter('{*}t'))
+                else:
+                    value = cell.findtext('{*}v')
+                row.append((cell_type, value, int(cell.get('s', 0))))
+            rows.append(row)
+            _free(element)
+    return dimension, rows
+
+
+def _xlsx_shared_strings(archive, indexes):
+    """The shared strings at the indexes, parsing the table only up to the last of them."""
+    if not indexes or 'xl/sharedStrings.xml' not in archive.namelist():
+        return {}
+    last = max(indexes)
+    strings = {}
+    with archive.open('xl/sharedStrings.xml') as xml_file:
+        for index, (_, element) in enumerate(etree.iterparse(xml_file, events=('end',), tag='{*}si')):
+            if index in indexes:
+                # Phonetic runs (rPh) are not part of the text
+                strings[index] = ''.join(
+                    text.text or '' for text in element.iter('{*}t')
+                    if etree.QName(text.getparent()).localname != 'rPh'
+                )
+            if index >= last:
+                break
+            _free(element)
+    return strings
+
+
+def _xlsx_value(cell, shared_strings, date_styles, epoch):
+    """Value of a raw cell like openpyxl reads it: numbers, dates, booleans or text."""
+    if cell is None:
+        return None
+    cell_type, value, style = cell
+    if value is None:
+        return None
+    if cell_type == 's':
+        return shared_strings.get(int(value))
+    if cell_type == 'b':
+        return value == '1'
+    if cell_type != 'n':
+        return value
+    try:
+        number = float(value) if any(c in value for c in '.eE') else int(value)
+    except ValueError:
+        return value
+    if style in date_styles:
+        try:
+            return from_excel(number, epoch)
+        except (ValueError, OverflowError):
+            pass
+    return number
+
+
+@register_reader('.xlsx')
+def read_excel_file(file, num_lines, max_chars):
+    """
+    List every sheet with its dimensions and header row, then read the first few rows of the active sheet.
+    The sheets are streamed from their XML and parsing stops after the rows that are needed, and only the
+    shared strings these rows reference are resolved, so the cost does not grow with the workbook's size.
+    """
+    with zipfile.ZipFile(file) as archive:
+        sheets, active, epoch = _xlsx_sheets(archive)
+        parsed = [
+            _xlsx_rows(archive, part, num_lines if index == active else 1)
+            for index, (_, part) in enumerate(sheets)
+        ]
+        indexes = {
+            int(cell[1]) for _, rows in parsed for row in rows for cell in row
+            if cell is not None and cell[0] == 's' and cell[1] is not None
+        }
+        shared_strings = _xlsx_shared_strings(archive, indexes)
+        date_styles = _xlsx_date_styles(archive)
+
+    def values(row, dimension):
+        # Rows are padded to the width of the sheet, like openpyxl does
+        width = column_index_from_string(coordinate_from_string(dimension.split(':')[-1])[0]) if dimension else 0
+        row = row + [None] * (width - len(row))
+        return [_xlsx_value(cell, shared_strings, date_styles, epoch) for cell in row]
+
+    preview = PreviewBuffer(num_lines + len(sheets) + 1, max_chars)
+    for (name, _), (dimension, rows) in zip(sheets, parsed):
+        header = values(rows[0], dimension) if rows else []
+        preview.add(f"Sheet '{name}' ({dimension or 'unknown'}), header: {header}")
+
+    if sheets:
+        name, _ = sheets[active]
+        dimension, rows = parsed[active]
+        preview.add(f"First rows of sheet '{name}':")
+        for row in rows:
+            if not preview.add(str(values(row, dimension))):
+                break
+    return preview.text()
+
+
+def _slide_paths(archive):
+    """Slide part names in presentation order."""
+    relationships = etree.fromstring(archive.read('ppt/_rels/presentation.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in relationships}
+    presentation = etree.fromstring(archive.read('ppt/presentation.xml'))
+    slide_ids = presentation.iterfind(f'.//{{{PRESENTATION_NAMESPACE}}}sldId')
+    return [
+        posixpath.normpath(posixpath.join('ppt', targets[slide_id.get(f'{{{RELATIONSHIP_NAMESPACE}}}id')]))
+        for slide_id in slide_ids
+    ]
+
+
+@register_reader('.pptx')
+def read_ppt_file(file, num_lines, max_chars):
+    """Read the first few slides of a PowerPoint (.pptx) file, parsing only the slides that are needed."""
+    preview = PreviewBuffer(max_chars, max_chars)
+    with zipfile.ZipFile(file) as archive:
+        for slide_path in _slide_paths(archive)[:num_lines]:  # Read up to the number of slides specified
+            with archive.open(slide_path) as slide:
+                for paragraph in _iter_paragraphs(slide, f'{{{DRAWING_NAMESPACE}}}p', f'{{{DRAWING_NAMESPACE}}}t'):
+                    if paragraph and not preview.add(paragraph):
+                        return preview.text() + '\n'
+    return preview.text() + '\n'
+
+
+@register_reader('.pdf')
+def read_pdf_file(file, num_lines, max_chars):
+    """
+    Read the first few pages of a PDF file. Pages are loaded lazily by index,
+    so only the cross-reference table and the extracted pages are parsed.
+    """
+    reader = PdfReader(file, strict=False)
+    preview = PreviewBuffer(max_chars, max_chars)
+    for i in range(min(len(reader.pages), num_lines)):  # Read up to the number of pages specified
+        for line in (reader.pages[i].extract_text() or '').splitlines():
+            if not preview.add(line):
+                return preview.text() + '\n'
+    return preview.text() + '\n'
+
+
+def _file_size(file):
+    return os.fstat(file.fileno()).st_size
+
+
+def _read_sample(file):
+    """Read the start of a line-oriented file, cut after its last complete line."""
+    sample = file.read(SCHEMA_SAMPLE_BYTES)
+    complete = len(sample) < SCHEMA_SAMPLE_BYTES
+    if not complete and b'\n' in sample:
+        sample = sample[:sample.rindex(b'\n') + 1]
+    return sample, complete
+
+
+def describe_table(preview, data_frame, row_count, exact):
+    """Add the columns with their inferred types, the row count and a few sample rows of a table."""
+    preview.add(f"Rows: {row_count}" if exact else f"Rows: ~{row_count} (estimated)")
+    preview.add(f"Columns ({len(data_frame.columns)}):")
+    for column, dtype in data_frame.dtypes.items():
+        preview.add(f"  {column}: {dtype}")
+    preview.add("Sample rows:")
+    for row in data_frame.head(SCHEMA_SAMPLE_ROWS).itertuples(index=False):
+        if not preview.add(f"  {list(row)}"):
+            break
+    return preview.text()
+
+
+def _estimate_rows(file, sample, sample_rows, complete):
+    """Exact row count if the whole file was sampled, else extrapolated from the sampled bytes per row."""
+    if complete or not sample_rows:
+        return sample_rows, True
+    return int(_file_size(file) * sample_rows / len(sample)), False
+
+
+def read_delimited_file(file, num_lines, max_chars, delimiter):
+    """Describe the schema of a delimited text file from a sample of its first rows."""
+    sample, complete = _read_sample(file)
+    data_frame = pd.read_csv(io.BytesIO(sample), sep=delimiter)
+    # The header line is not a data row, subtract its bytes
+    header_length = sample.find(b'\n') + 1
+    row_count, exact = _estimate_rows(file, sample[header_length:], len(data_frame), complete)
+
+    preview = PreviewBuffer(max_chars, max_chars)
+    preview.add(f"Delimiter: {delimiter!r}")
+    return describe_table(preview, data_frame, row_count, exact)
+
+
+@register_reader('.csv')
+def read_csv_file(file, num_lines, max_chars):
+    """Describe the schema of a CSV file."""
+    return read_delimited_file(file, num_lines, max_chars, ',')
+
+
+@register_reader('.tsv', '.tab')
+def read_tsv_file(file, num_lines, max_chars):
+    """Describe the schema of a TSV file."""
+    return read_delimited_file(file, num_lines, max_chars, '\t')
+
+
+@register_reader('.jsonl', '.ndjson')
+def read_json_lines_file(file, num_lines, max_chars):
+    """Describe the schema of a JSON Lines file from a sample of its first records."""
+    sample, complete = _read_sample(file)
+    data_frame = pd.read_json(io.BytesIO(sample), lines=True)
+    row_count, exact = _estimate_rows(file, sample, len(data_frame), complete)
+    return describe_table(PreviewBuffer(max_chars, max_chars), data_frame, row_count, exact)
+
+
+@register_reader('.json')
+def read_json_file(file, num_lines, max_chars):
+    """
+    Describe a JSON document: the schema of a list of records, or the keys of an object.
+    Documents too large to be sampled are previewed as text instead of being parsed.
+    """
+    sample = file.read(SCHEMA_SAMPLE_BYTES)
+    if len(sample) == SCHEMA_SAMPLE_BYTES:
+        preview = PreviewBuffer(num_lines, max_chars)
+        preview.add(f"Large JSON document ({_file_size(file)} bytes), beginning:")
+        preview.add(sample[:max_chars].decode('utf-8', errors='replace'))
+        return preview.text()
+
+    document = json.loads(sample)
+    preview = PreviewBuffer(max_chars, max_chars)
+    if isinstance(document, list) and document and all(isinstance(item, dict) for item in document):
+        preview.add("List of records")
+        return describe_table(preview, pd.json_normalize(document), len(document), True)
+    if isinstance(document, dict):
+        preview.add(f"Object with {len(document)} keys:")
+        for key, value in document.items():
+            if not preview.add(f"  {key}: {type(value).__name__} = {json.dumps(value, default=str)[:80]}"):
+                break
+        return preview.text()
+    preview.add(f"{type(document).__name__}: {json.dumps(document, default=str)[:max_chars]}")
+    return preview.text()
+
+
+@register_reader('.parquet')
+def read_parquet_file(file, num_lines, max_chars):
+    """Describe a Parquet file from its footer metadata and the first rows of its first row group."""
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(file)
+    metadata = parquet_file.metadata
+    preview = PreviewBuffer(max_chars, max_chars)
+    preview.add(f"Rows: {metadata.num_rows}, row groups: {metadata.num_row_groups}")
+    preview.add(f"Columns ({metadata.num_columns}):")
+    for field in parquet_file.schema_arrow:
+        preview.add(f"  {field.name}: {field.type}")
+    preview.add("Sample rows:")
+    batch = next(parquet_file.iter_batches(batch_size=SCHEMA_SAMPLE_ROWS), None)
+    for row in (batch.to_pylist() if batch is not None else []):
+        if not preview.add(f"  {list(row.values())}"):
+            break
+    return preview.text()
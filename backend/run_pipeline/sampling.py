@@ -0,0 +1,128 @@
+import csv
+import logging
+from django.conf import settings
+from openpyxl import Workbook, load_workbook
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PyPDF2 import PdfReader, PdfWriter
+
+from services import metrics
+from services.workspace import Workspace
+
+logger = logging.getLogger(__name__)
+
+# Maps lower-case file extensions to samplers, see register_sampler
+SAMPLERS = {}
+
+
+def register_sampler(*extensions):
+    """
+    Register a sampler for file extensions. A sampler is called with the path of an input file and the
+    path its sample is written to, and writes the same kind of file with only the start of the content.
+    """
+    def decorator(sampler):
+        for extension in extensions:
+            SAMPLERS[extension] = sampler
+        return sampler
+    return decorator
+
+
+@register_sampler('.csv', '.tsv')
+def sample_delimited_file(source, destination):
+    """
+    The header and the first SAMPLE_ROWS records. Quoted fields may span lines, so the file is cut
+    at the end of a record as the csv module reads it, not after a number of lines.
+    """
+    delimiter = '\t' if source.suffix.lower() == '.tsv' else ','
+    with source.open('rb') as source_file, destination.open('wb') as destination_file:
+        def lines():
+            # The reader pulls only the lines of the records it returns, they are copied as they are.
+            # Latin-1 maps each byte to one character, which keeps the quotes and line ends of UTF-8 text.
+            for line in source_file:
+                destination_file.write(line)
+                yield line.decode('latin-1')
+
+        for i, _ in enumerate(csv.reader(lines(), delimiter=delimiter)):
+            if i >= settings.SAMPLE_ROWS:
+                break
+
+
+@register_sampler('.xlsx')
+def sample_excel_file(source, destination):
+    """The first SAMPLE_ROWS + 1 rows of every sheet, as values without formatting."""
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    sample = Workbook(write_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            sample_sheet = sample.create_sheet(sheet.title)
+            for row in sheet.iter_rows(max_row=settings.SAMPLE_ROWS + 1, values_only=True):
+                sample_sheet.append(row)
+        sample.save(destination)
+    finally:
+        workbook.close()
+
+
+@register_sampler('.parquet')
+def sample_parquet_file(source, destination):
+    """The first SAMPLE_ROWS rows, the columnar copies of large tables are sampled as well."""
+    parquet_file = pq.ParquetFile(source)
+    batch = next(parquet_file.iter_batches(batch_size=settings.SAMPLE_ROWS), None)
+    if batch is None:
+        table = parquet_file.schema_arrow.empty_table()
+    else:
+        table = pa.Table.from_batches([batch])
+    pq.write_table(table, destination)
+
+
+@register_sampler('.pdf')
+def sample_pdf_file(source, destination):
+    """The first SAMPLE_PDF_PAGES pages."""
+    reader = PdfReader(source, strict=False)
+    writer = PdfWriter()
+    for i in range(min(len(reader.pages), settings.SAMPLE_PDF_PAGES)):
+        writer.add_page(reader.pages[i])
+    with destination.open('wb') as f:
+        writer.write(f)
+
+
+def create_sample_workspace(temp_directory, file_names):
+    """
+    Create a workspace holding truncated copies of the input files under the same names, files without
+    a sampler are linked as they are. Returns None if the inputs are smaller than SAMPLE_MIN_BYTES or
+    none of them could be sampled, running the code on the full inputs is then about as fast.
+    """
+    paths = {name: temp_directory / name for name in file_names}
+    if sum(path.stat().st_size for path in paths.values()) < settings.SAMPLE_MIN_BYTES:
+        return None
+
+    workspace = Workspace()
+    sampled = 0
+    with metrics.span('sample', files=len(paths)):
+        for name, path in paths.items():
+            destination = workspace.directory / name
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            sampler = SAMPLERS.get(path.suffix.lower())
+            if sampler is not None:
+                try:
+                    sampler(path, destination)
+                    sampled += 1
+                    continue
+                except Exception as e:
+                    logger.warning(f"Could not sample {name}, the sample run uses the whole file: {e}")
+                    destination.unlink(missing_ok=True)
+            workspace.add_input(path, name)
+
+    if not sampled:
+        workspace.cleanup()
+        return None
+    logger.info(f"Sampled {sampled} of {len(paths)} input files in {workspace.directory.name}.")
+    return workspace
+
+
+def sample_failure_logs(logs):
+    """Logs of a failed sample run, telling the fixer what the program ran on."""
+    return (
+        f"The program failed on a sample of the input files: the same files, truncated to their first "
+        f"{settings.SAMPLE_ROWS} rows (tables) or {settings.SAMPLE_PDF_PAGES} pages (PDFs). The full files "
+        f"have more rows and pages, so do not rely on their number.\n{logs}"
+    )
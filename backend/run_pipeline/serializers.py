@@ -1,5 +1,6 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import FileUpload, UploadProcess
+from .models import FileUpload, Pipeline, PipelineVersion, UploadProcess
 
 class FileUploadSerializer(serializers.ModelSerializer):
     class Meta:
@@ -7,6 +8,59 @@ class FileUploadSerializer(serializers.ModelSerializer):
         fields = ['file']
 
 class UploadProcessSerializer(serializers.ModelSerializer):
+    status_url = serializers.SerializerMethodField()
+    result_url = serializers.SerializerMethodField()
+    pipeline = serializers.SerializerMethodField()
+
     class Meta:
         model = UploadProcess
-        fields = ['process_id', 'description']
+        fields = ['process_id', 'description', 'status', 'logs', 'created_at', 'updated_at', 'status_url', 'result_url',
+                  'pipeline']
+
+    def _absolute_url(self, name, process):
+        url = reverse(name, args=[process.process_id])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def get_status_url(self, process):
+        return self._absolute_url('job-status', process)
+
+    def get_result_url(self, process):
+        if process.status != UploadProcess.SUCCEEDED:
+            return None
+        return self._absolute_url('job-result', process)
+
+    def get_pipeline(self, process):
+        """The saved pipeline version holding the code of a succeeded job."""
+        version = process.pipeline_version
+        if version is None:
+            return None
+        return {'pipeline_id': version.pipeline_id, 'version': version.version}
+
+class PipelineVersionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PipelineVersion
+        fields = ['version', 'code', 'schema_fingerprint', 'input_names', 'created_at']
+
+class PipelineSerializer(serializers.ModelSerializer):
+    latest_version = serializers.SerializerMethodField()
+    run_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Pipeline
+        fields = ['pipeline_id', 'instruction', 'created_at', 'latest_version', 'run_url']
+
+    def get_latest_version(self, pipeline):
+        latest = pipeline.latest_version
+        return latest.version if latest else None
+
+    def get_run_url(self, pipeline):
+        url = reverse('pipeline-run', args=[pipeline.pipeline_id])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+class PipelineDetailSerializer(PipelineSerializer):
+    versions = PipelineVersionSerializer(many=True, read_only=True)
+
+    class Meta(PipelineSerializer.Meta):
+        fields = PipelineSerializer.Meta.fields + ['versions']
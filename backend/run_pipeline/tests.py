@@ -1,3 +1,1323 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import signal
+import socket
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+
+import pandas as pd
+from docx import Document
+from openpyxl import Workbook
+from pptx import Presentation
+from services import groq_client, metrics
+from services.code_cache import CodeCache, input_fingerprint
+from services.code_utils import CodeStreamCollector, extract_code, syntax_error
+from services.executor import (
+    EXIT_CANCELLED,
+    EXIT_ERROR,
+    EXIT_MEMORY_LIMIT,
+    EXIT_SUCCESS,
+    EXIT_TIMEOUT,
+    ExecutionResult,
+    ExecutionScheduler,
+    job_result,
+    split_peak_memory,
+)
+from services.llm_retry import RetryPolicy, parse_duration, server_requested_delay
+from services.local_executor import LocalExecutor
+from services.podman_executor import PodmanExecutor
+from services.preflight import preflight, required_packages
+from services.prompt_builder import PromptBuilder, estimate_tokens
+from services.stub_llm import StubLLMServer
+from services.worker_pool_executor import WorkerPoolExecutor, memory_bytes
+from services.workspace import Workspace
+
+from . import pipeline
+from .batch import collect_groups, input_names
+from .columnar import ColumnarCache, add_columnar_copies, columnar_note
+from .downloads import ZipStream, create_file_response, parse_range
+from .jobs import (
+    cleanup_expired_jobs,
+    fail_orphaned_jobs,
+    job_result_directory,
+    job_upload_directory,
+    run_job,
+    worker_id,
+)
+from .models import UploadProcess
+from .pipeline import ProgramPipeline
+from .pipeline_store import matching_version, save_pipeline_version, select_version
+from .preview_cache import PreviewCache, file_digest
+from .previews import (
+    PREVIEW_READERS,
+    PreviewTimeout,
+    discard_preview_pool,
+    extract_preview,
+    extract_preview_in_worker,
+    generate_input_files_description,
+    get_preview_pool,
+    read_excel_file,
+    read_ppt_file,
+    read_text_file,
+    read_word_file,
+    register_reader,
+)
+from .sampling import create_sample_workspace, sample_delimited_file
+from .uploads import SizeLimitUploadHandler
+from .views import RunProgramView
+
+
+def wait_for(condition, timeout=5):
+    """Poll until the condition holds, failing after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Condition not reached in time.")
+        time.sleep(0.01)
+
+
+class ExecutionSchedulerTests(SimpleTestCase):
+    def test_jobs_are_admitted_in_fifo_order(self):
+        scheduler = ExecutionScheduler(max_concurrency=2)
+        admitted = []
+        releases = [threading.Event() for _ in range(5)]
+
+        def job(number):
+            with scheduler.slot():
+                admitted.append(number)
+                releases[number].wait(5)
+
+        threads = [threading.Thread(target=job, args=(number,)) for number in range(5)]
+        for number, thread in enumerate(threads):
+            thread.start()
+            # Enqueue the jobs one after the other
+            wait_for(lambda: scheduler.stats()["running"] + scheduler.stats()["queue_depth"] == number + 1)
+        self.assertEqual(admitted, [0, 1])
+        self.assertEqual(scheduler.stats()["queue_depth"], 3)
+
+        # Every finished job hands its slot to the oldest waiting one
+        for number in range(3):
+            releases[number].set()
+            wait_for(lambda: len(admitted) == number + 3)
+            self.assertEqual(admitted[-1], number + 2)
+        for release in releases:
+            release.set()
+        for thread in threads:
+            thread.join(5)
+        stats = scheduler.stats()
+        self.assertEqual((stats["running"], stats["queue_depth"], stats["admitted"]), (0, 0, 5))
+        self.assertGreater(stats["max_wait_time"], 0)
+
+
+# The cookie message storage needs the SECRET_KEY, which is only set in deployments
+API_TEST_SETTINGS = {
+    'ALLOWED_HOSTS': ['testserver'],
+    'MESSAGE_STORAGE': 'django.contrib.messages.storage.session.SessionStorage',
+}
+
+
+def temporary_directory(test):
+    """A temporary directory removed after the test."""
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    return Path(directory.name)
+
+
+def apply_patch(test, patcher):
+    """Start a mock patcher or settings override for the rest of the test."""
+    if isinstance(patcher, override_settings):
+        patcher.enable()
+        test.addCleanup(patcher.disable)
+        return None
+    patched = patcher.start()
+    test.addCleanup(patcher.stop)
+    return patched
+
+
+def response_bytes(response):
+    """Body of a plain or streaming response."""
+    if response.streaming:
+        body = b''.join(response.streaming_content)
+        response.close()
+        return body
+    return response.content
+
+
+def fake_run(temp_directory, input_files_description, instruction):
+    """ProgramPipeline.run writing the instruction to output/result.txt."""
+    (Path(temp_directory) / 'main.py').write_text(f'print({instruction!r})\n')
+    (Path(temp_directory) / 'output' / 'result.txt').write_text(instruction)
+    return True, 'Done.'
+
+
+@override_settings(**API_TEST_SETTINGS)
+class JobApiTests(TestCase):
+    def setUp(self):
+        media_root = temporary_directory(self)
+        apply_patch(self, override_settings(
+            MEDIA_ROOT=media_root, PODMAN_WORKSPACE_ROOT=media_root, PODMAN_OUTPUTS_ROOT=media_root / 'outputs'
+        ))
+        self.submit_job = apply_patch(self, mock.patch('run_pipeline.views.submit_job'))
+
+    def submit(self):
+        response = self.client.post('/api/jobs/', {
+            'instruction': 'Sum the amounts',
+            'files': SimpleUploadedFile('sales.csv', b'date,amount\n2024-01-01,1.5\n'),
+        })
+        self.assertEqual(response.status_code, 202)
+        return response
+
+    def test_submit_and_poll(self):
+        response = self.submit()
+        process_id = response.json()['process_id']
+        self.assertEqual(response['Location'], f'/api/jobs/{process_id}/')
+        self.submit_job.assert_called_once()
+
+        response = self.client.get(f'/api/jobs/{process_id}/')
+        self.assertEqual(response.json()['status'], UploadProcess.QUEUED)
+        self.assertEqual(self.client.get(f'/api/jobs/{process_id}/result/').status_code, 409)
+        self.assertEqual(self.client.get('/api/jobs/999/').status_code, 404)
+
+    def test_missing_fields(self):
+        self.assertEqual(self.client.post('/api/jobs/', {'instruction': 'Sum the amounts'}).status_code, 400)
+        response = self.client.post('/api/jobs/', {'files': SimpleUploadedFile('a.csv', b'a\n1\n')})
+        self.assertEqual(response.status_code, 400)
+
+    def test_run_job(self):
+        process_id = self.submit().json()['process_id']
+        with mock.patch('run_pipeline.jobs.get_executor'), \
+                mock.patch('run_pipeline.jobs.ProgramPipeline') as pipeline:
+            pipeline.return_value.run.side_effect = fake_run
+            run_job(process_id)
+
+        self.assertEqual(UploadProcess.objects.get(process_id=process_id).status, UploadProcess.SUCCEEDED)
+        response = self.client.get(f'/api/jobs/{process_id}/result/')
+        self.assertEqual(response.status_code, 200)
+        # A single output file is sent as it is
+        self.assertEqual(response_bytes(response), b'Sum the amounts')
+
+        # The code that ran is saved as the first version of the instruction's pipeline
+        process = UploadProcess.objects.get(process_id=process_id)
+        self.assertEqual(process.pipeline_version.code, "print('Sum the amounts')\n")
+        self.assertEqual(process.pipeline_version.version, 1)
+
+    def test_failed_job(self):
+        process_id = self.submit().json()['process_id']
+        with mock.patch('run_pipeline.jobs.get_executor'), \
+                mock.patch('run_pipeline.jobs.ProgramPipeline') as pipeline:
+            pipeline.return_value.run.return_value = (False, 'Traceback: boom')
+            run_job(process_id)
+
+        response = self.client.get(f'/api/jobs/{process_id}/result/')
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json()['logs'], 'Traceback: boom')
+
+
+@override_settings(MAX_UPLOAD_FILE_SIZE=10, MAX_UPLOAD_REQUEST_SIZE=15, **API_TEST_SETTINGS)
+class SizeLimitUploadHandlerTests(TestCase):
+    def test_file_size_limit(self):
+        request = mock.Mock(spec=['upload_limit_error'])
+        handler = SizeLimitUploadHandler(request)
+        handler.new_file('files', 'big.csv', 'text/csv', 20)
+        self.assertEqual(handler.receive_data_chunk(b'12345', 0), b'12345')
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b'123456', 5)
+        self.assertIn('big.csv exceeds the maximum size of 10 bytes', request.upload_limit_error)
+
+    def test_request_size_limit(self):
+        request = mock.Mock(spec=['upload_limit_error'])
+        handler = SizeLimitUploadHandler(request)
+        handler.new_file('files', 'a.csv', 'text/csv', 8)
+        handler.receive_data_chunk(b'12345678', 0)
+        handler.new_file('files', 'b.csv', 'text/csv', 8)
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b'12345678', 0)
+        self.assertIn('maximum total size of 15 bytes', request.upload_limit_error)
+
+    def test_view_answers_413(self):
+        response = self.client.post('/api/jobs/', {
+            'instruction': 'Sum the amounts',
+            'files': SimpleUploadedFile('big.csv', b'a,b\n' * 10),
+        })
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('big.csv', response.json()['error'])
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_no_or_unsupported_header_serves_whole_file(self):
+        for header in (None, '', 'bytes=-', 'bytes=0-1,5-6', 'items=0-1'):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header, 100))
+
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 10))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 10))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 10))
+        # The end and suffix length are clamped to the file
+        self.assertEqual(parse_range('bytes=50-500', 100), (50, 50))
+        self.assertEqual(parse_range('bytes=-500', 100), (0, 100))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=100-', 'bytes=10-5', 'bytes=-0'):
+            with self.subTest(header=header), self.assertRaises(ValueError):
+                parse_range(header, 100)
+
+
+class DownloadTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+
+    def test_range_request(self):
+        path = self.directory / 'report.csv'
+        path.write_bytes(bytes(range(100)))
+        cleanup = mock.Mock()
+
+        response = create_file_response(path, RequestFactory().get('/', HTTP_RANGE='bytes=10-19'), cleanup)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(response_bytes(response), bytes(range(10, 20)))
+        cleanup.assert_called_once()
+
+        response = create_file_response(path, RequestFactory().get('/', HTTP_RANGE='bytes=100-'))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_zip_stream(self):
+        text_path = self.directory / 'report.csv'
+        text_path.write_text('a,b\n' * 50000)
+        image_path = self.directory / 'chart.png'
+        image_path.write_bytes(bytes(range(256)) * 10)
+        cleanup = mock.Mock()
+
+        stream = ZipStream([
+            ('output/report.csv', text_path), ('output/chart.png', image_path), ('main.py', b'print(1)\n'),
+        ], cleanup=cleanup)
+        data = b''.join(stream)
+        stream.close()
+
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('output/report.csv'), text_path.read_bytes())
+            self.assertEqual(archive.read('output/chart.png'), image_path.read_bytes())
+            self.assertEqual(archive.read('main.py'), b'print(1)\n')
+            # Already compressed formats are stored as they are
+            self.assertEqual(archive.getinfo('output/report.csv').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.getinfo('output/chart.png').compress_type, zipfile.ZIP_STORED)
+        cleanup.assert_called_once()
+
+    def test_zip_stream_closed_before_streaming_cleans_up(self):
+        cleanup = mock.Mock()
+        ZipStream([('main.py', b'')], cleanup=cleanup).close()
+        cleanup.assert_called_once()
+
+
+class PreviewCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+
+    def test_lru_eviction_and_persistence(self):
+        cache = PreviewCache(self.directory / 'previews', max_entries=2)
+        cache.set('a', 'preview a')
+        cache.set('b', 'preview b')
+        self.assertEqual(cache.get('a'), 'preview a')
+        cache.set('c', 'preview c')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Another process finds the same entries on disk
+        cache = PreviewCache(self.directory / 'previews', max_entries=2)
+        self.assertEqual(cache.get('a'), 'preview a')
+        self.assertEqual(cache.get('c'), 'preview c')
+
+    def test_disabled(self):
+        cache = PreviewCache(self.directory / 'previews', max_entries=0)
+        cache.set('a', 'preview a')
+        self.assertIsNone(cache.get('a'))
+        self.assertFalse((self.directory / 'previews').exists())
+
+    def test_key_by_content(self):
+        first, second = self.directory / 'first.csv', self.directory / 'second.csv'
+        first.write_text('a,b\n1,2\n')
+        second.write_text('a,b\n1,2\n')
+        self.assertEqual(file_digest(first), file_digest(second))
+        second.write_text('a,b\n1,3\n')
+        self.assertNotEqual(file_digest(first), file_digest(second))
+
+
+class InputFilesDescriptionTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+        apply_patch(self, mock.patch(
+            'run_pipeline.previews.get_preview_cache', return_value=PreviewCache(self.directory / 'cache', 0)
+        ))
+        (self.directory / 'notes.txt').write_text('first line\nsecond line\n')
+        (self.directory / 'broken.docx').write_bytes(b'not a zip archive')
+
+    def describe(self):
+        return generate_input_files_description(['notes.txt', 'broken.docx'], self.directory, 16)
+
+    def assert_description(self, description):
+        self.assertIn('notes.txt:\n"""\nfirst line\nsecond line\n', description)
+        # A file that cannot be read does not fail the others
+        self.assertIn('broken.docx', description)
+
+    @override_settings(PREVIEW_WORKERS=0)
+    def test_in_request_thread(self):
+        self.assert_description(self.describe())
+
+    @override_settings(PREVIEW_WORKERS=1)
+    def test_in_worker_processes(self):
+        self.addCleanup(discard_preview_pool, get_preview_pool())
+        self.assert_description(self.describe())
+
+
+def write_workbook(path, sheets):
+    """Save an xlsx workbook of {sheet title: rows}, the first sheet is the active one."""
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for title, rows in sheets.items():
+        sheet = workbook.create_sheet(title)
+        for row in rows:
+            sheet.append(row)
+    workbook.save(path)
+
+
+class DocumentPreviewTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+
+    def test_text_file_reads_only_the_budget(self):
+        file = io.BytesIO(b'line\n' * 1000000)
+        self.assertEqual(read_text_file(file, 3, 100), 'line\nline\nline\n')
+        self.assertEqual(len(read_text_file(io.BytesIO(b'x' * 10000), 3, 100)), 101)
+        self.assertLessEqual(file.tell(), 400)
+
+    def test_word_file(self):
+        document = Document()
+        for i in range(100):
+            document.add_paragraph(f'Paragraph {i}')
+        document.save(self.directory / 'report.docx')
+        with open(self.directory / 'report.docx', 'rb') as file:
+            self.assertEqual(read_word_file(file, 3, 1000), 'Paragraph 0\nParagraph 1\nParagraph 2')
+
+    def test_excel_file(self):
+        write_workbook(self.directory / 'sales.xlsx', {
+            'Sales': [['date', 'amount']] + [[f'2024-01-{day:02}', day * 1.5 + 0.25] for day in range(1, 31)],
+            'Notes': [['note'], ['checked']],
+        })
+        with open(self.directory / 'sales.xlsx', 'rb') as file:
+            preview = read_excel_file(file, 3, 1000)
+        self.assertEqual(preview.splitlines(), [
+            "Sheet 'Sales' (A1:B31), header: ['date', 'amount']",
+            "Sheet 'Notes' (A1:A2), header: ['note']",
+            "First rows of sheet 'Sales':",
+            "['date', 'amount']",
+            "['2024-01-01', 1.75]",
+            "['2024-01-02', 3.25]",
+        ])
+
+    def test_excel_cell_types(self):
+        rows = [['when', 'flag', 'name', 'n'], [datetime.datetime(2024, 1, 1), True, 'alpha', 1]]
+        rows.append([datetime.date(2024, 2, 3), False, 'beta', 2.5])
+        rows += [[None, None, f'filler {i}', i] for i in range(5000)]
+        write_workbook(self.directory / 'types.xlsx', {'Data': rows})
+        with open(self.directory / 'types.xlsx', 'rb') as file:
+            preview = read_excel_file(file, 3, 1000)
+        self.assertEqual(preview.splitlines(), [
+            "Sheet 'Data' (A1:D5003), header: ['when', 'flag', 'name', 'n']",
+            "First rows of sheet 'Data':",
+            "['when', 'flag', 'name', 'n']",
+            "[datetime.datetime(2024, 1, 1, 0, 0), True, 'alpha', 1]",
+            "[datetime.datetime(2024, 2, 3, 0, 0), False, 'beta', 2.5]",
+        ])
+
+    def test_presentation_file(self):
+        presentation = Presentation()
+        for i in range(5):
+            slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+            slide.shapes.title.text = f'Slide {i}'
+        presentation.save(self.directory / 'deck.pptx')
+        with open(self.directory / 'deck.pptx', 'rb') as file:
+            self.assertEqual(read_ppt_file(file, 2, 1000), 'Slide 0\nSlide 1\n')
+
+
+class SchemaPreviewTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+
+    def preview(self, name, content, extension):
+        path = self.directory / name
+        path.write_bytes(content)
+        return extract_preview(path, extension, 16, 4000)
+
+    def test_csv_schema(self):
+        preview = self.preview('sales.csv', b'date,amount\n2024-01-01,1.5\n2024-01-02,2\n', '.csv')
+        self.assertEqual(preview.splitlines()[:5], [
+            "Delimiter: ','", "Rows: 2", "Columns (2):", "  date: object", "  amount: float64",
+        ])
+        self.assertIn("  ['2024-01-01', 1.5]", preview)
+
+    def test_row_count_of_large_files_is_estimated(self):
+        preview = self.preview('big.tsv', b'id\tname\n' + b''.join(b'%06d\tname\n' % i for i in range(100000)), '.tsv')
+        self.assertIn("Rows: ~", preview)
+        self.assertIn("Delimiter: '\\t'", preview)
+
+    def test_json_and_parquet(self):
+        self.assertIn("Object with 2 keys:\n  a: int = 1", self.preview('data.json', b'{"a": 1, "b": [2]}', '.json'))
+        self.assertIn("List of records\nRows: 2", self.preview('data.json', b'[{"a": 1}, {"a": 2}]', '.json'))
+
+        pd.DataFrame({'id': [1, 2, 3], 'name': ['a', 'b', 'c']}).to_parquet(self.directory / 'data.parquet')
+        preview = extract_preview(self.directory / 'data.parquet', '.parquet', 16, 4000)
+        self.assertTrue(preview.startswith("Rows: 3, row groups: 1\nColumns (2):\n  id: int64\n  name: string"))
+
+    def test_registered_readers(self):
+        self.addCleanup(PREVIEW_READERS.pop, '.test')
+        register_reader('.test')(lambda file, num_lines, max_chars: file.read().decode().upper())
+        self.assertEqual(self.preview('notes.test', b'hello', '.test'), 'HELLO')
+        self.assertEqual(self.preview('notes.bin', b'hello', '.bin'), "Cannot read this file.")
+
+
+class PromptBuilderTests(SimpleTestCase):
+    def test_small_sections_are_kept_whole(self):
+        builder = PromptBuilder(1000)
+        builder.add('a.csv', 'x,y\n1,2\n')
+        builder.add('b.csv', 'z\n3\n')
+        text, sections = builder.build()
+        self.assertEqual(text, 'a.csv:\n"""\nx,y\n1,2\n...\n"""\n\nb.csv:\n"""\nz\n3\n...\n"""\n\n')
+        self.assertFalse(any(section.truncated for section in sections))
+
+    def test_large_sections_share_the_budget(self):
+        builder = PromptBuilder(200)
+        builder.add('small.csv', 'a\n1\n')
+        builder.add('large.csv', 'b\n' + '1234567890\n' * 1000)
+        text, sections = builder.build()
+        self.assertLessEqual(estimate_tokens(text), 200)
+        self.assertFalse(sections[0].truncated)
+        self.assertTrue(sections[1].truncated)
+        self.assertIn('[... truncated to fit the prompt]', sections[1].text)
+
+    def test_headers_over_budget_omit_sections(self):
+        builder = PromptBuilder(100)
+        for i in range(30):
+            builder.add(f'file_{i:02}.csv', 'a,b\n1,2\n' * 20)
+        text, sections = builder.build()
+        self.assertLessEqual(estimate_tokens(text), 100)
+        # Not even the headers fit, the sections are only listed by name
+        self.assertTrue(text.startswith('Further sections, not shown: file_00.csv, file_01.csv'))
+        self.assertEqual([section.text for section in sections], [''] * 30)
+
+        builder = PromptBuilder(100)
+        for i in range(16):
+            builder.add(f'file_{i:02}.csv', 'a,b\n1,2\n' * 20)
+        text, sections = builder.build()
+        self.assertLessEqual(estimate_tokens(text), 100)
+        self.assertTrue(text.startswith('file_00.csv:\n'))
+        self.assertIn('Further sections, not shown: file_10.csv, ', text)
+        self.assertTrue(text.endswith(', file_15.csv\n\n'))
+
+    def test_budget_is_never_exceeded(self):
+        for budget in (0, 1, 5, 20, 50, 300):
+            for count in (1, 3, 12):
+                builder = PromptBuilder(budget)
+                for i in range(count):
+                    builder.add(f'input_{i}.txt', 'word ' * (i * 40) + '\n')
+                text, _ = builder.build()
+                with self.subTest(budget=budget, count=count):
+                    self.assertLessEqual(estimate_tokens(text), budget)
+
+
+def description(name, columns, rows, sample_value=1.5):
+    """Input files description of a CSV file, as built from its preview."""
+    builder = PromptBuilder(10000)
+    preview = f"Rows: {rows}\nColumns ({len(columns)}):\n" + ''.join(f"  {column}\n" for column in columns)
+    builder.add(name, preview + f"Sample rows:\n  ['2024-01-01', {sample_value}]\n")
+    return builder.build()[0]
+
+
+class CodeCacheTests(SimpleTestCase):
+    def test_lru_eviction(self):
+        cache = CodeCache(max_entries=2, ttl=60)
+        cache.set('a', 'code a')
+        cache.set('b', 'code b')
+        self.assertEqual(cache.get('a'), 'code a')
+        cache.set('c', 'code c')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'code a')
+        self.assertEqual(cache.get('c'), 'code c')
+        self.assertEqual(cache.stats(), {"entries": 2, "hits": 3, "misses": 1})
+
+    def test_ttl_expiry(self):
+        cache = CodeCache(max_entries=10, ttl=60)
+        with mock.patch('services.code_cache.time.monotonic', return_value=1000.0):
+            cache.set('a', 'code a')
+        with mock.patch('services.code_cache.time.monotonic', return_value=1059.0):
+            self.assertEqual(cache.get('a'), 'code a')
+        with mock.patch('services.code_cache.time.monotonic', return_value=1061.0):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_disabled(self):
+        cache = CodeCache(max_entries=0, ttl=60)
+        cache.set('a', 'code a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_key_ignores_instruction_case_and_whitespace(self):
+        description = 'sales.csv:\n"""\nColumns (2):\n  date: object\n  amount: float64\n...\n"""\n\n'
+        self.assertEqual(CodeCache.key('Sum the  amounts', description), CodeCache.key('sum the amounts', description))
+        self.assertNotEqual(CodeCache.key('Sum the amounts', description), CodeCache.key('Count the rows', description))
+
+    def test_fingerprint_ignores_content(self):
+        columns = ['date: object', 'amount: float64']
+        fingerprint = input_fingerprint(description('sales.csv', columns, 100))
+        self.assertEqual(input_fingerprint(description('sales.csv', columns, 2500, 'n/a')), fingerprint)
+        self.assertNotEqual(input_fingerprint(description('sales.csv', ['date: object', 'total: float64'], 100)),
+                            fingerprint)
+        self.assertNotEqual(input_fingerprint(description('orders.csv', columns, 100)), fingerprint)
+
+
+class ApiError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = mock.Mock(headers=headers or {})
+
+
+class ApiConnectionError(Exception):
+    pass
+
+
+@override_settings(LLM_MAX_RETRIES=3, LLM_BACKOFF_BASE=0.5, LLM_BACKOFF_MAX=20)
+class RetryPolicyTests(SimpleTestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(ApiError, ApiConnectionError)
+        sleep = mock.patch('services.llm_retry.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_transient_errors_are_retried(self):
+        function = mock.Mock(side_effect=[ApiError(429), ApiConnectionError(), ApiError(503), 'done'])
+        self.assertEqual(self.policy.call(function, 'prompt'), 'done')
+        self.assertEqual(function.call_count, 4)
+        self.assertEqual(self.sleep.call_count, 3)
+        for (delay,), _ in self.sleep.call_args_list:
+            self.assertLessEqual(delay, 20)
+
+    def test_gives_up_after_max_retries(self):
+        function = mock.Mock(side_effect=ApiError(500))
+        with self.assertRaises(ApiError):
+            self.policy.call(function)
+        self.assertEqual(function.call_count, 4)
+
+    def test_client_errors_are_not_retried(self):
+        function = mock.Mock(side_effect=ApiError(400))
+        with self.assertRaises(ApiError):
+            self.policy.call(function)
+        self.assertEqual(function.call_count, 1)
+        self.sleep.assert_not_called()
+
+    def test_server_requested_delay(self):
+        self.assertEqual(server_requested_delay({'retry-after': '7'}), 7.0)
+        self.assertEqual(server_requested_delay({'retry-after-ms': '250'}), 0.25)
+        self.assertEqual(
+            server_requested_delay({'x-ratelimit-reset-requests': '2m0.5s', 'x-ratelimit-reset-tokens': '120ms'}),
+            120.5,
+        )
+        self.assertIsNone(server_requested_delay({}))
+        self.assertEqual(parse_duration('1h1m1s'), 3661)
+        self.assertIsNone(parse_duration('soon'))
+
+        delay = self.policy.delay(0, ApiError(429, {'retry-after': '7'}))
+        self.assertTrue(7 <= delay <= 7.5)
+        # Requested delays are capped to LLM_BACKOFF_MAX
+        self.assertLessEqual(self.policy.delay(0, ApiError(429, {'retry-after': '3600'})), 20.5)
+
+
+class ExtractCodeTests(SimpleTestCase):
+    def test_responses(self):
+        cases = [
+            ("print(1)", "print(1)"),
+            ("`print(1)`", "print(1)"),
+            ("```python\nprint(1)\n```", "print(1)"),
+            ("```py\nprint(1)\n```", "print(1)"),
+            ("```Python3\nprint(1)\n```\nThis prints 1.", "print(1)"),
+            ("Here is the code:\n```\nprint(1)\n```\n", "print(1)"),
+            ("```python\nprint(1)\n", "print(1)"),
+            ("```python\nprint(1)```", "print(1)"),
+            ("```python x = 1```", "x = 1"),
+            ("```python\nfence = '```'\nprint(fence)\n```", "fence = '```'\nprint(fence)"),
+            ("```python\npython_files = 1\n```", "python_files = 1"),
+        ]
+        for content, code in cases:
+            with self.subTest(content=content):
+                self.assertEqual(extract_code(content), code)
+
+    def test_stream_collector(self):
+        collector = CodeStreamCollector()
+        self.assertFalse(collector.feed("Sure:\n``"))
+        self.assertFalse(collector.feed("`python\nprint(1)\n"))
+        self.assertTrue(collector.feed("```\nMore prose"))
+        self.assertEqual(extract_code(collector.text()), "print(1)")
+
+    def test_syntax_error(self):
+        self.assertIsNone(syntax_error("print(1)\n"))
+        self.assertIn("SyntaxError", syntax_error("print(1\n"))
+        # The sandbox runs Python 3.9, which has no match statement
+        self.assertIn("SyntaxError", syntax_error("match 1:\n    case 1:\n        pass\n"))
+
+    def test_stream_collector_ignores_fences_inside_the_code(self):
+        collector = CodeStreamCollector()
+        self.assertFalse(collector.feed("Sure:\n``"))
+        self.assertFalse(collector.feed("`python\nfence = '```"))
+        self.assertFalse(collector.feed("'\nprint(fence)\n"))
+        self.assertTrue(collector.feed("```\nMore prose"))
+        self.assertEqual(extract_code(collector.text()), "fence = '```'\nprint(fence)")
+
+
+class FakeLLMClient:
+    """Generates fixed code, the fake executor below writes output only for 'write_output = True'."""
+
+    def __init__(self, code):
+        self.code = code
+
+    def generate_python_code(self, input_files_description, instruction, temperature=None):
+        return self.code
+
+    def fix_generated_code(self, generated_code, logs):
+        return self.code
+
+
+class FakeExecutor:
+    def execute_script(self, temp_directory, cancel_event=None, packages=None):
+        if (temp_directory / "main.py").read_text() == 'write_output = True':
+            (temp_directory / "output" / "result.txt").write_text('Done.')
+        return True, 'Ran.'
+
+
+@override_settings(SPECULATIVE_CANDIDATES=[{'provider': 'silent'}, {'provider': 'writer'}])
+class SpeculativeRunTests(SimpleTestCase):
+    def test_first_candidate_with_output_wins(self):
+        root = temporary_directory(self)
+        apply_patch(self, override_settings(PODMAN_WORKSPACE_ROOT=root, PODMAN_OUTPUTS_ROOT=root / 'outputs'))
+        temp_directory = root / 'process'
+        (temp_directory / 'output').mkdir(parents=True)
+        (temp_directory / 'sales.csv').write_text('a\n1\n')
+        apply_patch(self, mock.patch.dict('run_pipeline.pipeline.LLM_PROVIDERS', {
+            'silent': lambda: FakeLLMClient('pass'),
+            'writer': lambda: FakeLLMClient('write_output = True'),
+        }))
+
+        result, generated_code = ProgramPipeline(FakeExecutor()).run_speculative(temp_directory, '', 'Do it')
+        self.assertEqual((result, generated_code), ((True, 'Ran.'), 'write_output = True'))
+        self.assertEqual((temp_directory / 'output' / 'result.txt').read_text(), 'Done.')
+        self.assertEqual((temp_directory / 'main.py').read_text(), 'write_output = True')
+
+
+REQUIREMENTS_PATH = settings.PODMAN_IMAGE_DIR / "requirements.txt"
+
+
+class PreflightTests(SimpleTestCase):
+    def test_valid_code_passes(self):
+        code = (
+            "import pandas as pd\n"
+            "from mpl_toolkits.mplot3d import Axes3D\n"
+            "df = pd.read_csv('data/sales.csv')\n"
+            "df.to_csv('output/result.csv')\n"
+        )
+        report = preflight(code, ['data/sales.csv'], REQUIREMENTS_PATH)
+        self.assertTrue(report.ok, str(report))
+
+    def test_problems_are_reported(self):
+        code = (
+            "import polars\n"
+            "import pandas as pd\n"
+            "df = pd.read_csv('missing.csv')\n"
+            "print(df)\n"
+        )
+        report = preflight(code, ['sales.csv'], REQUIREMENTS_PATH)
+        self.assertFalse(report.ok)
+        text = str(report)
+        self.assertIn('polars', text)
+        self.assertIn("'missing.csv' is read but was not uploaded", text)
+        self.assertIn("never writes to the 'output/' directory", text)
+
+    def test_optional_imports(self):
+        code = (
+            "try:\n"
+            "    import ujson as json\n"
+            "except ImportError:\n"
+            "    import json\n"
+            "import pandas as pd\n"
+            "df = pd.read_csv('sales.csv')\n"
+            "df.to_excel('output/sales.xlsx')\n"
+        )
+        report = preflight(code, ['sales.csv'], REQUIREMENTS_PATH)
+        self.assertTrue(report.ok, str(report))
+
+    def test_long_extensions_are_checked(self):
+        code = "import pandas as pd\npd.read_parquet('missing.parquet').to_csv('output/result.csv')\n"
+        report = preflight(code, ['sales.csv'], REQUIREMENTS_PATH)
+        self.assertIn("'missing.parquet' is read but was not uploaded", str(report))
+
+
+class RequiredPackagesTests(SimpleTestCase):
+    def test_required_packages(self):
+        code = "import os\nimport yaml\nimport pandas as pd\nfrom mpl_toolkits.mplot3d import Axes3D\nimport polars\n"
+        self.assertEqual(required_packages(code, REQUIREMENTS_PATH), ['PyYAML', 'matplotlib', 'pandas'])
+        self.assertIsNone(required_packages("def (\n", REQUIREMENTS_PATH))
+
+    def test_optional_pandas_dependencies(self):
+        code = (
+            "import pandas as pd\n"
+            "tables = pd.read_html('page.html')\n"
+            "html = tables[0].style.background_gradient().to_html()\n"
+            "tables[0].to_parquet('output/table.parquet')\n"
+        )
+        self.assertEqual(
+            required_packages(code, REQUIREMENTS_PATH), ['Jinja2', 'lxml', 'matplotlib', 'pandas', 'pyarrow']
+        )
+        # Without pandas the names are ordinary attributes
+        self.assertEqual(required_packages("x.style = 1\n", REQUIREMENTS_PATH), [])
+
+
+class WorkspaceTests(SimpleTestCase):
+    def test_inputs_are_linked_and_output_is_separate(self):
+        root = temporary_directory(self)
+        stored = root / 'stored.csv'
+        stored.write_text('a\n1\n')
+        with Workspace(root / 'workspaces', root / 'outputs') as workspace:
+            workspace.add_input(stored, 'sales.csv')
+            workspace.save_upload(SimpleUploadedFile('notes.txt', b'hello'))
+            self.assertEqual((workspace.directory / 'sales.csv').stat().st_ino, stored.stat().st_ino)
+            self.assertEqual((workspace.directory / 'notes.txt').read_bytes(), b'hello')
+
+            (workspace.directory / 'output' / 'result.txt').write_text('Done.')
+            self.assertEqual((root / 'outputs' / workspace.directory.name / 'result.txt').read_text(), 'Done.')
+        self.assertEqual(list((root / 'workspaces').iterdir()), [])
+        self.assertEqual(list((root / 'outputs').iterdir()), [])
+        self.assertTrue(stored.exists())
+
+
+class JobResultTests(SimpleTestCase):
+    def test_peak_memory_is_split_from_stderr(self):
+        self.assertEqual(split_peak_memory("Traceback\n__adp_peak_memory_kib=2048\n"), ("Traceback", 2048 * 1024))
+        self.assertEqual(split_peak_memory("Traceback\n"), ("Traceback\n", None))
+
+    def test_exit_reasons(self):
+        result = job_result(0, b'Done.', b'\n__adp_peak_memory_kib=10\n', None, 1.5)
+        self.assertEqual(tuple(result), (True, 'Done.'))
+        self.assertEqual((result.exit_reason, result.elapsed, result.peak_memory), (EXIT_SUCCESS, 1.5, 10240))
+
+        cases = [
+            ((1, b'', b'ValueError', None), EXIT_ERROR),
+            ((128 + signal.SIGKILL, b'', b'', None), EXIT_MEMORY_LIMIT),
+            ((-9, b'', b'', EXIT_TIMEOUT), EXIT_TIMEOUT),
+            ((-9, b'', b'', EXIT_CANCELLED), EXIT_CANCELLED),
+        ]
+        for arguments, exit_reason in cases:
+            with self.subTest(exit_reason=exit_reason):
+                result = job_result(*arguments, 2.0)
+                self.assertFalse(result.success)
+                self.assertEqual(result.exit_reason, exit_reason)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_spans_are_collected_per_job(self):
+        with metrics.collect_timings() as timings:
+            with metrics.span('generate', provider='groq') as generate:
+                metrics.add_to_span('retries')
+            metrics.record('queue', 0.25)
+            metrics.record('execute', 1.0)
+            metrics.record('execute', 0.5)
+        self.assertEqual([timing.stage for timing in timings], ['generate', 'queue', 'execute', 'execute'])
+        self.assertEqual(generate.attributes, {'provider': 'groq', 'retries': 1})
+        header = metrics.server_timing(timings[1:])
+        self.assertEqual(header, 'queue;dur=250.0, execute;dur=1500.0;desc="2 calls"')
+
+        # Outside of collect_timings spans only feed the histograms
+        metrics.record('queue', 0.1)
+        self.assertEqual(len(timings), 4)
+
+    def test_prometheus_format(self):
+        counter = metrics.Counter('test_runs_total', 'Test runs.', ('exit_reason',))
+        counter.inc(exit_reason='success')
+        counter.inc(2, exit_reason='success')
+        histogram = metrics.Histogram('test_seconds', 'Test durations.', (1, 5))
+        histogram.observe(0.5)
+        histogram.observe(3)
+        self.assertEqual(counter.render(), [
+            '# HELP test_runs_total Test runs.', '# TYPE test_runs_total counter',
+            'test_runs_total{exit_reason="success"} 3',
+        ])
+        self.assertIn('test_seconds_bucket{le="5"} 2', histogram.render())
+        self.assertIn('test_seconds_count 2', histogram.render())
+
+    @override_settings(**API_TEST_SETTINGS)
+    def test_endpoint_and_server_timing(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE adp_stage_duration_seconds histogram', response.content.decode())
+        self.assertTrue(response['Server-Timing'].startswith('total;dur='))
+
+
+FAILING_CODE = "raise SystemExit('no output')\n"
+
+
+@override_settings(GROQ_API_KEY='stub', SPECULATIVE_CANDIDATES=[], LLM_MAX_RETRIES=0)
+class ProgramPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.stub = StubLLMServer({'Break it': FAILING_CODE}).start()
+        self.addCleanup(self.stub.stop)
+        apply_patch(self, override_settings(GROQ_BASE_URL=self.stub.groq_base_url))
+        # A client and a code cache of their own, the client pointing to the stub
+        apply_patch(self, mock.patch.object(groq_client, '_client', None))
+        apply_patch(self, mock.patch('run_pipeline.pipeline.get_code_cache', return_value=CodeCache(10, 60)))
+        self.directory = temporary_directory(self)
+        (self.directory / 'sales.csv').write_text('date,amount\n2024-01-01,1.5\n2024-01-02,2.5\n')
+        (self.directory / 'output').mkdir()
+        self.description = 'sales.csv:\n"""\nColumns (2):\n  date: object\n  amount: float64\n...\n"""\n\n'
+        self.pipeline = ProgramPipeline(LocalExecutor())
+
+    def summary(self):
+        return json.loads((self.directory / 'output' / 'summary.json').read_text())
+
+    def test_run(self):
+        result = self.pipeline.run(self.directory, self.description, 'Summarize the files')
+        self.assertIsInstance(result, ExecutionResult)
+        self.assertTrue(result.success, result.logs)
+        self.assertEqual(result.exit_reason, EXIT_SUCCESS)
+        self.assertEqual(self.summary(), {'sales.csv': {'bytes': 42, 'lines': 3}})
+        self.assertEqual(self.stub.requests, 1)
+
+        # The same instruction on the same inputs reuses the code
+        (self.directory / 'output' / 'summary.json').unlink()
+        result = self.pipeline.run(self.directory, self.description, 'summarize the  files')
+        self.assertTrue(result.success, result.logs)
+        self.assertTrue((self.directory / 'output' / 'summary.json').exists())
+        self.assertEqual(self.stub.requests, 1)
+
+    def test_failing_code_is_fixed(self):
+        result = self.pipeline.run(self.directory, self.description, 'Break it')
+        self.assertTrue(result.success, result.logs)
+        self.assertEqual(self.summary(), {'sales.csv': {'bytes': 42, 'lines': 3}})
+        # The generation and one fix
+        self.assertEqual(self.stub.requests, 2)
+        self.assertEqual((self.directory / 'main.py').read_text(), self.stub.default_code.strip())
+
+
+@override_settings(WORKER_POOL_PRELOAD=[], SANDBOX_MAX_CONCURRENCY=1, PODMAN_TIMEOUT=30)
+class WorkerPoolExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = WorkerPoolExecutor()
+        self.addCleanup(self.executor.shutdown)
+        self.directory = temporary_directory(self)
+        (self.directory / 'output').mkdir()
+
+    def run_code(self, code):
+        (self.directory / 'main.py').write_text(code)
+        return self.executor.execute_script(self.directory)
+
+    def test_jobs_run_in_forked_children(self):
+        result = self.run_code("import os\nopen('output/pid.txt', 'w').write(str(os.getpid()))\nprint('Done.')\n")
+        self.assertEqual((result.success, result.exit_reason), (True, EXIT_SUCCESS), result.logs)
+        self.assertEqual(result.logs.strip(), 'Done.')
+        first_pid = (self.directory / 'output' / 'pid.txt').read_text()
+
+        # The worker goes back to the pool and forks a new child for the next job
+        result = self.run_code("import os\nopen('output/pid.txt', 'w').write(str(os.getpid()))\n")
+        self.assertTrue(result.success, result.logs)
+        self.assertNotEqual((self.directory / 'output' / 'pid.txt').read_text(), first_pid)
+
+        result = self.run_code("raise ValueError('bad input')\n")
+        self.assertEqual((result.success, result.exit_reason), (False, EXIT_ERROR))
+        self.assertIn("ValueError: bad input", result.logs)
+
+    def test_memory_bytes(self):
+        self.assertEqual(memory_bytes('512m'), 512 * 1024 ** 2)
+        self.assertEqual(memory_bytes('1g'), 1024 ** 3)
+        self.assertIsNone(memory_bytes(None))
+        with self.assertRaises(ValueError):
+            memory_bytes('lots')
+
+
+SUM_CODE = (
+    "import pandas as pd\n"
+    "total = pd.read_csv('sales.csv')['amount'].sum()\n"
+    "open('output/total.txt', 'w').write(str(total))\n"
+)
+
+
+@override_settings(**API_TEST_SETTINGS)
+class PipelineStoreTests(TestCase):
+    def setUp(self):
+        root = temporary_directory(self)
+        apply_patch(self, override_settings(
+            MEDIA_ROOT=root, PODMAN_WORKSPACE_ROOT=root / 'workspaces', PODMAN_OUTPUTS_ROOT=root / 'outputs'
+        ))
+        apply_patch(self, mock.patch('run_pipeline.views.get_executor', return_value=LocalExecutor()))
+        self.description = 'sales.csv:\n"""\nColumns (2):\n  date: object\n  amount: float64\n...\n"""\n\n'
+
+    def test_versions(self):
+        first = save_pipeline_version('Sum the amounts', self.description, SUM_CODE, ['sales.csv'])
+        self.assertEqual((first.version, first.input_names), (1, ['sales.csv']))
+        # The same code for the same input structure is kept once, per normalized instruction
+        self.assertEqual(save_pipeline_version('sum the  amounts', self.description, SUM_CODE, ['sales.csv']), first)
+        second = save_pipeline_version(
+            'Sum the amounts', 'other.csv:\n"""\nx\n"""\n\n', SUM_CODE + '\n', ['other.csv']
+        )
+        self.assertEqual((second.pipeline, second.version), (first.pipeline, 2))
+        third = save_pipeline_version('Sum the amounts', 'a.csv:\n"""\nx\n"""\n\n', SUM_CODE, ['a.csv', 'b.csv'])
+
+        # The latest version the uploads fit by number and types of files
+        self.assertEqual(select_version(first.pipeline, ['march.csv']), second)
+        self.assertEqual(select_version(first.pipeline, ['march.csv', 'april.csv']), third)
+        self.assertEqual(select_version(first.pipeline, ['march.json']), third)
+        self.assertEqual(select_version(first.pipeline, ['march.csv'], version=1), first)
+        self.assertIsNone(select_version(first.pipeline, ['march.csv'], version=4))
+        # A version generated for inputs of the same structure under the same names is preferred
+        self.assertEqual(matching_version(second, self.description), second)
+        first.input_names = ['other.csv']
+        first.save()
+        self.assertEqual(matching_version(second, self.description), first)
+
+    def test_run_saved_pipeline(self):
+        version = save_pipeline_version('Sum the amounts', self.description, SUM_CODE, ['sales.csv'])
+        url = f'/api/pipelines/{version.pipeline_id}/run/'
+        sales = SimpleUploadedFile('sales.csv', b'date,amount\n2024-01-01,1.5\n2024-01-02,2.5\n')
+        response = self.client.post(url, {'files': [sales]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_bytes(response), b'4.0')
+        self.assertEqual((response['X-Pipeline-Id'], response['X-Pipeline-Version']), (str(version.pipeline_id), '1'))
+
+        response = self.client.post(url, {'files': [SimpleUploadedFile('sales.csv', b'x')], 'version': '7'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_uploads_are_linked_onto_the_input_names(self):
+        version = save_pipeline_version('Sum the amounts', self.description, SUM_CODE, ['sales.csv'])
+        url = f'/api/pipelines/{version.pipeline_id}/run/'
+        march = SimpleUploadedFile('sales-03.csv', b'date,amount\n2024-03-01,2.5\n2024-03-02,3.5\n')
+        response = self.client.post(url, {'files': [march]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_bytes(response), b'6.0')
+
+        files = [SimpleUploadedFile('a.csv', b'amount\n1\n'), SimpleUploadedFile('b.csv', b'amount\n2\n')]
+        response = self.client.post(url, {'files': files})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "Version 1 reads 1 input files (sales.csv), 2 were uploaded.")
+        response = self.client.post(url, {'files': [SimpleUploadedFile('sales.json', b'[]')]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_saved_code_skips_the_preflight_check(self):
+        # The pre-flight check cannot tell that this code writes to output/
+        code = "import os\nopen(os.path.join('out' + 'put', 'done.txt'), 'w').write('Done.')\n"
+        version = save_pipeline_version('Say done', self.description, code, ['sales.csv'])
+        response = self.client.post(
+            f'/api/pipelines/{version.pipeline_id}/run/', {'files': [SimpleUploadedFile('sales.csv', b'a\n1\n')]}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_bytes(response), b'Done.')
+
+
+def csv_upload(name, amounts):
+    return SimpleUploadedFile(name, ('date,amount\n' + ''.join(f'2024-01-01,{a}\n' for a in amounts)).encode())
+
+
+def fake_sum_run(pipeline, temp_directory, input_files_description, instruction):
+    """ProgramPipeline.run as if SUM_CODE had been generated and run."""
+    (Path(temp_directory) / 'main.py').write_text(SUM_CODE)
+    return pipeline.execute(SUM_CODE, temp_directory)
+
+
+@override_settings(**API_TEST_SETTINGS)
+class BatchTests(TestCase):
+    def setUp(self):
+        root = temporary_directory(self)
+        apply_patch(self, override_settings(
+            MEDIA_ROOT=root, PODMAN_WORKSPACE_ROOT=root / 'workspaces', PODMAN_OUTPUTS_ROOT=root / 'outputs'
+        ))
+        apply_patch(self, mock.patch('run_pipeline.views.get_executor', return_value=LocalExecutor()))
+        apply_patch(self, mock.patch.object(ProgramPipeline, 'run', autospec=True, side_effect=fake_sum_run))
+
+    def test_groups(self):
+        files = MultiValueDict({
+            'group.jan 2024': [csv_upload('sales.csv', [1]), csv_upload('notes.txt', [])],
+            'files': [csv_upload('feb.csv', [2]), csv_upload('jan_2024.csv', [3])],
+        })
+        items = collect_groups(files)
+        self.assertEqual([item.name for item in items], ['jan_2024', 'feb', 'jan_2024-2'])
+        self.assertEqual(input_names(items[1], ['sales.csv']), ['sales.csv'])
+        self.assertEqual(input_names(items[1], ['sales.xlsx']), ['feb.csv'])
+        self.assertEqual(input_names(items[0], ['sales.csv']), ['sales.csv', 'notes.txt'])
+
+    def test_batch(self):
+        response = self.client.post('/api/batch/', {
+            'instruction': 'Sum the amounts',
+            'files': [csv_upload('sales.csv', [1, 2]), csv_upload('sales-02.csv', [3]), csv_upload('other.txt', [])],
+        })
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(io.BytesIO(response_bytes(response)))
+        self.assertEqual(archive.read('sales/total.txt'), b'3')
+        # The second group's file is linked under the name the code was generated for
+        self.assertEqual(archive.read('sales-02/total.txt'), b'3')
+        report = json.loads(archive.read('report.json'))
+        self.assertEqual((report['succeeded'], report['failed']), (2, 1))
+        self.assertEqual([item['success'] for item in report['items']], [True, True, False])
+        self.assertIn("sales.csv", report['items'][2]['logs'])
+        self.assertEqual(ProgramPipeline.run.call_count, 1)
+
+
+class ColumnarCopyTests(SimpleTestCase):
+    def setUp(self):
+        root = temporary_directory(self)
+        self.directory = root / 'workspace'
+        self.directory.mkdir()
+        cache = ColumnarCache(root / 'cache', 10)
+        apply_patch(self, mock.patch('run_pipeline.columnar.get_columnar_cache', return_value=cache))
+        apply_patch(self, override_settings(COLUMNAR_MIN_BYTES=30))
+
+    def test_tables_get_parquet_copies(self):
+        (self.directory / 'sales.csv').write_text('date,amount\n2024-01-01,1.5\n2024-01-02,2.5\n')
+        (self.directory / 'small.csv').write_text('a\n1\n')
+        (self.directory / 'notes.txt').write_text('x' * 100)
+        write_workbook(self.directory / 'book.xlsx', {'Jan': [['amount'], [1]], 'Feb 2': [['amount'], [2]]})
+
+        copies = add_columnar_copies(self.directory, ['sales.csv', 'small.csv', 'notes.txt', 'book.xlsx'])
+        self.assertEqual([str(copy) for copy in copies], [
+            'sales.csv.parquet (copy of sales.csv)',
+            "book.xlsx.Jan.parquet (copy of book.xlsx, sheet 'Jan')",
+            "book.xlsx.Feb_2.parquet (copy of book.xlsx, sheet 'Feb 2')",
+        ])
+        self.assertEqual(pd.read_parquet(self.directory / 'sales.csv.parquet')['amount'].sum(), 4.0)
+        self.assertEqual(pd.read_parquet(self.directory / 'book.xlsx.Feb_2.parquet')['amount'].tolist(), [2])
+        self.assertIn('pandas.read_parquet(path, memory_map=True)', columnar_note(copies))
+        self.assertEqual(columnar_note([]), '')
+
+        # Copies that are already there are kept
+        self.assertEqual(len(add_columnar_copies(self.directory, ['sales.csv', 'book.xlsx'])), 3)
+
+    def test_engines_are_required_packages(self):
+        code = "import pandas as pd\npd.read_excel('book.xlsx').to_parquet('output/book.parquet')\n"
+        self.assertEqual(required_packages(code, REQUIREMENTS_PATH), ['openpyxl', 'pandas', 'pyarrow'])
+
+
+@override_settings(SAMPLE_ROWS=2, SAMPLE_MIN_BYTES=0)
+class SampleFirstTests(SimpleTestCase):
+    def setUp(self):
+        root = temporary_directory(self)
+        apply_patch(self, override_settings(PODMAN_WORKSPACE_ROOT=root, PODMAN_OUTPUTS_ROOT=root / 'outputs'))
+        self.directory = root / 'process'
+        self.directory.mkdir()
+        (self.directory / 'sales.csv').write_text('amount\n' + '1\n' * 10)
+        (self.directory / 'notes.txt').write_text('first line\n' * 10)
+
+    def test_tables_are_truncated(self):
+        sample = create_sample_workspace(self.directory, ['sales.csv', 'notes.txt'])
+        self.addCleanup(sample.cleanup)
+        self.assertEqual((sample.directory / 'sales.csv').read_text(), 'amount\n1\n1\n')
+        self.assertEqual((sample.directory / 'notes.txt').read_text(), 'first line\n' * 10)
+
+        with override_settings(SAMPLE_MIN_BYTES=1000):
+            self.assertIsNone(create_sample_workspace(self.directory, ['sales.csv', 'notes.txt']))
+
+    def test_failed_sample_run_keeps_the_result(self):
+        executor = mock.Mock()
+        executor.execute_script.return_value = ExecutionResult(False, 'KeyError: 2', EXIT_ERROR, 0.5, 1024)
+        sample = create_sample_workspace(self.directory, ['sales.csv'])
+        self.addCleanup(sample.cleanup)
+
+        result = ProgramPipeline(executor).execute_sample_first("print(1)\n", self.directory, sample, check=False)
+        self.assertEqual((result.exit_reason, result.elapsed, result.peak_memory), (EXIT_ERROR, 0.5, 1024))
+        self.assertTrue(result.logs.startswith('The program failed on a sample of the input files'))
+        self.assertTrue(result.logs.endswith('KeyError: 2'))
+        # The full inputs are not run once the sample failed
+        executor.execute_script.assert_called_once()
+        self.assertEqual(executor.execute_script.call_args[0][0], sample.directory)
+
+
+class SavedCodeColumnarCopyTests(SimpleTestCase):
+    def test_copies_are_created_for_code_reading_them(self):
+        root = temporary_directory(self)
+        apply_patch(self, mock.patch('run_pipeline.columnar.get_columnar_cache', return_value=ColumnarCache(root, 10)))
+        (root / 'sales.csv').write_text('amount\n1\n2\n')
+        executor = mock.Mock()
+        executor.execute_script.return_value = (True, 'Done.')
+        pipeline = ProgramPipeline(executor)
+
+        # Below COLUMNAR_MIN_BYTES code reading the original gets no copy
+        pipeline.execute("import pandas as pd\npd.read_csv('sales.csv')\n", root, check=False)
+        self.assertFalse((root / 'sales.csv.parquet').exists())
+        # Saved code generated on larger inputs reads the copy, which is then created whatever the size
+        pipeline.execute("import pandas as pd\npd.read_parquet('sales.csv.parquet')\n", root, check=False)
+        self.assertEqual(pd.read_parquet(root / 'sales.csv.parquet')['amount'].tolist(), [1, 2])
+
+
+class PreviewTimeoutTests(SimpleTestCase):
+    def test_slow_file_is_interrupted(self):
+        path = temporary_directory(self) / 'data.slow'
+        path.write_text('x')
+        self.addCleanup(PREVIEW_READERS.pop, '.slow')
+        register_reader('.slow')(lambda file, num_lines, max_chars: time.sleep(5))
+        # The workers install the alarm handler, restore the test runner's
+        self.addCleanup(signal.signal, signal.SIGALRM, signal.getsignal(signal.SIGALRM))
+
+        started_at = time.monotonic()
+        with self.assertRaises(PreviewTimeout):
+            extract_preview_in_worker(path, '.slow', 16, 100, 0.2)
+        self.assertLess(time.monotonic() - started_at, 2)
+        # The alarm is disarmed once a file is done
+        self.assertEqual(extract_preview_in_worker(path, '.txt', 16, 100, 0.2), 'x\n')
+        time.sleep(0.3)
+
+
+class JobRecoveryTests(TestCase):
+    def setUp(self):
+        apply_patch(self, override_settings(MEDIA_ROOT=temporary_directory(self), JOB_RETENTION=3600))
+
+    def test_orphaned_jobs_fail(self):
+        # No process has this pid, it is above the kernel's pid_max
+        lost = UploadProcess.objects.create(description='Lost', status=UploadProcess.RUNNING,
+                                            worker=f'{socket.gethostname()}:9999999')
+        running = UploadProcess.objects.create(description='Running', status=UploadProcess.RUNNING, worker=worker_id())
+        elsewhere = UploadProcess.objects.create(description='Elsewhere', worker='other-host:1')
+
+        self.assertEqual(fail_orphaned_jobs(), 1)
+        lost.refresh_from_db()
+        self.assertEqual((lost.status, lost.logs), (UploadProcess.FAILED, "The server stopped before the job finished."))
+        for process in (running, elsewhere):
+            process.refresh_from_db()
+            self.assertFalse(process.is_finished)
+
+    def test_expired_jobs_are_removed(self):
+        expired = UploadProcess.objects.create(description='Old', status=UploadProcess.SUCCEEDED)
+        recent = UploadProcess.objects.create(description='New', status=UploadProcess.SUCCEEDED)
+        queued = UploadProcess.objects.create(description='Queued')
+        UploadProcess.objects.filter(process_id__in=[expired.process_id, queued.process_id]).update(
+            updated_at=timezone.now() - timedelta(hours=2)
+        )
+        for process in (expired, recent):
+            job_result_directory(process.process_id).mkdir(parents=True)
+            job_upload_directory(process.process_id).mkdir(parents=True)
+
+        self.assertEqual(cleanup_expired_jobs(), 1)
+        self.assertEqual(
+            sorted(UploadProcess.objects.values_list('description', flat=True)), ['New', 'Queued']
+        )
+        self.assertFalse(job_result_directory(expired.process_id).parent.exists())
+        self.assertFalse(job_upload_directory(expired.process_id).exists())
+        self.assertTrue(job_result_directory(recent.process_id).exists())
+
+
+@override_settings(MAX_UPLOAD_FILE_SIZE=10, MAX_UPLOAD_REQUEST_SIZE=15, **API_TEST_SETTINGS)
+class BatchUploadLimitTests(TestCase):
+    def test_batch_view_answers_413(self):
+        response = self.client.post('/api/batch/', {
+            'instruction': 'Sum the amounts',
+            'files': SimpleUploadedFile('big.csv', b'a,b\n' * 10),
+        })
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('big.csv', response.json()['error'])
+
+
+class BenchmarkCommandTests(TransactionTestCase):
+    def setUp(self):
+        # The concurrent requests of the command run against the test database, with executors and clients of its own
+        apply_patch(self, mock.patch('run_pipeline.management.commands.benchmark.setup_databases'))
+        apply_patch(self, mock.patch('run_pipeline.management.commands.benchmark.teardown_databases'))
+        apply_patch(self, mock.patch.object(pipeline, '_executor', None))
+        apply_patch(self, mock.patch.object(RunProgramView, 'executor', None))
+        apply_patch(self, mock.patch.object(groq_client, '_client', None))
+        apply_patch(self, override_settings(PODMAN_WORKSPACE_ROOT=str(temporary_directory(self))))
+        # The command sets a secret key for the rest of its process
+        self.addCleanup(setattr, settings, 'SECRET_KEY', '')
+
+    def benchmark(self, *arguments):
+        output = StringIO()
+        call_command('benchmark', '--file-types=csv', '--file-sizes=1KB', '--concurrency=1', '--requests=2',
+                     '--llm-latency=0', *arguments, stdout=output, stderr=output)
+        return output.getvalue()
+
+    def test_requests_succeed(self):
+        self.assertIn('errors=0/2', self.benchmark())
+
+    def test_failing_warm_up_aborts(self):
+        with self.assertRaisesRegex(CommandError, r'warm-up request failed with status 500: ModuleNotFoundError'):
+            self.benchmark('--executor=services.missing.Executor')
+
+
+class InputStructureTests(SimpleTestCase):
+    def text_description(self, name, text):
+        builder = PromptBuilder(10000)
+        builder.add(name, text)
+        return builder.build()[0]
+
+    def test_file_names_are_kept_exactly(self):
+        # Code generated for sales_2024.csv opens sales_2024.csv
+        columns = ['date: object', 'amount: float64']
+        self.assertNotEqual(input_fingerprint(description('sales_2024.csv', columns, 100)),
+                            input_fingerprint(description('sales_2025.csv', columns, 100)))
+
+    def test_previews_of_files_without_structure_count(self):
+        fingerprint = input_fingerprint(self.text_description('notes.txt', 'Region: north\nTarget: 100\n'))
+        self.assertEqual(input_fingerprint(self.text_description('notes.txt', 'Region: north\nTarget: 100\n')),
+                         fingerprint)
+        self.assertNotEqual(input_fingerprint(self.text_description('notes.txt', 'Region: south\nTarget: 80\n')),
+                            fingerprint)
+
+
+class SandboxStdlibTests(SimpleTestCase):
+    def test_modules_of_the_sandbox_python(self):
+        # The sandbox runs Python 3.9, which has binhex but not tomllib
+        code = "import binhex\nimport tomllib\nopen('output/result.txt', 'w').write('Done.')\n"
+        report = preflight(code, [], REQUIREMENTS_PATH)
+        self.assertIn('not installed in the sandbox: tomllib.', str(report))
+
+
+class SelectVariantTests(SimpleTestCase):
+    def setUp(self):
+        root = temporary_directory(self)
+        apply_patch(self, override_settings(PODMAN_WORKSPACE_ROOT=root / 'workspaces', PODMAN_OUTPUTS_ROOT=root / 'outputs'))
+        self.executor = PodmanExecutor()
+        self.addCleanup(self.executor.shutdown)
+
+    def test_smallest_variant_providing_the_packages(self):
+        self.assertEqual(self.executor.select_variant([]), [])
+        self.assertEqual(self.executor.select_variant(['pandas', 'openpyxl']), settings.PODMAN_IMAGE_VARIANTS['data'])
+        self.assertIsNone(self.executor.select_variant(['pandas', 'PyYAML']))
+        self.assertIsNone(self.executor.select_variant(None))
+
+    @override_settings(PODMAN_IMAGE_VARIANTS={'slim': []})
+    def test_complete_image_without_a_providing_variant(self):
+        self.assertIsNone(self.executor.select_variant(['pandas']))
+
+
+@override_settings(SAMPLE_ROWS=2)
+class DelimitedSampleTests(SimpleTestCase):
+    def sample(self, name, content):
+        directory = temporary_directory(self)
+        source, destination = directory / name, directory / f'sample-{name}'
+        source.write_bytes(content)
+        sample_delimited_file(source, destination)
+        return destination.read_bytes()
+
+    def test_quoted_fields_spanning_lines_are_kept_whole(self):
+        content = 'id,note\r\n1,"first\r\nsecond, third"\r\n2,"Zürich ""HQ"""\r\n3,plain\r\n'.encode()
+        self.assertEqual(self.sample('notes.csv', content), content[:content.index(b'3,plain')])
+
+    def test_tab_separated_files(self):
+        content = b'id\tnote\n1\t"a\nb"\n2\tc\n3\td\n'
+        self.assertEqual(self.sample('notes.tsv', content), b'id\tnote\n1\t"a\nb"\n2\tc\n')
+        self.assertEqual(self.sample('short.tsv', b'id\n1\n'), b'id\n1\n')
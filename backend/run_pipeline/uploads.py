@@ -0,0 +1,42 @@
+import logging
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+logger = logging.getLogger(__name__)
+
+
+class SizeLimitUploadHandler(FileUploadHandler):
+    """
+    Enforce MAX_UPLOAD_FILE_SIZE and MAX_UPLOAD_REQUEST_SIZE while the upload is streaming in.
+    The upload is stopped at the first chunk over a limit and the reason is stored on the
+    request as `upload_limit_error`, so views can answer with 413.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.file_size = 0
+        self.request_size = 0
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file_size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file_size += len(raw_data)
+        self.request_size += len(raw_data)
+        if self.file_size > settings.MAX_UPLOAD_FILE_SIZE:
+            self.abort(f"File {self.file_name} exceeds the maximum size of {settings.MAX_UPLOAD_FILE_SIZE} bytes.")
+        if self.request_size > settings.MAX_UPLOAD_REQUEST_SIZE:
+            self.abort(f"Uploaded files exceed the maximum total size of {settings.MAX_UPLOAD_REQUEST_SIZE} bytes.")
+        return raw_data
+
+    def file_complete(self, file_size):
+        # Let the following handlers build the uploaded file
+        return None
+
+    def abort(self, message):
+        logger.error(message)
+        if self.request is not None:
+            self.request.upload_limit_error = message
+        # Drain the rest of the request body without storing it, so that a 413 can still be returned
+        raise StopUpload(connection_reset=False)
@@ -1,6 +1,16 @@
 from django.urls import path
-from .views import RunProgramView
+from .views import (
+    BatchView, JobListView, JobResultView, JobStatusView, PipelineDetailView, PipelineListView, PipelineRunView,
+    RunProgramView,
+)
 
 urlpatterns = [
     path('run-program/', RunProgramView.as_view(), name='run-program'),
+    path('batch/', BatchView.as_view(), name='batch'),
+    path('jobs/', JobListView.as_view(), name='job-list'),
+    path('jobs/<int:process_id>/', JobStatusView.as_view(), name='job-status'),
+    path('jobs/<int:process_id>/result/', JobResultView.as_view(), name='job-result'),
+    path('pipelines/', PipelineListView.as_view(), name='pipeline-list'),
+    path('pipelines/<int:pipeline_id>/', PipelineDetailView.as_view(), name='pipeline-detail'),
+    path('pipelines/<int:pipeline_id>/run/', PipelineRunView.as_view(), name='pipeline-run'),
 ]
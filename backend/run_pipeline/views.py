@@ -1,55 +1,74 @@
-from pathlib import Path
+from contextlib import ExitStack
+from functools import partial
+from django.conf import settings
 from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-import tempfile
 import logging
-import shutil
-import os
-import pandas as pd
-from docx import Document
-from openpyxl import load_workbook
-from pptx import Presentation
-from PyPDF2 import PdfReader
-
-from services.openai_client import OpenAIClient
-from services.groq_client import GroqApiClient
-from services.podman_executor import PodmanExecutor
+
+from services import metrics
+from services.workspace import Workspace
+
+from .batch import batch_entries, cleanup as cleanup_batch, collect_groups, run_batch
+from .downloads import create_download_response, create_zip_response
+from .jobs import job_result_directory, submit_job, worker_id
+from .models import FileUpload, Pipeline, UploadProcess
+from .pipeline import ProgramPipeline, get_executor
+from .pipeline_store import input_names_mismatch, matching_version, save_pipeline_version, select_version
+from .previews import generate_input_files_description
+from .serializers import PipelineDetailSerializer, PipelineSerializer, UploadProcessSerializer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def set_pipeline_headers(response, version):
+    """Tell the client which saved pipeline version produced the response."""
+    response['X-Pipeline-Id'] = str(version.pipeline_id)
+    response['X-Pipeline-Version'] = str(version.version)
+
+
 class RunProgramView(APIView):
-    # Class attribute for PodmanExecutor (Singleton pattern)
-    podman_executor = None
+    # Class attribute for the executor of the EXECUTOR_BACKEND (Singleton pattern)
+    executor = None
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        # Initialize PodmanExecutor once for the whole class
-        if RunProgramView.podman_executor is None:
-            logger.info("Initializing PodmanExecutor for the first time.")
-            RunProgramView.podman_executor = PodmanExecutor()
+        # Initialize the executor once for the whole class
+        if RunProgramView.executor is None:
+            RunProgramView.executor = get_executor()
         else:
-            logger.info("Reusing existing PodmanExecutor instance.")
+            logger.info("Reusing existing executor instance.")
 
     def post(self, request, *args, **kwargs):
         logger.info("Starting the post request for RunProgramView.")
         
-        # Create a temporary directory for the upload process
-        logger.info("Creating a temporary directory.")
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_directory = Path(temp_dir)
-            logger.info(f"Temporary directory created at: {temp_directory}")
-
-            # Create an output directory within the temporary directory
-            output_directory = temp_directory / "output"
-            output_directory.mkdir(parents=True, exist_ok=True)  # Create output directory
+        # Create a workspace for the upload process below the workspace root,
+        # so that the pooled containers can see it
+        logger.info("Creating a workspace.")
+        with ExitStack() as stack:
+            workspace = Workspace()
+            stack.callback(workspace.cleanup)
+            temp_directory = workspace.directory
+            logger.info(f"Workspace created at: {temp_directory}")
+
+            # The output directory lives apart from the inputs, the sandbox may only write there
+            output_directory = workspace.output_directory
             logger.info(f"Output directory created at: {output_directory}")
 
             # Handle file uploads
-            uploaded_files = self.handle_file_uploads(request.FILES.getlist('files'), temp_directory)
+            with metrics.span('upload') as upload_span:
+                files = request.FILES.getlist('files')
+                limit_error = getattr(request, 'upload_limit_error', None)
+                if limit_error:
+                    return Response({"error": limit_error}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+                uploaded_files = self.handle_file_uploads(files, workspace)
+                upload_span.attributes.update(files=len(files), input_bytes=sum(file.size for file in files))
+
             if not uploaded_files:
                 logger.error("No files uploaded.")
                 return Response({"error": "No files uploaded."}, status=status.HTTP_400_BAD_REQUEST)
@@ -57,7 +76,7 @@ class RunProgramView(APIView):
             logger.info(f"Uploaded files: {uploaded_files}")
 
             # Generate the input files description based on the uploaded files
-            input_files_description = self.generate_input_files_description(uploaded_files, temp_directory, 16)
+            input_files_description = generate_input_files_description(uploaded_files, temp_directory, 16)
             
             # Check if there's any description generated
             if not input_files_description:
@@ -69,182 +88,215 @@ class RunProgramView(APIView):
             if not instruction:
                 logger.error("Instruction is required.")
                 return Response({"error": "Instruction is required"}, status=status.HTTP_400_BAD_REQUEST)
-            
-            # openai_client = OpenAIClient()
-            # generated_code = openai_client.generate_python_code(input_files_description, instruction)
 
-            groq_client = GroqApiClient()
-            generated_code = groq_client.generate_python_code(input_files_description, instruction)
+            # Generate the Python code, execute it and fix it on failure
+            pipeline = ProgramPipeline(RunProgramView.executor)
+            execution_successfull, logs = pipeline.run(temp_directory, input_files_description, instruction)
 
-            code_file_path = self.save_generated_code(generated_code, temp_directory)
-            logger.info(f"Generated code saved to: {code_file_path}")
+            if not execution_successfull:  # Check if there's an error
+                return Response(logs, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            # Execute the generated Python script using the class-level PodmanExecutor
-            logger.info("Executing the generated Python script.")
-            execution_successfull, logs = RunProgramView.podman_executor.execute_script(temp_directory)
+            # Keep the working code, so that the next run of the instruction can skip the LLM
+            version = save_pipeline_version(
+                instruction, input_files_description, (temp_directory / "main.py").read_text(), uploaded_files
+            )
+
+            # Stream the output directory as a response, which removes the workspace once it is sent
+            logger.info("Creating download response of the output directory.")
+            with metrics.span('response'):
+                response = create_download_response(output_directory, request, cleanup=workspace.cleanup)
+            if version is not None:
+                set_pipeline_headers(response, version)
+            stack.pop_all()
+            return response
 
-            
-            if not execution_successfull:
-                print('--- error logs ---\n')
-                print(logs)
-                print('--- error logs ---\n')
-                number_of_generation_retries = 2
-                logs = ""
-                for _ in range(number_of_generation_retries):
-                    # Execute the generated Python script
-                    generated_code = groq_client.fix_generated_code(generated_code, logs)
-                    code_file_path = self.save_generated_code(generated_code, temp_directory)
-                    execution_successfull, logs = RunProgramView.podman_executor.execute_script(temp_directory)
-                    if execution_successfull:
-                        break
-                    else:
-                        print('--- error logs ---\n')
-                        print(logs)
-                        print('--- error logs ---\n')
-            
+    def handle_file_uploads(self, files, workspace):
+        """Handle file uploads and save them to the workspace."""
+        uploaded_files = []
+        for file in files:
+            # Uploads Django spooled to disk are linked, smaller ones are written chunk by chunk
+            workspace.save_upload(file)
+            uploaded_files.append(file.name)  # Save file name directly
+        return uploaded_files
 
-            if not execution_successfull:  # Check if there's an error
-                logger.error("Execution of the Python script failed.")
-                return Response(logs, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            logger.info("Execution of the Python script successful.")
+class JobListView(APIView):
+    """Submit a job: store the uploads and return immediately, the program runs in the background."""
 
-            # Create a zip file of the output directory and return it as a response
-            logger.info("Creating zip response of the output directory.")
-            return self.create_download_response(output_directory)  # Pass the output directory
+    def post(self, request, *args, **kwargs):
+        files = request.FILES.getlist('files')
+        limit_error = getattr(request, 'upload_limit_error', None)
+        if limit_error:
+            return Response({"error": limit_error}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if not files:
+            logger.error("No files uploaded.")
+            return Response({"error": "No files uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+
+        instruction = request.data.get("instruction")
+        if not instruction:
+            logger.error("Instruction is required.")
+            return Response({"error": "Instruction is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        process = UploadProcess.objects.create(description=instruction, worker=worker_id())
+        for file in files:
+            FileUpload.objects.create(process=process, file=file)
+        submit_job(process)
 
-    def generate_input_files_description(self, uploaded_files, temp_directory, num_lines):
-        """
-        Generate a description string of the uploaded files, including their first few lines.
-        This handles both file objects (like UploadedFile) and file paths (str).
-        """
-        description = ""
+        serializer = UploadProcessSerializer(process, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED,
+                        headers={'Location': reverse('job-status', args=[process.process_id])})
 
-        for file in uploaded_files:
-            file_name = os.path.basename(file)
-            file_extension = os.path.splitext(file_name)[1].lower()
-            file_path = os.path.join(temp_directory, file_name)
 
-            description += f"{file_name}:\n\"\"\"\n"
-            first_lines = ""
+class JobStatusView(APIView):
+    """Poll the state of a submitted job."""
 
-            try:
-                # Handle different file types
-                if file_extension in ['.txt', '']:  # Text file or unknown extension defaults to text
-                    first_lines = self.read_text_file(open(file_path, 'rb'), num_lines)
-                elif file_extension == '.docx':  # Word file
-                    first_lines = self.read_word_file(open(file_path, 'rb'), num_lines)
-                elif file_extension == '.xlsx':  # Excel file
-                    first_lines = self.read_excel_file(open(file_path, 'rb'), num_lines)
-                elif file_extension == '.pptx':  # PowerPoint file
-                    first_lines = self.read_ppt_file(open(file_path, 'rb'), num_lines)
-                elif file_extension == '.pdf':  # PDF file
-                    first_lines = self.read_pdf_file(open(file_path, 'rb'), num_lines)
-                else:
-                    first_lines = "Cannot read this file."  # Default to text file for unknown types
-
-                description += first_lines
-                description += "...\n\"\"\"\n\n"
-
-            except Exception as e:
-                logger.error(f"Error reading file {file_name}: {str(e)}")
-                description += f"Error reading file {file_name}\n\n"
-
-        return description
-
-    def read_text_file(self, file, num_lines):
-        """Read the first few lines of a text file."""
-        first_lines = ""
-        for i, line in enumerate(file):
-            first_lines += line.decode('utf-8')  # Assuming file encoding is UTF-8
-            if i >= num_lines - 1:  # Read up to the number of lines specified
-                break
-        return first_lines
-
-    def read_word_file(self, file, num_lines):
-        """Read the first few paragraphs of a Word (.docx) file."""
-        doc = Document(file)
-        first_paragraphs = '\n'.join([para.text for para in doc.paragraphs[:num_lines]])  # First num_lines paragraphs
-        return first_paragraphs
-
-    def read_excel_file(self, file, num_lines):
-        """Read the first few rows of an Excel (.xlsx) file."""
-        wb = load_workbook(file, read_only=True)
-        sheet = wb.active
-        first_rows = '\n'.join([str([cell.value for cell in row]) for row in sheet.iter_rows(min_row=1, max_row=num_lines)])  # First num_lines rows
-        return first_rows
-
-    def read_ppt_file(self, file, num_lines):
-        """Read the first few slides of a PowerPoint (.pptx) file."""
-        prs = Presentation(file)
-        first_slides = ""
-        for i, slide in enumerate(prs.slides):
-            slide_text = '\n'.join([shape.text for shape in slide.shapes if hasattr(shape, "text")])
-            first_slides += slide_text + '\n'
-            if i >= num_lines - 1:  # Read up to the number of slides specified
-                break
-        return first_slides
-
-    def read_pdf_file(self, file, num_lines):
-        """Read the first few pages of a PDF file."""
-        reader = PdfReader(file)
-        first_pages = ""
-        for i, page in enumerate(reader.pages):
-            first_pages += page.extract_text() + '\n'
-            if i >= num_lines - 1:  # Read up to the number of pages specified
-                break
-        return first_pages
-
-    def handle_file_uploads(self, files, temp_directory):
-        """Handle file uploads and save them to the temporary directory."""
-        uploaded_files = []
-        for file in files:
-            self.save_uploaded_file(file, temp_directory)
-            uploaded_files.append(file.name)  # Save file name directly
-        return uploaded_files
+    def get(self, request, process_id, *args, **kwargs):
+        process = get_object_or_404(UploadProcess, process_id=process_id)
+        serializer = UploadProcessSerializer(process, context={'request': request})
+        return Response(serializer.data)
 
-    def save_uploaded_file(self, file, temp_directory):
-        """Save the uploaded file in the temporary directory."""
-        file_path = temp_directory / file.name
-        with file_path.open('wb') as f:
-            f.write(file.read())
-
-    def save_generated_code(self, generated_code, temp_directory):
-        """Save the generated code to a file in the temporary directory."""
-        code_file_path = temp_directory / "main.py"
-        with code_file_path.open('w') as f:
-            f.write(generated_code)
-        return code_file_path
-    
-    def create_download_response(self, output_directory):
-        """Create a zip file of the output directory and return it as a response."""
-        zip_filename = f"output.zip"
-        zip_file_path = output_directory.parent / zip_filename  # Store zip file at the temp directory level
-
-        # Get the list of files in the output directory
-        files = os.listdir(output_directory)
-        
-        # Check if there is exactly one file in the directory
-        if len(files) == 1:
-            # Return the single file directly
-            single_file_path = output_directory / files[0]
-            with open(single_file_path, 'rb') as single_file:
-                response = HttpResponse(single_file.read(), content_type='application/octet-stream')
-                response['Content-Disposition'] = f'attachment; filename="{files[0]}"'
-                logger.info(f"Returning single file: {files[0]}")
+
+class JobResultView(APIView):
+    """Download the outputs of a job once it succeeded."""
+
+    def get(self, request, process_id, *args, **kwargs):
+        process = get_object_or_404(UploadProcess, process_id=process_id)
+        if not process.is_finished:
+            return Response({"error": "Job is not finished yet.", "status": process.status}, status=status.HTTP_409_CONFLICT)
+        if process.status == UploadProcess.FAILED:
+            return Response({"error": "Job failed.", "logs": process.logs}, status=status.HTTP_410_GONE)
+        return create_download_response(job_result_directory(process.process_id), request)
+
+
+class BatchView(APIView):
+    """
+    Apply one instruction to many input groups, given as `group.<name>` fields or one group per file
+    of `files`. The code is generated on the first group and run on the others in parallel. Returns
+    a zip with the outputs of each group in its own directory and a report.json of all groups.
+    """
+
+    def post(self, request, *args, **kwargs):
+        # Parsing the upload sets the size limit error
+        files = request.FILES
+        limit_error = getattr(request, 'upload_limit_error', None)
+        if limit_error:
+            return Response({"error": limit_error}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        instruction = request.data.get("instruction")
+        if not instruction:
+            logger.error("Instruction is required.")
+            return Response({"error": "Instruction is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        items = collect_groups(files)
+        if not items:
+            logger.error("No files uploaded.")
+            return Response({"error": "No files uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.BATCH_MAX_GROUPS:
+            return Response({"error": f"At most {settings.BATCH_MAX_GROUPS} input groups are allowed."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        with ExitStack() as stack:
+            stack.callback(cleanup_batch, items)
+            version = run_batch(items, instruction, get_executor())
+            if not items[0].success:
+                return Response({
+                    "error": f"No working code could be generated on the first input group {items[0].name}.",
+                    "logs": items[0].logs,
+                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            # The workspaces are removed once the archive is sent
+            with metrics.span('response'):
+                response = create_zip_response(
+                    batch_entries(items, instruction, version), "batch.zip", partial(cleanup_batch, items)
+                )
+            if version is not None:
+                set_pipeline_headers(response, version)
+            stack.pop_all()
             return response
-        elif len(files) > 1:
-            # Create a zip file from the output directory
-            shutil.make_archive(zip_file_path.with_suffix(''), 'zip', str(output_directory))
-            logger.info(f"Created zip file at: {zip_file_path}")
-
-            # Prepare the zip file for download
-            with open(zip_file_path, 'rb') as zip_file:
-                response = HttpResponse(zip_file.read(), content_type='application/zip')
-                response['Content-Disposition'] = f'attachment; filename="{zip_filename}"'
-                logger.info(f"Returning zip file: {zip_filename}")
+
+
+class PipelineListView(APIView):
+    """List the saved pipelines."""
+
+    def get(self, request, *args, **kwargs):
+        pipelines = Pipeline.objects.order_by('-created_at')
+        return Response(PipelineSerializer(pipelines, many=True, context={'request': request}).data)
+
+
+class PipelineDetailView(APIView):
+    """Show a saved pipeline with the code of all its versions."""
+
+    def get(self, request, pipeline_id, *args, **kwargs):
+        pipeline = get_object_or_404(Pipeline, pipeline_id=pipeline_id)
+        return Response(PipelineDetailSerializer(pipeline, context={'request': request}).data)
+
+
+class PipelineRunView(APIView):
+    """
+    Run a saved pipeline on new input files. Its code goes straight to the executor without any LLM call.
+    The uploads are linked onto the input names the code reads, in upload order. The `version` to run
+    can be given, by default the latest version generated for inputs of the same structure is run, else
+    the latest version the uploads fit.
+    """
+
+    def post(self, request, pipeline_id, *args, **kwargs):
+        pipeline = get_object_or_404(Pipeline, pipeline_id=pipeline_id)
+        files = request.FILES.getlist('files')
+        limit_error = getattr(request, 'upload_limit_error', None)
+        if limit_error:
+            return Response({"error": limit_error}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if not files:
+            logger.error("No files uploaded.")
+            return Response({"error": "No files uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+
+        requested_version = request.data.get("version")
+        if requested_version is not None:
+            try:
+                requested_version = int(requested_version)
+            except ValueError:
+                return Response({"error": "The version must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+
+        names = [file.name for file in files]
+        version = select_version(pipeline, names, requested_version)
+        if version is None:
+            return Response({"error": "Pipeline version not found."}, status=status.HTTP_404_NOT_FOUND)
+        mismatch = input_names_mismatch(version, names)
+        if mismatch:
+            return Response({"error": mismatch}, status=status.HTTP_400_BAD_REQUEST)
+
+        with ExitStack() as stack:
+            workspace = Workspace()
+            stack.callback(workspace.cleanup)
+            # Versions saved before the input names were kept read the uploads under their own names
+            input_names = version.input_names or names
+            with metrics.span('upload') as upload_span:
+                for file, name in zip(files, input_names):
+                    workspace.save_upload(file, name)
+                upload_span.attributes.update(files=len(files), input_bytes=sum(file.size for file in files))
+
+            # The previews are only needed to pick the version matching the structure of the inputs
+            if requested_version is None:
+                version = matching_version(
+                    version, generate_input_files_description(input_names, workspace.directory, 16)
+                )
+
+            logger.info(f"Running version {version.version} of pipeline {pipeline.pipeline_id}.")
+            # Saved code ran successfully before, the heuristic pre-flight check could only reject it wrongly
+            execution_successfull, logs = ProgramPipeline(get_executor()).execute(
+                version.code, workspace.directory, check=False
+            )
+            if not execution_successfull:
+                return Response(logs, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            with metrics.span('response'):
+                response = create_download_response(workspace.output_directory, request, cleanup=workspace.cleanup)
+            set_pipeline_headers(response, version)
+            stack.pop_all()
             return response
-        else:
-            # Optionally handle the case where there are no files
-            logger.warning("No files found in the output directory.")
-            return HttpResponse("No files available for download.", status=404)
+
+
+class MetricsView(APIView):
+    """Aggregated stage timings and counters in the Prometheus text format."""
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,4 +1,6 @@
-from .openai_client import OpenAIClient
+from .groq_client import GroqApiClient, get_groq_client
+from .openai_client import OpenAIClient, get_openai_client
+from .executor import Executor
 from .podman_executor import PodmanExecutor
 
-__all__ = ['OpenAIClient', 'PodmanExecutor']
\ No newline at end of file
+__all__ = ['Executor', 'GroqApiClient', 'OpenAIClient', 'PodmanExecutor', 'get_groq_client', 'get_openai_client']
\ No newline at end of file
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# A file's section of the input files description, see PromptBuilder and the preview readers
+DESCRIPTION_SECTION_PATTERN = re.compile(r'^(?P<name>[^\n]+):\n"""\n(?P<body>.*?)\.\.\.\n"""\n', re.M | re.S)
+COLUMNS_PATTERN = re.compile(r'^Columns \(\d+\):$')
+SHEET_PATTERN = re.compile(r"^Sheet '(?P<name>.*)' \(.*\), header: (?P<header>.*)$")
+OBJECT_KEY_PATTERN = re.compile(r'^  (?P<key>.+?): (?P<type>\w+) = ')
+
+_code_cache = None
+_code_cache_lock = threading.Lock()
+
+
+def get_code_cache():
+    """Return the process-wide cache of generated code."""
+    global _code_cache
+    with _code_cache_lock:
+        if _code_cache is None:
+            _code_cache = CodeCache(settings.CODE_CACHE_MAX_ENTRIES, settings.CODE_CACHE_TTL)
+            metrics.register_cache('code_cache', 'generated code cache', _code_cache.stats)
+        return _code_cache
+
+
+def normalize_instruction(instruction):
+    """Ignore case and whitespace differences between instructions."""
+    return ' '.join(instruction.lower().split())
+
+
+def input_structure(input_files_description):
+    """
+    The structure of the input files in their description: the file names, the columns and types of
+    tables, the sheets and header rows of workbooks and the keys and types of JSON objects. Row counts
+    and sample rows are left out. The previews of files without such a structure, like texts and
+    documents, are kept whole, the code may depend on their content.
+    """
+    sections = list(DESCRIPTION_SECTION_PATTERN.finditer(input_files_description))
+    if not sections:
+        # Not built by the PromptBuilder, the whole description counts
+        return input_files_description
+
+    lines = []
+    for section in sections:
+        # Generated code opens the files by their exact names
+        lines.append(section['name'])
+        structure = []
+        in_columns = False
+        for line in section['body'].splitlines():
+            if COLUMNS_PATTERN.match(line):
+                in_columns = True
+            elif not line.startswith('  '):
+                in_columns = False
+                sheet = SHEET_PATTERN.match(line)
+                if sheet is not None:
+                    structure.append(f"sheet {sheet['name']}: {sheet['header']}")
+            elif in_columns:
+                structure.append(line.strip())
+            else:
+                key = OBJECT_KEY_PATTERN.match(line)
+                if key is not None:
+                    structure.append(f"{key['key']}: {key['type']}")
+        lines.extend(structure or [section['body'].rstrip('\n')])
+    return '\n'.join(lines)
+
+
+def input_fingerprint(input_files_description):
+    """
+    Fingerprint the structure of the input files, so that files of the same names and columns but
+    other row counts or values, like a daily export, get the same fingerprint.
+    """
+    return hashlib.sha256(input_structure(input_files_description).encode()).hexdigest()
+
+
+class CodeCache:
+    """In-memory cache of generated code that ran successfully, with TTL and LRU eviction."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(instruction, input_files_description):
+        text = f"{normalize_instruction(instruction)}\0{input_fingerprint(input_files_description)}"
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached code or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, code):
+        """Store code that ran successfully."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (code, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
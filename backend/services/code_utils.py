@@ -0,0 +1,71 @@
+import ast
+import re
+import traceback
+
+# Python version of the sandbox image (podman-image/Dockerfile), newer syntax would fail there
+SANDBOX_PYTHON_VERSION = (3, 9)
+
+# The opening fence of a Markdown code block, optionally tagged with the language
+OPENING_FENCE_PATTERN = re.compile(r"```[ \t]*(?:(?:python3?|py)\b)?[ \t]*\n?", re.I)
+
+# A closing fence at the start of a line; "```" inside the code, like in a string literal, is not one
+CLOSING_FENCE_PATTERN = re.compile(r"^[ \t]*```", re.M)
+
+# A closing fence right after the last line of code, like in "print(1)```"
+TRAILING_FENCE_PATTERN = re.compile(r"```[ \t]*$", re.M)
+
+
+def extract_code(content):
+    """
+    Extract the Python code from an LLM response, with or without a Markdown code fence.
+    The closing fence may be missing or follow the last line of code directly.
+    """
+    opening = OPENING_FENCE_PATTERN.search(content)
+    if opening is None:
+        return content.strip().strip("`").strip()
+    code = content[opening.end():]
+    closing = CLOSING_FENCE_PATTERN.search(code)
+    if closing is None:
+        closing = TRAILING_FENCE_PATTERN.search(code)
+    if closing is not None:
+        code = code[:closing.start()]
+    return code.strip()
+
+
+def syntax_error(code, filename="main.py"):
+    """Parse and compile the code and return the error as a traceback-like message, or None if it is valid."""
+    try:
+        tree = ast.parse(code, filename=filename, feature_version=SANDBOX_PYTHON_VERSION)
+        compile(tree, filename, "exec")
+    except (SyntaxError, ValueError) as e:
+        return ''.join(traceback.format_exception_only(type(e), e))
+    return None
+
+
+class CodeStreamCollector:
+    """
+    Accumulate a streamed LLM response. Once a fenced code block has been closed by a fence
+    at the start of a line, the rest of the response is only prose and the stream can be stopped early.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._complete = False
+
+    def feed(self, delta):
+        """Add a streamed piece of the response and return True once the code block is complete."""
+        if not delta:
+            return False
+        self._parts.append(delta)
+        if "`" in delta and not self._complete:
+            text = self.text()
+            opening = OPENING_FENCE_PATTERN.search(text)
+            self._complete = (
+                opening is not None
+                and text[opening.end() - 1:opening.end()] == "\n"
+                and CLOSING_FENCE_PATTERN.search(text, opening.end()) is not None
+            )
+        return self._complete
+
+    def text(self):
+        return ''.join(self._parts)
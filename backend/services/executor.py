@@ -0,0 +1,262 @@
+import collections
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks whether a running job was cancelled or passed its deadline
+CANCEL_POLL_INTERVAL = 0.1
+
+# Why a sandbox run ended
+EXIT_SUCCESS = "success"
+EXIT_ERROR = "error"
+EXIT_TIMEOUT = "timeout"
+EXIT_CPU_LIMIT = "cpu_limit"
+EXIT_MEMORY_LIMIT = "memory_limit"
+EXIT_CANCELLED = "cancelled"
+EXIT_SANDBOX_ERROR = "sandbox_error"
+
+# Last line the job wrapper writes to stderr, with the peak memory of the program in KiB
+PEAK_MEMORY_MARKER = "__adp_peak_memory_kib="
+
+# Runs main.py with a CPU time limit and reports its peak memory; passed to `python -c` in the sandbox
+JOB_WRAPPER = f"""
+import resource, subprocess, sys
+limit = int(sys.argv[1])
+def limit_cpu_time():
+    if limit > 0:
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, limit + 1))
+code = subprocess.call([sys.executable, "main.py"], preexec_fn=limit_cpu_time)
+sys.stderr.write("\\n{PEAK_MEMORY_MARKER}%d\\n" % resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+sys.exit(128 - code if code < 0 else code)
+"""
+
+
+class ExecutionResult:
+    """
+    Outcome of a sandbox run: why it ended, how long it took and the peak memory of the program
+    in bytes (None if unknown). Unpacks to (success, logs) like the other pipeline steps.
+    """
+
+    def __init__(self, success, logs, exit_reason, elapsed=0.0, peak_memory=None):
+        self.success = success
+        self.logs = logs
+        self.exit_reason = exit_reason
+        self.elapsed = elapsed
+        self.peak_memory = peak_memory
+
+    def __iter__(self):
+        return iter((self.success, self.logs))
+
+    def __repr__(self):
+        return (
+            f"ExecutionResult(success={self.success}, exit_reason={self.exit_reason!r}, "
+            f"elapsed={self.elapsed:.2f}, peak_memory={self.peak_memory})"
+        )
+
+
+def split_peak_memory(stderr):
+    """Remove the wrapper's peak memory line from the error output and return (stderr, peak memory in bytes)."""
+    head, marker, tail = stderr.rpartition(PEAK_MEMORY_MARKER)
+    if not marker:
+        return stderr, None
+    try:
+        peak_memory = int(tail.strip()) * 1024
+    except ValueError:
+        return stderr, None
+    return head.rstrip("\n"), peak_memory
+
+
+def job_command(python="python"):
+    """Command running main.py with the CPU time limit."""
+    return [python, "-c", JOB_WRAPPER, str(settings.PODMAN_CPU_TIME_LIMIT or 0)]
+
+
+def run_job(command, cancel_event=None, on_kill=None, cwd=None, process_group=False):
+    """
+    Run a job's command until it exits, passes the wall-clock limit (PODMAN_TIMEOUT) or is cancelled.
+    With `process_group`, the command gets its own process group which is killed as a whole.
+    Returns (returncode, stdout, stderr, stop_reason, elapsed), the stop reason is None if it exited.
+    """
+    start = time.monotonic()
+    deadline = start + settings.PODMAN_TIMEOUT if settings.PODMAN_TIMEOUT else None
+    poll = cancel_event is not None or deadline is not None
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, start_new_session=process_group
+    )
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=CANCEL_POLL_INTERVAL if poll else None)
+            return process.returncode, stdout, stderr, None, time.monotonic() - start
+        except subprocess.TimeoutExpired:
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = EXIT_CANCELLED
+            elif deadline is not None and time.monotonic() >= deadline:
+                stop_reason = EXIT_TIMEOUT
+            else:
+                continue
+        elapsed = time.monotonic() - start
+        # Killing the podman client alone would leave the job running inside the container
+        if on_kill is not None:
+            on_kill()
+        if process_group:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout, stderr, stop_reason, elapsed
+
+
+def job_result(returncode, stdout, stderr, stop_reason, elapsed):
+    """Interpret how a job ended as an ExecutionResult."""
+    stderr, peak_memory = split_peak_memory(stderr.decode(errors="replace") if stderr else "")
+
+    def result(success, logs, exit_reason):
+        return ExecutionResult(success, logs, exit_reason, elapsed, peak_memory)
+
+    if stop_reason == EXIT_CANCELLED:
+        return result(False, "Execution cancelled.", EXIT_CANCELLED)
+    if stop_reason == EXIT_TIMEOUT:
+        return result(False, (
+            f"The program was killed after running for {elapsed:.0f} seconds, "
+            f"it must finish within {settings.PODMAN_TIMEOUT} seconds.\n{stderr}"
+        ), EXIT_TIMEOUT)
+    if returncode == 0:
+        return result(True, stdout.decode(errors="replace"), EXIT_SUCCESS)
+    # Exit codes 125-127 come from podman itself
+    if returncode in (125, 126, 127):
+        return result(False, stderr or "No error output", EXIT_SANDBOX_ERROR)
+    if returncode == 128 + signal.SIGXCPU:
+        return result(False, (
+            f"The program was killed because it used more than {settings.PODMAN_CPU_TIME_LIMIT} "
+            f"seconds of CPU time.\n{stderr}"
+        ), EXIT_CPU_LIMIT)
+    if returncode == 128 + signal.SIGKILL:
+        return result(False, (
+            f"The program was killed, most likely because it used more than {settings.PODMAN_MEMORY} "
+            f"of memory.\n{stderr}"
+        ), EXIT_MEMORY_LIMIT)
+    return result(False, stderr or "No error output", EXIT_ERROR)
+
+
+class ExecutionScheduler:
+    """Admit at most `max_concurrency` jobs at once; waiting jobs are admitted in FIFO order."""
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._waiting = collections.deque()
+        self._running = 0
+        self._admitted = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._finished = 0
+        self._total_run_time = 0.0
+        self._max_peak_memory = 0
+        self._exit_reasons = collections.Counter()
+
+    @contextmanager
+    def slot(self):
+        """Block until the job may run; yields the time it waited in the queue."""
+        ticket = threading.Event()
+        enqueued_at = time.monotonic()
+        with self._lock:
+            if self._running < self.max_concurrency and not self._waiting:
+                self._running += 1
+                ticket.set()
+            else:
+                self._waiting.append(ticket)
+                logger.info(f"Job queued for execution, queue depth: {len(self._waiting)}")
+        ticket.wait()
+
+        wait_time = time.monotonic() - enqueued_at
+        with self._lock:
+            self._admitted += 1
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+        if wait_time > 0.01:
+            logger.info(f"Job admitted after waiting {wait_time:.2f}s")
+
+        try:
+            yield wait_time
+        finally:
+            with self._lock:
+                if self._waiting:
+                    # Hand the slot directly to the oldest waiting job
+                    self._waiting.popleft().set()
+                else:
+                    self._running -= 1
+
+    def record(self, result):
+        """Account for the ExecutionResult of a finished job."""
+        with self._lock:
+            self._finished += 1
+            self._total_run_time += result.elapsed
+            self._max_peak_memory = max(self._max_peak_memory, result.peak_memory or 0)
+            self._exit_reasons[result.exit_reason] += 1
+
+    def stats(self):
+        """Return the current queue depth, running jobs, wait and run times and why jobs ended."""
+        with self._lock:
+            return {
+                "queue_depth": len(self._waiting),
+                "running": self._running,
+                "max_concurrency": self.max_concurrency,
+                "admitted": self._admitted,
+                "average_wait_time": self._total_wait_time / self._admitted if self._admitted else 0.0,
+                "max_wait_time": self._max_wait_time,
+                "finished": self._finished,
+                "average_run_time": self._total_run_time / self._finished if self._finished else 0.0,
+                "max_peak_memory": self._max_peak_memory,
+                "exit_reasons": dict(self._exit_reasons),
+            }
+
+
+class Executor:
+    """
+    Interface of the backends running the generated code, selected with the EXECUTOR_BACKEND setting.
+    A backend runs main.py of a job directory, writing to its output directory, and returns an ExecutionResult.
+    Jobs are admitted by the scheduler, at most SANDBOX_MAX_CONCURRENCY at once.
+    """
+
+    def __init__(self):
+        self.scheduler = ExecutionScheduler(settings.SANDBOX_MAX_CONCURRENCY or os.cpu_count() or 1)
+        metrics.register_collector(self.collect_metrics)
+
+    def warm_up(self):
+        """Prepare the backend for the first job, without blocking the caller."""
+
+    def execute_script(self, shared_directory, cancel_event=None, packages=None):
+        """
+        Run main.py of the shared directory and return an ExecutionResult, which unpacks to (success, logs).
+        `packages` are the distributions the code imports, None if unknown. Setting the optional
+        cancel_event stops the running job.
+        """
+        raise NotImplementedError
+
+    def shutdown(self):
+        """Release the resources held by the backend."""
+
+    def gauges(self):
+        """(name, documentation, value) of the gauges the backend exports."""
+        stats = self.scheduler.stats()
+        return [
+            ("adp_sandbox_queue_depth", "Jobs waiting for a sandbox slot.", stats["queue_depth"]),
+            ("adp_sandbox_running", "Jobs running in the sandbox.", stats["running"]),
+            ("adp_sandbox_max_concurrency", "Jobs that may run in the sandbox at once.", stats["max_concurrency"]),
+        ]
+
+    def collect_metrics(self):
+        """Gauges of the backend for the metrics endpoint."""
+        lines = []
+        for name, documentation, value in self.gauges():
+            lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return lines
@@ -1,95 +1,217 @@
+import asyncio
 import logging
-from groq import Groq
+import threading
+import groq
+from groq import AsyncGroq, Groq
 from django.conf import settings
 
+from . import metrics
+from .code_utils import CodeStreamCollector, extract_code
+from .llm_retry import RetryPolicy, connection_limits
+
 
 logger = logging.getLogger(__name__)
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_groq_client():
+    """Return the process-wide GroqApiClient, whose HTTP connections are reused across requests."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GroqApiClient()
+        return _client
+
+
 class GroqApiClient:
     def __init__(self):
-        self.client = Groq(api_key=settings.GROQ_API_KEY)
+        self.client = Groq(
+            api_key=settings.GROQ_API_KEY,
+            base_url=settings.GROQ_BASE_URL,
+            timeout=settings.LLM_TIMEOUT,
+            max_retries=0,  # Retries are done by the RetryPolicy
+            http_client=groq.DefaultHttpxClient(limits=connection_limits()),
+        )
         self.model = 'llama-3.3-70b-versatile'
+        self.retry_policy = RetryPolicy(groq.APIStatusError, groq.APIConnectionError, provider='groq')
+        self._async_client = None
+        self._async_client_loop = None
 
-    def generate_python_code(self, input_files_description, instruction):
-        """Generate Python code using the specified model."""
-        logger.info("Generating Python code.")
-        
-        chat_completion = self.client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"""
-                        You are a machine that only generates Python code without any comments or explanations.
-                        Write all processed files in the code you generate in the directory 'output/'.
-                        If the instruction is to create a website, write a python program that writes an HTML file.
-                        The input files are: {input_files_description}.
-                        Use those descriptions to understand their contents structure.
-                        ALWAYS READ THE DATA FROM THE ACTUAL FILES!
-                        ALWAYS WRITE ONE OR MULTIPLE OUTPUT FILES IN THE 'output/' DIRECTORY.
-                        Only output valid python code without any comments or explanations.
-                        The description of the python code to generate is will be provided in the next message.
-                    """
-                },
-                {
-                    "role": "user",
-                    "content": instruction
-                }
-            ],
+    @property
+    def async_client(self):
+        """AsyncGroq client of the running event loop, its pooled connections cannot be shared across loops."""
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            self._async_client = AsyncGroq(
+                api_key=settings.GROQ_API_KEY,
+                base_url=settings.GROQ_BASE_URL,
+                timeout=settings.LLM_TIMEOUT,
+                max_retries=0,
+                http_client=groq.DefaultAsyncHttpxClient(limits=connection_limits()),
+            )
+            self._async_client_loop = loop
+        return self._async_client
+
+    def _complete(self, messages):
+        chat_completion = self.retry_policy.call(
+            self.client.chat.completions.create,
+            messages=messages,
             model=self.model,  # Specify the model
         )
-        
-        generated_code = chat_completion.choices[0].message.content.strip()
-        generated_code = generated_code.strip("`").replace("python", "").strip()
-        return generated_code
+        return chat_completion.choices[0].message.content
+
+    async def _acomplete(self, messages):
+        chat_completion = await self.retry_policy.acall(
+            self.async_client.chat.completions.create,
+            messages=messages,
+            model=self.model,
+        )
+        return chat_completion.choices[0].message.content
+
+    def _stream_code(self, messages, temperature=None):
+        """Stream the completion and stop reading as soon as its code block is complete."""
+        stream = self.retry_policy.call(
+            self.client.chat.completions.create,
+            messages=messages,
+            model=self.model,
+            stream=True,
+            **({"temperature": temperature} if temperature is not None else {}),
+        )
+        collector = CodeStreamCollector()
+        try:
+            for chunk in stream:
+                if chunk.choices and collector.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            stream.close()
+        return extract_code(collector.text())
+
+    async def _astream_code(self, messages, temperature=None):
+        """Stream the completion without blocking the event loop, stopping once the code block is complete."""
+        stream = await self.retry_policy.acall(
+            self.async_client.chat.completions.create,
+            messages=messages,
+            model=self.model,
+            stream=True,
+            **({"temperature": temperature} if temperature is not None else {}),
+        )
+        collector = CodeStreamCollector()
+        try:
+            async for chunk in stream:
+                if chunk.choices and collector.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            await stream.close()
+        return extract_code(collector.text())
+
+    def _generation_messages(self, input_files_description, instruction):
+        return [
+            {
+                "role": "system",
+                "content": f"""
+                    You are a machine that only generates Python code without any comments or explanations.
+                    Write all processed files in the code you generate in the directory 'output/'.
+                    If the instruction is to create a website, write a python program that writes an HTML file.
+                    The input files are: {input_files_description}.
+                    Use those descriptions to understand their contents structure.
+                    ALWAYS READ THE DATA FROM THE ACTUAL FILES!
+                    ALWAYS WRITE ONE OR MULTIPLE OUTPUT FILES IN THE 'output/' DIRECTORY.
+                    Only output valid python code without any comments or explanations.
+                    The description of the python code to generate is will be provided in the next message.
+                """
+            },
+            {
+                "role": "user",
+                "content": instruction
+            }
+        ]
+
+    def _dependency_messages(self, generated_code):
+        return [
+            {
+                "role": "user",
+                "content": f"""
+                    You are a helpful assistant that lists Python package dependencies.
+                    List all dependencies required to run the following Python code: {generated_code}.
+                    Provide the output as a comma-separated list without any explanations or comments.
+                    Omit preinstalled packages. If there are no dependencies, return the word 'None'.
+                """
+            }
+        ]
+
+    def _fix_messages(self, generated_code, error_output):
+        return [
+            {
+                "role": "user",
+                "content": f"""
+                    You are an machine that generates Python code based on the old code and an error message.
+                    You can only output valid python code without any comments or explanations.
+                    The old python code and its error will be provided in the next message.
+                """
+            },
+            {
+                "role": "user",
+                "content": f"""
+                    The following Python code generated an error:\n\n{generated_code}\n\n
+                    The error message is:\n\n{error_output}\n\n
+                """
+            }
+        ]
+
+    def generate_python_code(self, input_files_description, instruction, temperature=None):
+        """Generate Python code using the specified model, at the model's default temperature unless given."""
+        logger.info("Generating Python code.")
+        messages = self._generation_messages(input_files_description, instruction)
+        with metrics.span('llm_generate', provider='groq'):
+            code = self._stream_code(messages, temperature)
+            metrics.count_llm_tokens('groq', messages, code)
+        return code
+
+    async def agenerate_python_code(self, input_files_description, instruction, temperature=None):
+        """Generate Python code without blocking the event loop."""
+        logger.info("Generating Python code.")
+        messages = self._generation_messages(input_files_description, instruction)
+        with metrics.span('llm_generate', provider='groq'):
+            code = await self._astream_code(messages, temperature)
+            metrics.count_llm_tokens('groq', messages, code)
+        return code
 
     def request_dependencies(self, generated_code):
         """Request to list dependencies required to run the generated code."""
         logger.info("Requesting dependencies.")
-        
-        chat_completion = self.client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""
-                        You are a helpful assistant that lists Python package dependencies.
-                        List all dependencies required to run the following Python code: {generated_code}. 
-                        Provide the output as a comma-separated list without any explanations or comments. 
-                        Omit preinstalled packages. If there are no dependencies, return the word 'None'.
-                    """
-                }
-            ],
-            model=self.model,
-        )
-        
-        dependencies = chat_completion.choices[0].message.content.strip().split(",")
+        messages = self._dependency_messages(generated_code)
+        with metrics.span('llm_dependencies', provider='groq'):
+            content = self._complete(messages)
+            metrics.count_llm_tokens('groq', messages, content)
+        dependencies = content.strip().split(",")
         return [dep.strip() for dep in dependencies if dep.strip()]  # Clean and return dependencies
 
+    async def arequest_dependencies(self, generated_code):
+        """Request to list dependencies without blocking the event loop."""
+        logger.info("Requesting dependencies.")
+        messages = self._dependency_messages(generated_code)
+        with metrics.span('llm_dependencies', provider='groq'):
+            content = await self._acomplete(messages)
+            metrics.count_llm_tokens('groq', messages, content)
+        dependencies = content.strip().split(",")
+        return [dep.strip() for dep in dependencies if dep.strip()]
+
     def fix_generated_code(self, generated_code, error_output):
         """Fix the generated Python code based on the error output."""
         logger.info("Requesting to fix Python code based on error output.")
-        
-        chat_completion = self.client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""
-                        You are an machine that generates Python code based on the old code and an error message.
-                        You can only output valid python code without any comments or explanations.
-                        The old python code and its error will be provided in the next message.
-                    """
-                },
-                {
-                    "role": "user",
-                    "content": f"""
-                        The following Python code generated an error:\n\n{generated_code}\n\n
-                        The error message is:\n\n{error_output}\n\n
-                    """
-                }
-            ],
-            model=self.model,
-        )
+        messages = self._fix_messages(generated_code, error_output)
+        with metrics.span('llm_fix', provider='groq'):
+            code = self._stream_code(messages)
+            metrics.count_llm_tokens('groq', messages, code)
+        return code
 
-        generated_code = chat_completion.choices[0].message.content.strip()
-        generated_code = generated_code.strip("`").replace("python", "").strip()
-        
-        return generated_code
\ No newline at end of file
+    async def afix_generated_code(self, generated_code, error_output):
+        """Fix the generated Python code without blocking the event loop."""
+        logger.info("Requesting to fix Python code based on error output.")
+        messages = self._fix_messages(generated_code, error_output)
+        with metrics.span('llm_fix', provider='groq'):
+            code = await self._astream_code(messages)
+            metrics.count_llm_tokens('groq', messages, code)
+        return code
@@ -0,0 +1,121 @@
+import asyncio
+import email.utils
+import logging
+import random
+import re
+import time
+import httpx
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: timeouts, lock conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Durations like "2m59.56s" or "120ms" used by the x-ratelimit-reset-* headers
+DURATION_PATTERN = re.compile(r'(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m(?!s))?(?:(\d+(?:\.\d+)?)s)?(?:(\d+(?:\.\d+)?)ms)?$')
+
+
+def connection_limits():
+    """Connection pool limits shared by the HTTP clients of the LLM providers."""
+    return httpx.Limits(
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_MAX_CONNECTIONS,
+    )
+
+
+def parse_duration(value):
+    """Parse a rate-limit reset duration like '1m30s' or '250ms' into seconds."""
+    match = DURATION_PATTERN.match(value.strip()) if value else None
+    if not match or not any(match.groups()):
+        return None
+    hours, minutes, seconds, milliseconds = (float(group or 0) for group in match.groups())
+    return hours * 3600 + minutes * 60 + seconds + milliseconds / 1000
+
+
+def server_requested_delay(headers):
+    """Seconds the server asked us to wait, from the retry-after or rate-limit reset headers."""
+    if headers is None:
+        return None
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        retry_after = headers['retry-after']
+        try:
+            return float(retry_after)
+        except ValueError:
+            date = email.utils.parsedate_to_datetime(retry_after) if retry_after else None
+            if date is not None:
+                return max(date.timestamp() - time.time(), 0)
+    resets = [
+        parse_duration(headers.get(name))
+        for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+        if headers.get(name)
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class RetryPolicy:
+    """Retry transient LLM API errors with jittered exponential backoff, honouring rate-limit headers."""
+
+    def __init__(self, status_error, connection_error, provider=''):
+        # Exception classes of the provider's SDK
+        self.status_error = status_error
+        self.connection_error = connection_error
+        self.provider = provider
+        self.max_retries = settings.LLM_MAX_RETRIES
+        self.backoff_base = settings.LLM_BACKOFF_BASE
+        self.backoff_max = settings.LLM_BACKOFF_MAX
+
+    def is_retryable(self, error):
+        if isinstance(error, self.connection_error):
+            return True
+        return isinstance(error, self.status_error) and error.status_code in RETRYABLE_STATUS_CODES
+
+    def delay(self, attempt, error):
+        """Seconds to wait before the next attempt."""
+        requested = server_requested_delay(getattr(getattr(error, 'response', None), 'headers', None))
+        if requested is not None:
+            # Add a little jitter so that waiting clients do not all come back at once
+            return min(requested, self.backoff_max) + random.uniform(0, self.backoff_base)
+        # Full jitter: uniformly between zero and the exponential backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _should_retry(self, attempt, error):
+        if attempt >= self.max_retries or not self.is_retryable(error):
+            return None
+        delay = self.delay(attempt, error)
+        logger.warning(f"LLM request failed ({error.__class__.__name__}), retrying in {delay:.2f}s.")
+        metrics.LLM_RETRIES.inc(provider=self.provider)
+        metrics.add_to_span('retries')
+        return delay
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                delay = self._should_retry(attempt, error)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return await function(*args, **kwargs)
+            except Exception as error:
+                delay = self._should_retry(attempt, error)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
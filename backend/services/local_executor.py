@@ -0,0 +1,31 @@
+import logging
+import sys
+from pathlib import Path
+
+from . import metrics
+from .executor import EXIT_CANCELLED, ExecutionResult, Executor, job_command, job_result, run_job
+
+logger = logging.getLogger(__name__)
+
+
+class LocalExecutor(Executor):
+    """
+    Run the generated code in a local subprocess with the host's Python instead of a container.
+    It applies the same time and CPU limits, but does NOT isolate the code: only use it for
+    benchmarks and development with trusted, canned code.
+    """
+
+    def execute_script(self, shared_directory, cancel_event=None, packages=None):
+        """Run main.py of the shared directory with the host's Python; the packages are not checked."""
+        shared_directory = Path(shared_directory).resolve()
+        with self.scheduler.slot() as wait_time:
+            metrics.record("sandbox_queue", wait_time)
+            if cancel_event is not None and cancel_event.is_set():
+                return ExecutionResult(False, "Execution cancelled.", EXIT_CANCELLED)
+            result = job_result(*run_job(
+                job_command(sys.executable), cancel_event, cwd=shared_directory, process_group=True
+            ))
+
+        self.scheduler.record(result)
+        metrics.record_sandbox_run(result, backend="local")
+        return result
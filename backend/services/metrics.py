@@ -0,0 +1,245 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from .prompt_builder import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets of stage durations in seconds, from preview cache hits to slow container runs
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Histogram buckets of sizes in bytes, 1 KiB to 4 GiB
+SIZE_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(12))
+
+# Timing spans of the job the current thread or task works on, None outside of collect_timings()
+_timings = contextvars.ContextVar('timings', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+_collectors = []
+_collectors_lock = threading.Lock()
+
+
+def _label_text(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return f'{value:.6g}' if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonically increasing count, by label values."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        register_collector(self.render)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_label_text(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, by label values."""
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        # Label values -> (bucket counts, sum, count)
+        self._values = {}
+        self._lock = threading.Lock()
+        register_collector(self.render)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _label_text(self.labelnames, key, [('le', _format_value(float(bound)))])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                lines.append(f'{self.name}_bucket{_label_text(self.labelnames, key, [("le", "+Inf")])} {count}')
+                lines.append(f'{self.name}_sum{_label_text(self.labelnames, key)} {_format_value(total)}')
+                lines.append(f'{self.name}_count{_label_text(self.labelnames, key)} {count}')
+        return lines
+
+
+def register_collector(collector):
+    """Register a callable returning lines of the Prometheus text format for the metrics endpoint."""
+    with _collectors_lock:
+        _collectors.append(collector)
+
+
+def register_cache(name, description, stats):
+    """
+    Export the hits, misses and entries of a cache, read from its stats() function returning a dict
+    with these keys, as adp_<name>_hits_total, adp_<name>_misses_total and adp_<name>_entries.
+    """
+    def collect():
+        values = stats()
+        return [
+            f'# HELP adp_{name}_hits_total Lookups of the {description} that found an entry.',
+            f'# TYPE adp_{name}_hits_total counter',
+            f'adp_{name}_hits_total {values["hits"]}',
+            f'# HELP adp_{name}_misses_total Lookups of the {description} that found no entry.',
+            f'# TYPE adp_{name}_misses_total counter',
+            f'adp_{name}_misses_total {values["misses"]}',
+            f'# HELP adp_{name}_entries Entries in the {description}.',
+            f'# TYPE adp_{name}_entries gauge',
+            f'adp_{name}_entries {values["entries"]}',
+        ]
+    register_collector(collect)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _collectors_lock:
+        collectors = list(_collectors)
+    lines = []
+    for collector in collectors:
+        try:
+            lines.extend(collector())
+        except Exception:
+            logger.exception("A metrics collector failed.")
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_DURATION = Histogram(
+    'adp_stage_duration_seconds', 'Duration of the pipeline stages.', DURATION_BUCKETS, ('stage',)
+)
+LLM_TOKENS = Counter(
+    'adp_llm_tokens_total', 'Estimated tokens sent to and received from the LLMs.', ('provider', 'kind')
+)
+LLM_RETRIES = Counter('adp_llm_retries_total', 'Retried LLM requests.', ('provider',))
+SANDBOX_RUNS = Counter('adp_sandbox_runs_total', 'Sandbox runs by exit reason.', ('exit_reason',))
+SANDBOX_PEAK_MEMORY = Histogram(
+    'adp_sandbox_peak_memory_bytes', 'Peak memory of the programs run in the sandbox.', SIZE_BUCKETS
+)
+OUTPUT_SIZE = Histogram('adp_output_bytes', 'Total size of the output files of a job.', SIZE_BUCKETS)
+
+
+class Span:
+    """A timed stage of a job with attributes like token counts, retries or sizes."""
+
+    def __init__(self, stage, attributes, duration=0.0):
+        self.stage = stage
+        self.attributes = attributes
+        self.duration = duration
+
+    def __repr__(self):
+        return f'Span({self.stage!r}, {self.duration:.3f}s, {self.attributes})'
+
+
+def _finish(finished_span):
+    STAGE_DURATION.observe(finished_span.duration, stage=finished_span.stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append(finished_span)
+    logger.info(f"Stage {finished_span.stage} took {finished_span.duration:.3f}s {finished_span.attributes or ''}")
+
+
+@contextmanager
+def span(stage, **attributes):
+    """Time a stage of the current job; the yielded Span's attributes can be updated inside the block."""
+    current = Span(stage, dict(attributes))
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        _finish(current)
+
+
+def record(stage, duration, **attributes):
+    """Record a stage that was timed elsewhere, like the time a job waited in the sandbox queue."""
+    _finish(Span(stage, dict(attributes), duration))
+
+
+def record_sandbox_run(result, **attributes):
+    """Record the ExecutionResult of a sandbox run as a span and in the sandbox metrics."""
+    record(
+        'sandbox', result.elapsed,
+        exit_reason=result.exit_reason, peak_memory=result.peak_memory, **attributes,
+    )
+    SANDBOX_RUNS.inc(exit_reason=result.exit_reason)
+    if result.peak_memory is not None:
+        SANDBOX_PEAK_MEMORY.observe(result.peak_memory)
+
+
+def count_llm_tokens(provider, messages, completion):
+    """Count the estimated prompt and completion tokens of an LLM request, in total and on the running span."""
+    prompt_tokens = estimate_tokens(''.join(message['content'] for message in messages))
+    completion_tokens = estimate_tokens(completion)
+    LLM_TOKENS.inc(prompt_tokens, provider=provider, kind='prompt')
+    LLM_TOKENS.inc(completion_tokens, provider=provider, kind='completion')
+    add_to_span('prompt_tokens', prompt_tokens)
+    add_to_span('completion_tokens', completion_tokens)
+
+
+def add_to_span(name, amount=1):
+    """Add to a numeric attribute of the innermost running span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.attributes[name] = current.attributes.get(name, 0) + amount
+
+
+@contextmanager
+def collect_timings():
+    """Collect the spans finished in this context, including threads started with propagate()."""
+    timings = []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def propagate(function):
+    """Wrap a function to run in a copy of the current context, so that its spans belong to the current job."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+def server_timing(timings):
+    """Server-Timing header value summing the durations of the spans by stage, in milliseconds."""
+    stages = {}
+    for finished_span in timings:
+        duration, count = stages.get(finished_span.stage, (0.0, 0))
+        stages[finished_span.stage] = (duration + finished_span.duration, count + 1)
+    return ', '.join(
+        f'{stage};dur={duration * 1000:.1f}' + (f';desc="{count} calls"' if count > 1 else '')
+        for stage, (duration, count) in stages.items()
+    )
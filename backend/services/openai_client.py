@@ -1,25 +1,123 @@
+import asyncio
 import openai
 import logging
+import threading
 from django.conf import settings
 import json
 
+from . import metrics
+from .code_utils import extract_code
+from .llm_retry import RetryPolicy, connection_limits
+
 logger = logging.getLogger(__name__)
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """Return the process-wide OpenAIClient, whose HTTP connections are reused across requests."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAIClient()
+        return _client
+
+
+GENERATE_CODE_FUNCTION = {
+    "name": "generate_code_output",
+    "description": "Generates Python code in a structured output format",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "python_code": {
+                "type": "string",
+                "description": "Generated valid Python code"
+            }
+        },
+        "required": ["python_code"]
+    }
+}
+
+FIX_CODE_FUNCTION = {
+    "name": "fix_code_output",
+    "description": "Fixes the provided Python code based on the error output",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "fixed_code": {
+                "type": "string",
+                "description": "Fixed version of the Python code"
+            }
+        },
+        "required": ["fixed_code"]
+    }
+}
+
+
 class OpenAIClient:
     def __init__(self):
-        openai.api_key = settings.OPENAI_API_KEY  # Set OpenAI API key from settings
+        self.client = openai.OpenAI(
+            api_key=settings.OPENAI_API_KEY,  # Set OpenAI API key from settings
+            base_url=settings.OPENAI_BASE_URL,
+            timeout=settings.LLM_TIMEOUT,
+            max_retries=0,  # Retries are done by the RetryPolicy
+            http_client=openai.DefaultHttpxClient(limits=connection_limits()),
+        )
+        self.model = "gpt-4o-mini"
+        self.retry_policy = RetryPolicy(openai.APIStatusError, openai.APIConnectionError, provider='openai')
+        self._async_client = None
+        self._async_client_loop = None
 
-    def generate_python_code(self, input_files_description, instruction):
-        """Generate Python code using OpenAI based on the instruction."""
-        logger.info("Generating Python code using OpenAI with structured outputs.")
-        
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            temperature=0.3,
+    @property
+    def async_client(self):
+        """AsyncOpenAI client of the running event loop, its pooled connections cannot be shared across loops."""
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            self._async_client = openai.AsyncOpenAI(
+                api_key=settings.OPENAI_API_KEY,
+                base_url=settings.OPENAI_BASE_URL,
+                timeout=settings.LLM_TIMEOUT,
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(limits=connection_limits()),
+            )
+            self._async_client_loop = loop
+        return self._async_client
+
+    def _stream_function_arguments(self, request):
+        """Stream a function-call completion and return its parsed arguments."""
+        stream = self.retry_policy.call(self.client.chat.completions.create, stream=True, **request)
+        arguments = []
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta if chunk.choices else None
+                if delta is not None and delta.function_call is not None and delta.function_call.arguments:
+                    arguments.append(delta.function_call.arguments)
+        finally:
+            stream.close()
+        return json.loads(''.join(arguments))
+
+    async def _astream_function_arguments(self, request):
+        """Stream a function-call completion without blocking the event loop and return its parsed arguments."""
+        stream = await self.retry_policy.acall(self.async_client.chat.completions.create, stream=True, **request)
+        arguments = []
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta if chunk.choices else None
+                if delta is not None and delta.function_call is not None and delta.function_call.arguments:
+                    arguments.append(delta.function_call.arguments)
+        finally:
+            await stream.close()
+        return json.loads(''.join(arguments))
+
+    def _generation_request(self, input_files_description, instruction, temperature=None):
+        return dict(
+            model=self.model,
+            temperature=0.3 if temperature is None else temperature,
             messages=[
                 {"role": "system", "content":
                 f"""
-                    You are a helpful assistant that generates Python code. 
+                    You are a helpful assistant that generates Python code.
                     Write all processed files in the code you generate in the directory 'output/'.
                     If the instruction is to create a website, write a python program that writes an HTML file.
                     The input files are: {input_files_description}.
@@ -29,68 +127,87 @@ class OpenAIClient:
                 """},
                 {"role": "user", "content": f"{instruction}"}
             ],
-            functions=[{
-                "name": "generate_code_output",
-                "description": "Generates Python code in a structured output format",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "python_code": {
-                            "type": "string",
-                            "description": "Generated valid Python code"
-                        }
-                    },
-                    "required": ["python_code"]
-                }
-            }],
+            functions=[GENERATE_CODE_FUNCTION],
             function_call={"name": "generate_code_output"}
         )
-        
-        # Handle structured output
-        generated_code = json.loads(response.choices[0].message.function_call.arguments)["python_code"]
-        return generated_code.strip()
-    
-    def request_dependencies(self, generated_code):
-        """Request to list dependencies required to run the generated code."""
-        logger.info("Requesting dependencies from OpenAI.")
-        response_dependencies = openai.chat.completions.create(
-            model="gpt-4o-mini",
+
+    def _dependency_request(self, generated_code):
+        return dict(
+            model=self.model,
             messages=[
                 {"role": "system", "content": "You are a helpful assistant that lists Python package dependencies."},
                 {"role": "user", "content": f"List all dependencies required to run the following Python code: {generated_code}. Provide the output as a comma-separated list without any explanations or comments. Omit preinstalled packages. If there are no dependencies, return the word 'None'."}
             ],
         )
-        dependencies = response_dependencies.choices[0].message.content.strip().split(",")
-        return [dep.strip() for dep in dependencies]  # Clean up dependency names
 
-    def fix_generated_code(self, generated_code, error_output):
-        """Fix the generated Python code based on the error output."""
-        logger.info("Requesting to fix Python code based on error output.")
-        
-        response_fix = openai.chat.completions.create(
-            model="gpt-4o-mini",
+    def _fix_request(self, generated_code, error_output):
+        return dict(
+            model=self.model,
             temperature=0.3,
             messages=[
                 {"role": "system", "content": "You are an expert Python developer tasked with fixing code based on the error message."},
                 {"role": "user", "content": f"The following Python code generated an error:\n\n{generated_code}\n\nThe error message is:\n\n{error_output}\n\nPlease provide a corrected version of the code."}
             ],
-            functions=[{
-                "name": "fix_code_output",
-                "description": "Fixes the provided Python code based on the error output",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "fixed_code": {
-                            "type": "string",
-                            "description": "Fixed version of the Python code"
-                        }
-                    },
-                    "required": ["fixed_code"]
-                }
-            }],
+            functions=[FIX_CODE_FUNCTION],
             function_call={"name": "fix_code_output"}
         )
-        
-        # Handle structured output
-        fixed_code = json.loads(response_fix.choices[0].message.function_call.arguments)["fixed_code"]
-        return fixed_code.strip()
+
+    def generate_python_code(self, input_files_description, instruction, temperature=None):
+        """Generate Python code using OpenAI based on the instruction."""
+        logger.info("Generating Python code using OpenAI with structured outputs.")
+        request = self._generation_request(input_files_description, instruction, temperature)
+        with metrics.span('llm_generate', provider='openai'):
+            # Handle structured output
+            arguments = self._stream_function_arguments(request)
+            metrics.count_llm_tokens('openai', request["messages"], arguments["python_code"])
+        return extract_code(arguments["python_code"])
+
+    async def agenerate_python_code(self, input_files_description, instruction, temperature=None):
+        """Generate Python code without blocking the event loop."""
+        logger.info("Generating Python code using OpenAI with structured outputs.")
+        request = self._generation_request(input_files_description, instruction, temperature)
+        with metrics.span('llm_generate', provider='openai'):
+            arguments = await self._astream_function_arguments(request)
+            metrics.count_llm_tokens('openai', request["messages"], arguments["python_code"])
+        return extract_code(arguments["python_code"])
+
+    def request_dependencies(self, generated_code):
+        """Request to list dependencies required to run the generated code."""
+        logger.info("Requesting dependencies from OpenAI.")
+        request = self._dependency_request(generated_code)
+        with metrics.span('llm_dependencies', provider='openai'):
+            response_dependencies = self.retry_policy.call(self.client.chat.completions.create, **request)
+            content = response_dependencies.choices[0].message.content
+            metrics.count_llm_tokens('openai', request["messages"], content)
+        dependencies = content.strip().split(",")
+        return [dep.strip() for dep in dependencies]  # Clean up dependency names
+
+    async def arequest_dependencies(self, generated_code):
+        """Request to list dependencies without blocking the event loop."""
+        logger.info("Requesting dependencies from OpenAI.")
+        request = self._dependency_request(generated_code)
+        with metrics.span('llm_dependencies', provider='openai'):
+            response_dependencies = await self.retry_policy.acall(self.async_client.chat.completions.create, **request)
+            content = response_dependencies.choices[0].message.content
+            metrics.count_llm_tokens('openai', request["messages"], content)
+        dependencies = content.strip().split(",")
+        return [dep.strip() for dep in dependencies]
+
+    def fix_generated_code(self, generated_code, error_output):
+        """Fix the generated Python code based on the error output."""
+        logger.info("Requesting to fix Python code based on error output.")
+        request = self._fix_request(generated_code, error_output)
+        with metrics.span('llm_fix', provider='openai'):
+            # Handle structured output
+            arguments = self._stream_function_arguments(request)
+            metrics.count_llm_tokens('openai', request["messages"], arguments["fixed_code"])
+        return extract_code(arguments["fixed_code"])
+
+    async def afix_generated_code(self, generated_code, error_output):
+        """Fix the generated Python code without blocking the event loop."""
+        logger.info("Requesting to fix Python code based on error output.")
+        request = self._fix_request(generated_code, error_output)
+        with metrics.span('llm_fix', provider='openai'):
+            arguments = await self._astream_function_arguments(request)
+            metrics.count_llm_tokens('openai', request["messages"], arguments["fixed_code"])
+        return extract_code(arguments["fixed_code"])
@@ -1,66 +1,411 @@
+import atexit
+import hashlib
+import os
+import queue
+import shutil
 import subprocess
-import time
+import tempfile
+import threading
 import logging
+import uuid
 from pathlib import Path
+from django.conf import settings
+
+from . import metrics
+from .executor import (
+    EXIT_CANCELLED, EXIT_SANDBOX_ERROR,
+    ExecutionResult, Executor, job_command, job_result, run_job,
+)
+from .preflight import TRANSITIVE_MODULES, requirement_name
+from .workspace import Workspace, link_file
 
 logger = logging.getLogger(__name__)
 
-class PodmanExecutor:
+# Mount point of the wheel cache during image builds
+CONTAINER_WHEEL_DIRECTORY = "/wheels"
+
+
+class PooledContainer:
+    """
+    A pre-started container that executes a single job with `podman exec`. It mounts only its own
+    empty slot workspace, the job's files are linked into it when the job arrives.
+    """
+
+    def __init__(self, name, image_tag, slot):
+        self.name = name
+        self.image_tag = image_tag
+        self.slot = slot
+
+
+class PodmanExecutor(Executor):
+    """Run the generated code in Podman containers, from warm pools of image variants providing its packages."""
+
     def __init__(self):
-        self.container_name = "python-container"
+        super().__init__()
+        self.container_name = settings.PODMAN_IMAGE_NAME
+        self.image_build_directory = Path(settings.PODMAN_IMAGE_DIR)
+        self.wheel_cache_directory = Path(settings.PODMAN_WHEEL_CACHE_DIR)
+        self.workspace_root = Path(settings.PODMAN_WORKSPACE_ROOT).resolve()
+        self.outputs_root = Path(settings.PODMAN_OUTPUTS_ROOT).resolve()
+        self.pool_size = settings.PODMAN_POOL_SIZE
 
-    def build_container(self, container_name):
-        """Build a container from the local directory."""
+        self._images = set()
+        self._image_lock = threading.Lock()
+        self._build_locks = {}
+        self._wheelhouse_ready = None
+        self._wheelhouse_lock = threading.Lock()
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+
+        self.workspace_root.mkdir(parents=True, exist_ok=True)
+        self.outputs_root.mkdir(parents=True, exist_ok=True)
+        atexit.register(self.shutdown)
+
+    def gauges(self):
+        """Gauges of the sandbox scheduler and the container pools."""
+        with self._pools_lock:
+            idle_containers = sum(pool.qsize() for pool in self._pools.values())
+        return super().gauges() + [
+            ("adp_sandbox_idle_containers", "Pre-started containers waiting for jobs.", idle_containers),
+        ]
+
+    def requirement_lines(self, packages=None):
+        """Lines of a requirements file installing the packages, all packages of the image by default."""
+        lines = [
+            line.strip()
+            for line in (self.image_build_directory / "requirements.txt").read_text().splitlines()
+            if requirement_name(line)
+        ]
+        if packages is None:
+            return lines
+        # Keep the version pins of the image's requirements
+        pinned = {requirement_name(line).lower(): line for line in lines}
+        return sorted({package.lower(): pinned.get(package.lower(), package) for package in packages}.values())
+
+    def provided_packages(self, packages=None):
+        """Lower-cased names of the distributions an image variant provides."""
+        if packages is not None:
+            return {package.lower() for package in packages}
+        # The complete image also provides the dependencies of its packages
+        provided = {requirement_name(line).lower() for line in self.requirement_lines()}
+        return provided | {package.lower() for package in TRANSITIVE_MODULES.values()}
+
+    def select_variant(self, packages):
+        """
+        Packages of the smallest prebuilt image variant that provides all the packages.
+        None selects the complete image, which is used when no smaller variant provides them.
+        """
+        if packages is None:
+            return None
+        required = {package.lower() for package in packages}
+        variants = [
+            (len(provided), variant)
+            for variant, provided in (
+                (variant, self.provided_packages(variant)) for variant in settings.PODMAN_IMAGE_VARIANTS.values()
+            )
+            if required <= provided
+        ]
+        if variants:
+            return min(variants, key=lambda variant: variant[0])[1]
+        return None
+
+    def image_hash(self, requirement_lines):
+        """Hash the Dockerfile and the packages the image is built with."""
+        digest = hashlib.sha256()
+        digest.update(b"Dockerfile")
+        digest.update((self.image_build_directory / "Dockerfile").read_bytes())
+        digest.update(b"requirements.txt")
+        digest.update("\n".join(requirement_lines).encode())
+        return digest.hexdigest()[:16]
+
+    def ensure_image(self, packages=None):
+        """
+        Return the tag of an up-to-date image providing the packages, building it only if it
+        does not exist yet. Without packages, the image with all packages of requirements.txt is used.
+        """
+        return self.ensure_variant(self.select_variant(packages))
+
+    def ensure_variant(self, packages=None):
+        """Return the tag of the image installing exactly these packages, building it if needed."""
         try:
-            image_build_directory = Path("podman-image")
+            requirement_lines = self.requirement_lines(packages)
+            image_tag = f"{self.container_name}:{self.image_hash(requirement_lines)}"
+        except OSError as e:
+            logger.error(f"Cannot read the image build directory {self.image_build_directory}: {str(e)}")
+            return None
+
+        with self._image_lock:
+            if image_tag in self._images:
+                return image_tag
+            build_lock = self._build_locks.setdefault(image_tag, threading.Lock())
+
+        # Jobs needing the same image wait for a single build
+        with build_lock:
+            with self._image_lock:
+                if image_tag in self._images:
+                    return image_tag
+            exists = subprocess.run(["podman", "image", "exists", image_tag]).returncode == 0
+            if not exists and not self.build_container(image_tag, requirement_lines):
+                return None
+            with self._image_lock:
+                self._images.add(image_tag)
+
+        logger.info(f"Using sandbox image: {image_tag} ({len(requirement_lines)} packages)")
+        return image_tag
 
+    def base_image(self):
+        """The image the Dockerfile builds on."""
+        for line in (self.image_build_directory / "Dockerfile").read_text().splitlines():
+            if line.strip().upper().startswith("FROM "):
+                return line.split()[1]
+        raise ValueError("The Dockerfile has no FROM instruction.")
+
+    def ensure_wheelhouse(self):
+        """
+        Download the wheels of all packages of requirements.txt and their dependencies once,
+        so that the image variants are built offline from the local wheel cache.
+        """
+        with self._wheelhouse_lock:
+            if self._wheelhouse_ready is not None:
+                return self._wheelhouse_ready
+
+            requirements_path = self.image_build_directory / "requirements.txt"
+            marker = self.wheel_cache_directory / f".complete-{hashlib.sha256(requirements_path.read_bytes()).hexdigest()[:16]}"
+            if marker.exists():
+                self._wheelhouse_ready = True
+                return True
+
+            logger.info(f"Filling the wheel cache: {self.wheel_cache_directory}")
+            self.wheel_cache_directory.mkdir(parents=True, exist_ok=True)
+            # Wheels are built in the base image so that they match its platform and Python version
+            result = subprocess.run(
+                [
+                    "podman", "run", "--rm",
+                    "-v", f"{self.wheel_cache_directory}:{CONTAINER_WHEEL_DIRECTORY}",
+                    "-v", f"{requirements_path}:/tmp/requirements.txt:ro",
+                    self.base_image(),
+                    "pip", "wheel", "--wheel-dir", CONTAINER_WHEEL_DIRECTORY, "-r", "/tmp/requirements.txt",
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            self._wheelhouse_ready = result.returncode == 0
+            if self._wheelhouse_ready:
+                marker.touch()
+            else:
+                logger.warning(f"Failed to fill the wheel cache, images are built from the package index: {result.stderr.decode()}")
+            return self._wheelhouse_ready
+
+    def build_container(self, image_tag, requirement_lines):
+        """Build a sandbox image installing the requirement lines from the wheel cache."""
+        try:
             # Ensure the image build directory exists
-            if not image_build_directory.is_dir():
-                logger.error(f"The specified image build directory does not exist: {image_build_directory}")
+            if not self.image_build_directory.is_dir():
+                logger.error(f"The specified image build directory does not exist: {self.image_build_directory}")
                 return False
 
-            # Build the container from the specified directory
-            subprocess.run(
-                ["podman", "build", "-t", self.container_name, str(image_build_directory)],
-                check=True
-            )
-            logger.info(f"Built the container: {self.container_name}")
-            return True  # Return the container name upon success
+            offline = self.ensure_wheelhouse()
+            with tempfile.TemporaryDirectory() as build_context:
+                shutil.copy(self.image_build_directory / "Dockerfile", build_context)
+                (Path(build_context) / "requirements.txt").write_text("\n".join(requirement_lines) + "\n")
+
+                command = [
+                    "podman", "build", "-t", image_tag,
+                    "-v", f"{self.wheel_cache_directory}:{CONTAINER_WHEEL_DIRECTORY}:ro",
+                ]
+                if not offline:
+                    # Use the cached wheels where possible and the package index for the rest
+                    command += ["--build-arg", f"PIP_OPTIONS=--find-links={CONTAINER_WHEEL_DIRECTORY}"]
+                # Build the image from the generated build context
+                subprocess.run([*command, build_context], check=True)
+            logger.info(f"Built the image: {image_tag}")
+            return True
 
         except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to build container: {str(e)}")
-            return None
+            logger.error(f"Failed to build image: {str(e)}")
+            return False
 
-    def execute_script(self, shared_directory):
-        """Build and run the container which executes the Python code in the Dockerfile."""
-        
-        # Build the container first
-        if not self.build_container(self.container_name):
-            return False ,"Container build failed."
+    def warm_up(self):
+        """Build the prebuilt image variants and pre-start their container pools in the background."""
+        def prepare():
+            self.wheel_cache_directory.mkdir(parents=True, exist_ok=True)
+            for packages in settings.PODMAN_IMAGE_VARIANTS.values():
+                image_tag = self.ensure_variant(packages)
+                if image_tag is not None:
+                    self._fill_pool(image_tag)
+        threading.Thread(target=prepare, daemon=True).start()
 
-        logger.info(f"Running the container: {self.container_name}")
+    def _pool(self, image_tag):
+        """Idle containers of an image."""
+        with self._pools_lock:
+            return self._pools.setdefault(image_tag, queue.SimpleQueue())
+
+    def _fill_pool(self, image_tag):
+        pool = self._pool(image_tag)
+        while pool.qsize() < self.pool_size:
+            container = self._start_container(image_tag)
+            if container is None:
+                break
+            pool.put(container)
+
+    def _start_container(self, image_tag):
+        """Start an idle container bound to a new slot workspace, waiting for the job to be executed in it."""
+        name = f"adp-pool-{uuid.uuid4().hex[:12]}"
+        slot = Workspace(self.workspace_root, self.outputs_root)
         try:
-            # Run the container; capture both stdout and stderr to handle errors directly
-            result = subprocess.run(
-                ["podman", "run", "--rm", "--name", self.container_name, "-v", f"{shared_directory}:/app", self.container_name],
+            subprocess.run(
+                [
+                    "podman", "run", "-d", "--rm", "--name", name,
+                    *self.resource_limit_options(),
+                    # Only the slot is mounted, at the same paths as on the host so that its output symlink resolves
+                    "-v", f"{slot.directory}:{slot.directory}:ro",
+                    "-v", f"{slot.output_directory}:{slot.output_directory}",
+                    image_tag, "sleep", "infinity",
+                ],
                 check=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Failed to start pooled container: {e.stderr.decode() if e.stderr else str(e)}")
+            slot.cleanup()
+            return None
+        logger.info(f"Started pooled container: {name}")
+        return PooledContainer(name, image_tag, slot)
+
+    def resource_limit_options(self):
+        """Podman options limiting the CPU, memory, processes and network available to a single job."""
+        options = []
+        if settings.PODMAN_CPUS:
+            options += ["--cpus", str(settings.PODMAN_CPUS)]
+        if settings.PODMAN_MEMORY:
+            # Without swap, so that a memory blow-up is killed instead of slowing down the host
+            options += ["--memory", settings.PODMAN_MEMORY, "--memory-swap", settings.PODMAN_MEMORY]
+        if settings.PODMAN_PIDS_LIMIT:
+            options += ["--pids-limit", str(settings.PODMAN_PIDS_LIMIT)]
+        if settings.PODMAN_NETWORK:
+            options += ["--network", settings.PODMAN_NETWORK]
+        return options
+
+    def acquire_container(self, image_tag):
+        """Take a warm container of the image from its pool, starting a new one if none is idle."""
+        try:
+            return self._pool(image_tag).get_nowait()
+        except queue.Empty:
+            return self._start_container(image_tag)
+
+    def discard_container(self, container):
+        """
+        Remove a container after its job, so that nothing the job left behind in it can see later
+        jobs, and top its pool up again. Both happen off the request path.
+        """
+        def recycle():
+            self.remove_container(container.name)
+            container.slot.cleanup()
+            self._fill_pool(container.image_tag)
+        threading.Thread(target=recycle, daemon=True).start()
+
+    def execute_script(self, shared_directory, cancel_event=None, packages=None):
+        """
+        Run main.py of the shared directory in the sandbox and return an ExecutionResult,
+        which unpacks to (success, logs). The job runs in an image providing the packages
+        (all packages by default). Setting the optional cancel_event stops the running job.
+        """
+        with metrics.span("image", packages=len(packages) if packages is not None else "all"):
+            image_tag = self.ensure_image(packages)
+        if image_tag is None:
+            return ExecutionResult(False, "Container build failed.", EXIT_SANDBOX_ERROR)
+
+        shared_directory = Path(shared_directory).resolve()
+        output_directory = (shared_directory / "output").resolve()
+        with self.scheduler.slot() as wait_time:
+            metrics.record("sandbox_queue", wait_time)
+            if cancel_event is not None and cancel_event.is_set():
+                return ExecutionResult(False, "Execution cancelled.", EXIT_CANCELLED)
+            pooled = (
+                self.pool_size > 0
+                and shared_directory.is_relative_to(self.workspace_root)
+                and output_directory.is_relative_to(self.outputs_root)
+            )
+            if pooled:
+                result = self._execute_in_pool(shared_directory, output_directory, image_tag, cancel_event)
+            else:
+                result = self._execute_in_new_container(shared_directory, output_directory, image_tag, cancel_event)
 
-            logger.info(f"Container ran successfully: {self.container_name}")
-            return True, result.stdout.decode()
+        self.scheduler.record(result)
+        metrics.record_sandbox_run(result, pooled=pooled)
+        return result
 
-        except subprocess.CalledProcessError as e:
-            # Capture the error output directly from the exception
-            error_output = e.stderr.decode() if e.stderr else "No error output"
+    def _execute_in_pool(self, shared_directory, output_directory, image_tag, cancel_event=None):
+        container = self.acquire_container(image_tag)
+        if container is None:
+            return self._execute_in_new_container(shared_directory, output_directory, image_tag, cancel_event)
+
+        logger.info(f"Running the job in pooled container: {container.name}")
+        slot = container.slot
+        try:
+            # Hard links into the mounted slot show up in the container right away
+            for path in shared_directory.rglob("*"):
+                relative_path = path.relative_to(shared_directory)
+                if relative_path.parts[0] == "output" or not path.is_file():
+                    continue
+                (slot.directory / relative_path).parent.mkdir(parents=True, exist_ok=True)
+                link_file(path, slot.directory / relative_path)
 
-            return False, error_output
+            result = job_result(*run_job(
+                ["podman", "exec", "-w", str(slot.directory), container.name, *job_command()],
+                cancel_event,
+                on_kill=lambda: self.remove_container(container.name),
+            ))
 
-    def remove_container(self):
-        """Remove the persistent Podman container."""
-        logger.info(f"Removing container: {self.container_name}")
+            output_directory.mkdir(parents=True, exist_ok=True)
+            for entry in slot.output_directory.iterdir():
+                target = output_directory / entry.name
+                # Outputs of an earlier attempt of the same job are replaced
+                if target.is_dir() and not target.is_symlink():
+                    shutil.rmtree(target)
+                os.replace(entry, target)
+        finally:
+            self.discard_container(container)
+        return result
+
+    def _execute_in_new_container(self, shared_directory, output_directory, image_tag, cancel_event=None):
+        # Every job gets its own container name so that concurrent runs do not collide
+        name = f"adp-job-{uuid.uuid4().hex[:12]}"
+        logger.info(f"Running the container {name} from: {image_tag}")
+        # Run the container; capture both stdout and stderr to handle errors directly
+        return job_result(*run_job(
+            [
+                "podman", "run", "--rm", "--name", name,
+                *self.resource_limit_options(),
+                # Inputs and code are read-only, only the output directory is writable
+                "-v", f"{shared_directory}:{shared_directory}:ro",
+                "-v", f"{output_directory}:{output_directory}",
+                "-w", str(shared_directory),
+                image_tag, *job_command(),
+            ],
+            cancel_event,
+            on_kill=lambda: self.remove_container(name),
+        ))
+
+    def remove_container(self, name):
+        """Remove a Podman container."""
+        logger.info(f"Removing container: {name}")
         subprocess.run(
-            ["podman", "rm", "-f", self.container_name],
-            check=True
+            ["podman", "rm", "-f", name],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
         )
+
+    def shutdown(self):
+        """Remove all idle pooled containers."""
+        with self._pools_lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            while True:
+                try:
+                    container = pool.get_nowait()
+                except queue.Empty:
+                    break
+                self.remove_container(container.name)
+                container.slot.cleanup()
@@ -0,0 +1,290 @@
+import ast
+import functools
+import logging
+import re
+from pathlib import Path, PurePosixPath
+
+from .stdlib_modules import STDLIB_MODULES
+
+logger = logging.getLogger(__name__)
+
+# Import names of packages that differ from their distribution name
+PACKAGE_IMPORT_NAMES = {
+    "opencv-python": ["cv2"],
+    "opencv-python-headless": ["cv2"],
+    "python-docx": ["docx"],
+    "python-pptx": ["pptx"],
+    "beautifulsoup4": ["bs4"],
+    "PyYAML": ["yaml"],
+    "pillow": ["PIL"],
+    "python-dateutil": ["dateutil"],
+    "scikit-learn": ["sklearn"],
+}
+
+# Top-level modules a distribution ships besides its import name
+PACKAGE_EXTRA_MODULES = {
+    "matplotlib": ["mpl_toolkits", "pylab"],
+    "PyYAML": ["_yaml"],
+}
+
+# Modules installed as dependencies of the packages in the image (pandas, matplotlib, Flask, python-pptx, ...),
+# with the distribution providing them
+TRANSITIVE_MODULES = {
+    "PIL": "pillow", "dateutil": "python-dateutil", "pytz": "pytz", "tzdata": "tzdata", "six": "six",
+    "lxml": "lxml", "xlsxwriter": "XlsxWriter", "et_xmlfile": "et_xmlfile", "soupsieve": "soupsieve",
+    "jinja2": "Jinja2", "markupsafe": "MarkupSafe", "werkzeug": "Werkzeug", "itsdangerous": "itsdangerous",
+    "click": "click", "blinker": "blinker", "urllib3": "urllib3", "certifi": "certifi", "idna": "idna",
+    "charset_normalizer": "charset-normalizer", "pyparsing": "pyparsing", "cycler": "cycler",
+    "kiwisolver": "kiwisolver", "fontTools": "fonttools", "contourpy": "contourpy", "packaging": "packaging",
+}
+
+# Optional dependencies pandas imports only when these functions or attributes are used:
+# the engines of file formats, Jinja2 for DataFrame.style and matplotlib for plotting
+PANDAS_ENGINE_PACKAGES = {
+    "read_parquet": "pyarrow", "to_parquet": "pyarrow", "read_feather": "pyarrow", "to_feather": "pyarrow",
+    "read_excel": "openpyxl", "to_excel": "openpyxl",
+    "read_html": "lxml", "read_xml": "lxml", "to_xml": "lxml",
+    "style": "Jinja2", "background_gradient": "matplotlib", "plot": "matplotlib", "hist": "matplotlib",
+}
+
+# Calls whose first argument is a file that is read
+READ_CALL_PATTERN = re.compile(
+    r"^(open|read_\w+|load_workbook|imread|Document|Presentation|PdfReader|PdfFileReader|"
+    r"convert_from_path|ExcelFile)$"
+)
+
+# A string that looks like a relative or absolute file name with an extension
+FILE_PATH_PATTERN = re.compile(r"^[\w ./\\-]{1,255}\.[A-Za-z0-9]{1,10}$")
+
+OUTPUT_DIRECTORY = "output"
+
+
+class PreflightReport:
+    """Problems found in generated code before it is executed."""
+
+    def __init__(self):
+        self.issues = []
+
+    def add(self, issue):
+        self.issues.append(issue)
+
+    @property
+    def ok(self):
+        return not self.issues
+
+    def __str__(self):
+        lines = ["The code was not executed, the pre-flight check found these problems:"]
+        lines += [f"- {issue}" for issue in self.issues]
+        return "\n".join(lines)
+
+
+def requirement_name(line):
+    """Distribution name of a requirements.txt line, or None for comments and options."""
+    line = line.split("#", 1)[0].strip()
+    if not line or line.startswith("-"):
+        return None
+    return re.split(r"[\s<>=!~;\[]", line, 1)[0]
+
+
+def module_names(package):
+    """Import names a distribution is likely to provide."""
+    if package in PACKAGE_IMPORT_NAMES:
+        return PACKAGE_IMPORT_NAMES[package]
+    name = package.replace("-", "_")
+    return [name, name.lower()]
+
+
+def requirement_names(requirements_path):
+    """Distribution names listed in a requirements file."""
+    names = (requirement_name(line) for line in Path(requirements_path).read_text().splitlines())
+    return [name for name in names if name]
+
+
+@functools.lru_cache(maxsize=8)
+def _module_packages(requirements_path, mtime):
+    packages = dict(TRANSITIVE_MODULES)
+    for package in requirement_names(requirements_path):
+        for module in module_names(package) + PACKAGE_EXTRA_MODULES.get(package, []):
+            packages[module] = package
+    return packages
+
+
+def module_packages(requirements_path):
+    """Map the top-level modules importable in an image built from the requirements file to their distribution."""
+    requirements_path = Path(requirements_path)
+    return _module_packages(str(requirements_path), requirements_path.stat().st_mtime)
+
+
+def installed_modules(requirements_path):
+    """Top-level modules importable in an image built from the requirements file."""
+    return frozenset(module_packages(requirements_path))
+
+
+def required_packages(code, requirements_path):
+    """
+    Distributions the imports of the code need, out of those the requirements file provides, including
+    the optional dependencies pandas loads for the formats and features the code uses. Imports the
+    requirements file cannot provide are left out, the pre-flight check reports them.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    packages = module_packages(requirements_path)
+    required = {packages[module] for module in imported_modules(tree) if module in packages}
+    if "pandas" in required:
+        available = set(packages.values())
+        for node in ast.walk(tree):
+            name = _referenced_name(node)
+            if PANDAS_ENGINE_PACKAGES.get(name) in available:
+                required.add(PANDAS_ENGINE_PACKAGES[name])
+    return sorted(required)
+
+
+def _catches_import_error(node):
+    for handler in node.handlers:
+        names = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+        for name in names:
+            if name is None or (isinstance(name, ast.Name) and name.id in ("ImportError", "ModuleNotFoundError", "Exception")):
+                return True
+    return False
+
+
+def imported_modules(tree):
+    """Top-level modules imported by the code, leaving out optional imports guarded by `except ImportError`."""
+    modules = set()
+
+    def visit(node, optional):
+        if isinstance(node, ast.Try) and _catches_import_error(node):
+            for child in node.body:
+                visit(child, True)
+            for child in node.handlers + node.orelse + node.finalbody:
+                visit(child, optional)
+            return
+        if not optional:
+            if isinstance(node, ast.Import):
+                modules.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                modules.add(node.module.split(".")[0])
+        for child in ast.iter_child_nodes(node):
+            visit(child, optional)
+
+    visit(tree, False)
+    return modules
+
+
+def _string_constants(tree):
+    """Names that are assigned a string literal, to resolve `path = 'data.csv'; open(path)`."""
+    constants = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+    return constants
+
+
+def _referenced_name(node):
+    """Name a node refers to: a variable, an attribute or an imported name."""
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    if isinstance(node, ast.alias):
+        return node.name
+    return None
+
+
+def _call_name(node):
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return None
+
+
+def _is_write_mode(call):
+    mode = call.args[1] if len(call.args) > 1 else next((k.value for k in call.keywords if k.arg == "mode"), None)
+    return isinstance(mode, ast.Constant) and isinstance(mode.value, str) and any(c in mode.value for c in "wax+")
+
+
+def read_file_paths(tree):
+    """File name literals the code opens for reading."""
+    constants = _string_constants(tree)
+    paths = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not node.args:
+            continue
+        name = _call_name(node)
+        if name is None or not READ_CALL_PATTERN.match(name):
+            continue
+        if name == "open" and _is_write_mode(node):
+            continue
+        argument = node.args[0]
+        if isinstance(argument, ast.Constant) and isinstance(argument.value, str):
+            path = argument.value
+        elif isinstance(argument, ast.Name) and argument.id in constants:
+            path = constants[argument.id]
+        else:
+            continue
+        if FILE_PATH_PATTERN.match(path) and "://" not in path:
+            paths.append(path)
+    return paths
+
+
+def normalize_path(path):
+    # PurePosixPath drops "." components, so "./data.csv" and "data.csv" compare equal
+    return PurePosixPath(path.replace("\\", "/"))
+
+
+def writes_output(tree):
+    """Whether some string literal in the code refers to the output directory."""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            parts = normalize_path(node.value.strip()).parts
+            if parts and parts[0] == OUTPUT_DIRECTORY:
+                return True
+    return False
+
+
+def preflight(code, input_file_names, requirements_path):
+    """
+    Check generated code for problems that would make its execution fail:
+    imports missing from the sandbox image, reads of files that were not uploaded
+    and no output written to the output directory.
+    """
+    report = PreflightReport()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # Syntax errors are reported by the compiler
+        return report
+
+    available = installed_modules(requirements_path)
+    missing = sorted(
+        module for module in imported_modules(tree)
+        if module not in STDLIB_MODULES and module not in available
+    )
+    if missing:
+        report.add(
+            f"These modules are not installed in the sandbox: {', '.join(missing)}. Use only the standard "
+            f"library and these packages: {', '.join(requirement_names(requirements_path))}."
+        )
+
+    input_file_names = set(input_file_names)
+    for path in read_file_paths(tree):
+        normalized = normalize_path(path)
+        if normalized.parts and normalized.parts[0] == OUTPUT_DIRECTORY:
+            continue
+        if normalized.as_posix() not in input_file_names:
+            report.add(
+                f"The file '{path}' is read but was not uploaded. The input files are in the "
+                f"working directory: {', '.join(sorted(input_file_names)) or 'none'}."
+            )
+
+    if not writes_output(tree):
+        report.add(f"The code never writes to the '{OUTPUT_DIRECTORY}/' directory, all results must be written there.")
+
+    if not report.ok:
+        logger.info(f"Pre-flight check found {len(report.issues)} problems.")
+    return report
@@ -0,0 +1,117 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rough average of characters per token of the Llama and GPT tokenizers for English text and code
+CHARS_PER_TOKEN = 4
+
+TRUNCATION_MARKER = "[... truncated to fit the prompt]\n"
+
+
+def estimate_tokens(text):
+    """Estimate the number of tokens of a text without running a tokenizer."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut a text to whole lines fitting into `max_tokens`, marking that it was truncated."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max_tokens * CHARS_PER_TOKEN - len(TRUNCATION_MARKER)
+    if max_chars <= 0:
+        # Not even the marker fits
+        return ''
+    cut = text.rfind('\n', 0, max_chars + 1)
+    # Keep a partial line rather than nothing when the first line alone is too long
+    kept = text[:cut + 1] if cut > 0 else text[:max_chars - 1] + '\n'
+    return kept + TRUNCATION_MARKER
+
+
+class PromptSection:
+    """A named part of the prompt with its token usage."""
+
+    def __init__(self, name, text, original_tokens):
+        self.name = name
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self.original_tokens = original_tokens
+
+    @property
+    def truncated(self):
+        return self.tokens < self.original_tokens
+
+    def report(self):
+        return {
+            "name": self.name,
+            "tokens": self.tokens,
+            "original_tokens": self.original_tokens,
+            "truncated": self.truncated,
+        }
+
+
+class PromptBuilder:
+    """
+    Fit sections, such as the previews of the input files, into a shared token budget.
+    The headers and footers of the sections are always kept whole, and the rest of the budget
+    is split fairly between their texts: texts smaller than their share are kept whole and leave
+    the rest of their share to the larger ones, which are truncated to what remains. When the
+    headers alone exceed the budget, the last sections are dropped and only listed by name.
+    """
+
+    def __init__(self, token_budget, header_template='{name}:\n"""\n', footer='...\n"""\n\n',
+                 omitted_template='Further sections, not shown: {names}\n\n'):
+        self.token_budget = token_budget
+        self.header_template = header_template
+        self.footer = footer
+        self.omitted_template = omitted_template
+        self._sections = []
+
+    def add(self, name, text):
+        self._sections.append((name, text))
+
+    def _omitted_text(self, names):
+        return self.omitted_template.format(names=', '.join(names)) if names else ''
+
+    def build(self):
+        """Return the prompt text and the list of PromptSections it was built from."""
+        overheads = [
+            estimate_tokens(self.header_template.format(name=name) + self.footer) for name, _ in self._sections
+        ]
+        kept = list(range(len(self._sections)))
+        omitted = []
+        while kept and sum(overheads[index] for index in kept) + estimate_tokens(
+            self._omitted_text([self._sections[index][0] for index in omitted])
+        ) > self.token_budget:
+            omitted.insert(0, kept.pop())
+        omitted_text = self._omitted_text([self._sections[index][0] for index in omitted])
+        if not kept:
+            omitted_text = truncate_to_tokens(omitted_text, self.token_budget)
+
+        allotted = {}
+        remaining_budget = max(
+            self.token_budget - estimate_tokens(omitted_text) - sum(overheads[index] for index in kept), 0
+        )
+        remaining_sections = len(kept)
+        # Serve the smallest texts first, so that their unused share goes to the larger ones
+        for index in sorted(kept, key=lambda i: len(self._sections[i][1])):
+            share = remaining_budget // remaining_sections
+            allotted[index] = min(estimate_tokens(self._sections[index][1]), share)
+            remaining_budget -= allotted[index]
+            remaining_sections -= 1
+
+        sections = []
+        for index, (name, text) in enumerate(self._sections):
+            header = self.header_template.format(name=name)
+            original_tokens = estimate_tokens(header + text + self.footer)
+            if index in allotted:
+                body = truncate_to_tokens(text, allotted[index])
+                sections.append(PromptSection(name, header + body + self.footer, original_tokens))
+            else:
+                sections.append(PromptSection(name, '', original_tokens))
+
+        for section in sections:
+            logger.info(
+                f"Prompt section {section.name}: {section.tokens} tokens"
+                + (f" (truncated from {section.original_tokens})" if section.truncated else "")
+            )
+        return ''.join(section.text for section in sections) + omitted_text, sections
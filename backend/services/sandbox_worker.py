@@ -0,0 +1,98 @@
+"""
+Worker process of the WorkerPoolExecutor. Run as a script, without Django: it imports the modules
+given as arguments once, then reads jobs as JSON lines from stdin. Every job runs in a child forked
+from the worker, so it starts with the modules already loaded and cannot leave state behind.
+For each job the worker writes the child's pid, then its exit code, output and peak memory.
+"""
+import json
+import os
+import resource
+import runpy
+import sys
+import tempfile
+import traceback
+
+# The script's own directory (services/) must not shadow the modules of the jobs
+sys.path.pop(0)
+
+
+def send(message):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def set_limit(limit, value, hard=None):
+    if value:
+        resource.setrlimit(limit, (value, hard or value))
+
+
+def run_child(job, stdout, stderr):
+    """Run main.py in the forked child, never returns."""
+    code = 1
+    try:
+        os.setsid()
+        os.chdir(job["directory"])
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        # The job cannot raise the limits again. Past the CPU time it gets SIGXCPU,
+        # a second later SIGKILL.
+        cpu_time = job.get("cpu_time")
+        set_limit(resource.RLIMIT_CPU, cpu_time, cpu_time and cpu_time + 1)
+        set_limit(resource.RLIMIT_DATA, job.get("memory"))
+        set_limit(resource.RLIMIT_FSIZE, job.get("file_size"))
+        set_limit(resource.RLIMIT_NOFILE, job.get("open_files"))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        sys.argv = ["main.py"]
+        sys.path.insert(0, job["directory"])
+        runpy.run_path("main.py", run_name="__main__")
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            sys.stderr.write(f"{e.code}\n")
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def run(job):
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        pid = os.fork()
+        if pid == 0:
+            run_child(job, stdout, stderr)
+        send({"pid": pid})
+        _, status, usage = os.wait4(pid, 0)
+        code = os.waitstatus_to_exitcode(status)
+        stdout.seek(0)
+        stderr.seek(0)
+        send({
+            # A signal is reported like a shell does, as 128 + its number
+            "returncode": 128 - code if code < 0 else code,
+            "stdout": stdout.read().decode(errors="replace"),
+            "stderr": stderr.read().decode(errors="replace"),
+            "peak_memory": usage.ru_maxrss * 1024,
+        })
+
+
+def main(preload):
+    for module in preload:
+        try:
+            __import__(module)
+        except ImportError as e:
+            sys.stderr.write(f"The sandbox worker could not preload {module}: {e}\n")
+    send({"ready": True})
+    for line in sys.stdin:
+        if line.strip():
+            run(json.loads(line))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
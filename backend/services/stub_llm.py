@@ -0,0 +1,171 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Summarizes every input file into output/summary.json, using only the standard library
+# so that it runs in any sandbox image and with the local executor
+DEFAULT_CODE = '''import json
+import os
+
+summary = {}
+for name in sorted(os.listdir(".")):
+    if not os.path.isfile(name) or name == "main.py":
+        continue
+    with open(name, "rb") as f:
+        data = f.read()
+    summary[name] = {"bytes": len(data), "lines": data.count(b"\\n")}
+
+os.makedirs("output", exist_ok=True)
+with open(os.path.join("output", "summary.json"), "w") as f:
+    json.dump(summary, f, indent=2)
+'''
+
+# Number of chunks a streamed completion is split into
+STREAM_CHUNKS = 20
+
+
+class StubLLMServer:
+    """
+    Local server speaking the chat completions API of Groq and OpenAI, returning canned code
+    after a configurable latency. Streaming, plain completions and OpenAI function calls are supported.
+    The code is looked up by instruction; the default code is returned for unknown instructions.
+    """
+
+    def __init__(self, responses=None, default_code=DEFAULT_CODE, latency=0.0, host='127.0.0.1', port=0):
+        self.responses = dict(responses or {})
+        self.default_code = default_code
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def groq_base_url(self):
+        # The Groq SDK appends /openai/v1/chat/completions
+        return self.url
+
+    @property
+    def openai_base_url(self):
+        # The OpenAI SDK appends /chat/completions
+        return f'{self.url}/v1'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-llm', daemon=True)
+        self._thread.start()
+        logger.info(f"Stub LLM server listening on {self.url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def code_for(self, messages):
+        """Canned code of the first instruction found in the messages."""
+        for message in reversed(messages):
+            content = message.get('content') or ''
+            for instruction, code in self.responses.items():
+                if instruction in content:
+                    return code
+        return self.default_code
+
+    def completion(self, request):
+        """Content or function call arguments answering a chat completion request."""
+        messages = request.get('messages', [])
+        function_call = request.get('function_call')
+        if isinstance(function_call, dict):
+            function = next(f for f in request.get('functions', []) if f['name'] == function_call['name'])
+            argument = function['parameters']['required'][0]
+            return None, {'name': function['name'], 'arguments': json.dumps({argument: self.code_for(messages)})}
+        if any('dependencies' in (message.get('content') or '') for message in messages):
+            return 'None', None
+        return f'```python\n{self.code_for(messages)}\n```', None
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def do_POST(self):
+                if not self.path.endswith('/chat/completions'):
+                    self.send_error(404)
+                    return
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                with stub._lock:
+                    stub.requests += 1
+                time.sleep(stub.latency)
+                content, function_call = stub.completion(request)
+                if request.get('stream'):
+                    self._stream(request, content, function_call)
+                else:
+                    message = {'role': 'assistant', 'content': content}
+                    if function_call is not None:
+                        message['function_call'] = function_call
+                    self._send_json(stub_response(request, {'message': message, 'finish_reason': 'stop'}))
+
+            def _send_json(self, body):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, request, content, function_call):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                text = content if function_call is None else function_call['arguments']
+                size = max(1, -(-len(text) // STREAM_CHUNKS))
+                for start in range(0, len(text), size):
+                    piece = text[start:start + size]
+                    if function_call is None:
+                        delta = {'content': piece}
+                    else:
+                        delta = {'function_call': {'arguments': piece}}
+                        if start == 0:
+                            delta['function_call']['name'] = function_call['name']
+                    self._send_event(stub_response(request, {'delta': delta, 'finish_reason': None}, chunk=True))
+                self._send_event(stub_response(request, {'delta': {}, 'finish_reason': 'stop'}, chunk=True))
+                self.wfile.write(b'data: [DONE]\n\n')
+                self.wfile.flush()
+                self.close_connection = True
+
+            def _send_event(self, body):
+                self.wfile.write(f'data: {json.dumps(body)}\n\n'.encode())
+                self.wfile.flush()
+
+        return Handler
+
+
+def stub_response(request, choice, chunk=False):
+    """Chat completion (chunk) body with a single choice."""
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex}',
+        'object': 'chat.completion.chunk' if chunk else 'chat.completion',
+        'created': int(time.time()),
+        'model': request.get('model', 'stub'),
+        'choices': [{'index': 0, **choice}],
+    }
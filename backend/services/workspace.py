@@ -0,0 +1,84 @@
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# ioctl cloning a file into another one on copy-on-write file systems (btrfs, xfs), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def link_file(source, destination):
+    """
+    Make the file available at the destination without copying its content if possible:
+    hard-link it, else reflink it, else copy it. Returns how it was done.
+    """
+    try:
+        os.link(source, destination)
+        return "link"
+    except OSError:
+        pass
+
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            return "reflink"
+        except OSError:
+            shutil.copyfileobj(source_file, destination_file, settings.UPLOAD_CHUNK_SIZE)
+    logger.info(f"Copied {source}, it could not be linked into the workspace.")
+    return "copy"
+
+
+class Workspace:
+    """
+    Directory a job runs in, below the workspace root. It holds the input files, linked from where
+    they are stored, and main.py. Its `output` entry is a symlink to the job's own directory below
+    the outputs root. The sandbox mounts the workspace read-only and only the output directory writable,
+    both at the same paths as on the host so that the symlink resolves in the container as well.
+    """
+
+    def __init__(self, workspace_root=None, outputs_root=None):
+        workspace_root = Path(workspace_root or settings.PODMAN_WORKSPACE_ROOT).resolve()
+        outputs_root = Path(outputs_root or settings.PODMAN_OUTPUTS_ROOT).resolve()
+        workspace_root.mkdir(parents=True, exist_ok=True)
+        outputs_root.mkdir(parents=True, exist_ok=True)
+
+        self.directory = Path(tempfile.mkdtemp(dir=workspace_root))
+        self.output_directory = outputs_root / self.directory.name
+        self.output_directory.mkdir()
+        (self.directory / "output").symlink_to(self.output_directory, target_is_directory=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+    def add_input(self, source, name):
+        """Link a stored file into the workspace under the given name."""
+        destination = self.directory / name
+        link_file(source, destination)
+        return destination
+
+    def save_upload(self, file, name=None):
+        """
+        Store an uploaded file in the workspace, under its own name unless another one is given,
+        linking it if Django already wrote it to disk.
+        """
+        name = name or file.name
+        if hasattr(file, "temporary_file_path"):
+            return self.add_input(file.temporary_file_path(), name)
+        destination = self.directory / name
+        with destination.open("wb") as f:
+            for chunk in file.chunks(settings.UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        return destination
+
+    def cleanup(self):
+        """Remove the workspace and its output directory."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        shutil.rmtree(self.output_directory, ignore_errors=True)